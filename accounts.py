@@ -0,0 +1,50 @@
+from collections import namedtuple
+
+import password_policy
+
+
+# Stored in place of optional profile fields left blank
+NOT_AVAILABLE = "NOT AVAILABLE"
+
+# Profile fields as register() stores them
+Profile = namedtuple("Profile", "username fullname address city bike phone")
+
+
+def check_profile(username, fullname):
+    """Returns why a profile must be refused, or None when its required fields are present"""
+    if not username:
+        return "must require a username"
+    if not fullname:
+        return "must require full name"
+    return None
+
+
+def check(username, fullname, password, confirmation):
+    """Returns why a sign-up must be refused, or None when the required fields and the password are acceptable"""
+    problem = check_profile(username, fullname)
+    if problem:
+        return problem
+    if not password:
+        return "must require a password"
+    if password != confirmation:
+        return "passwords do not match"
+    return password_policy.check(password.strip())
+
+
+def clean(username, fullname, address, city, bike, phone):
+    """Returns the profile as stored: lowercase username, capitalised fields, blanks replaced and phone prefixed"""
+    address = address or NOT_AVAILABLE
+    city = city or NOT_AVAILABLE
+    bike = bike or NOT_AVAILABLE
+    phone = phone or NOT_AVAILABLE
+    # Numbers already carrying a country code, e.g. from an export, are kept as they are
+    if phone != NOT_AVAILABLE and not phone.startswith("+"):
+        phone = "+91-" + phone
+    return Profile(
+        username.lower(),
+        fullname[0].upper() + fullname[1:],
+        address[0].upper() + address[1:],
+        city[0].upper() + city[1:],
+        bike[0].upper() + bike[1:],
+        phone,
+    )
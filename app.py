@@ -1,41 +1,161 @@
 import os
 
-from cs50 import SQL
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
-from tempfile import mkdtemp
-from werkzeug.security import check_password_hash, generate_password_hash
-from datetime import datetime, timedelta
+from flask import Flask, Response, flash, jsonify, redirect, render_template, request, session
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime
 import secrets
-
-from helpers import apology, login_required, lookup, usd
+import threading
+
+import accounts
+import bulk
+import compaction
+import database
+import events
+import fragment_cache
+import friendship
+import hashing
+import http_cache
+import instrumentation
+import matcher
+import partitions
+import password_policy
+import places
+import ratelimit
+import relocation
+import repository
+import sessions
+import stats
+import typeahead
+from feed import load_feed, pool_created
+from geo import geocode
+from hashing import HashingBusy, hasher
+from helpers import apology, day_month_year, login_required, lookup, rate_limited, usd
+from migrations import db_cli
 
 # Configure application
 app = Flask(__name__)
 
 # Custom filter
 app.jinja_env.filters["usd"] = usd
-
-# Generate a random secret key using the secrets module and store it in the variable secret_key
-secret_key = secrets.token_hex(16)
-
-# Set the session type to use the filesystem to store session data and then Set the Flask app's secret key to be the value stored in the secret_key variable
-app.config["SESSION_TYPE"] = "filesystem"
-app.secret_key = "secret_key"
-
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///project.db")
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///project.db'
-
-
-# This decorator sets response headers to prevent caching
-@app.after_request
-def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
+app.jinja_env.filters["day_month_year"] = day_month_year
+
+# Behind PROXY_HOPS reverse proxies, take the client's address and scheme from the X-Forwarded-For and
+# X-Forwarded-Proto headers they set, so rate limits key on each client rather than the proxy. 0 trusts no header
+app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))
+if app.config["PROXY_HOPS"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"], x_proto=app.config["PROXY_HOPS"])
+
+# Read the secret key from the environment, every worker must share it, otherwise generate one for local development
+app.secret_key = os.environ.get("SECRET_KEY") or secrets.token_hex(16)
+
+# Configure the pooled SQLite connections, the schema is owned by 'flask db upgrade'
+app.config["DATABASE"] = "project.db"
+database.configure(app.config["DATABASE"])
+app.cli.add_command(db_cli)
+
+# Store sessions server-side, SESSION_TYPE picks 'sqlite' (shared by all workers), 'memory' (single worker) or 'cookie'.
+# Each worker keeps the sqlite sessions it read in memory for up to SESSION_CACHE_SECONDS
+app.config["SESSION_TYPE"] = os.environ.get("SESSION_TYPE", "sqlite")
+app.config["SESSION_CACHE_SECONDS"] = float(os.environ.get("SESSION_CACHE_SECONDS", sessions.CACHE_SECONDS))
+sessions.init_app(app)
+
+# Hash passwords in a bounded process pool, PASSWORD_HASH_METHOD sets the cost of new hashes
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", hashing.HASH_METHOD)
+hashing.init_app(app)
+
+# Reject passwords shorter than PASSWORD_MIN_LENGTH, missing a class of PASSWORD_REQUIRED_CLASSES (comma-separated
+# 'upper', 'lower', 'digit', 'special') or listed in the PASSWORD_DENYLIST file, an empty path turns the list off
+app.config["PASSWORD_MIN_LENGTH"] = int(os.environ.get("PASSWORD_MIN_LENGTH", password_policy.MIN_LENGTH))
+app.config["PASSWORD_REQUIRED_CLASSES"] = tuple(
+    name.strip() for name in os.environ.get("PASSWORD_REQUIRED_CLASSES", ",".join(password_policy.REQUIRED_CLASSES)).split(",")
+    if name.strip()
+)
+app.config["PASSWORD_DENYLIST"] = os.environ.get("PASSWORD_DENYLIST", password_policy.DENYLIST_PATH)
+password_policy.init_app(app)
+
+# Archive expired pools every COMPACTION_INTERVAL seconds in a background thread, 0 leaves it to 'flask db compact'
+app.config["COMPACTION_INTERVAL"] = float(os.environ.get("COMPACTION_INTERVAL", compaction.INTERVAL))
+compaction.init_app(app)
+
+# Pair riders without a bike with bike owners heading the same way every MATCH_INTERVAL seconds in a background
+# thread, 0 leaves it to 'flask db match'
+app.config["MATCH_INTERVAL"] = float(os.environ.get("MATCH_INTERVAL", matcher.INTERVAL))
+matcher.init_app(app)
+
+# Keep live pools in one in-memory partition per city so a feed only reads its rider's city, POOL_PARTITIONS 'none'
+# keeps every city in one
+app.config["POOL_PARTITIONS"] = os.environ.get("POOL_PARTITIONS", partitions.DEFAULT_PARTITIONING)
+partitions.init_app(app)
+
+# Push new pools, invites and accepted friend requests to the homepage over /stream when EVENTS_STREAM is 'on'. Each
+# open stream holds a worker thread for up to EVENTS_STREAM_SECONDS, then the browser reconnects. EVENTS_BACKEND picks
+# 'sqlite' (relayed between workers through the 'events' table, which also drops logged-out sessions from every
+# worker's session cache) or 'memory' (single worker)
+app.config["EVENTS_STREAM"] = os.environ.get("EVENTS_STREAM", "off") == "on"
+app.config["EVENTS_STREAM_SECONDS"] = float(os.environ.get("EVENTS_STREAM_SECONDS", events.STREAM_SECONDS))
+app.config["EVENTS_BACKEND"] = os.environ.get("EVENTS_BACKEND", events.DEFAULT_BACKEND)
+events.init_app(app)
+
+# Cache each user's nearby pools and invitations, FEED_CACHE_TYPE picks 'sqlite' (shared by all workers),
+# 'memory' (single worker) or 'none'
+app.config["FEED_CACHE_TYPE"] = os.environ.get("FEED_CACHE_TYPE", fragment_cache.DEFAULT_TYPE)
+fragment_cache.init_app(app)
+
+# Cache fingerprinted static files for a year, revalidate JSON with ETags and never store pages
+http_cache.init_app(app)
+
+# Count and time each request's SQL statements for /metrics, logging statements slower than SQL_SLOW_SECONDS and
+# any statement a request runs more than SQL_REPEAT_LIMIT times, which usually means an N+1 query
+app.config["SQL_INSTRUMENTATION"] = os.environ.get("SQL_INSTRUMENTATION", "on") == "on"
+app.config["SQL_SLOW_SECONDS"] = float(os.environ.get("SQL_SLOW_SECONDS", instrumentation.SLOW_SECONDS))
+app.config["SQL_REPEAT_LIMIT"] = int(os.environ.get("SQL_REPEAT_LIMIT", instrumentation.REPEAT_LIMIT))
+
+# Serve /metrics only to scrapers sending 'Authorization: Bearer METRICS_TOKEN', unset it answers 404 to everyone.
+# Statements beyond the first SQL_STATEMENT_LIMIT distinct ones share one label
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN") or None
+app.config["SQL_STATEMENT_LIMIT"] = int(os.environ.get("SQL_STATEMENT_LIMIT", instrumentation.STATEMENT_LIMIT))
+instrumentation.init_app(app)
+
+# Suggest users from an in-memory prefix index of usernames and names, TYPEAHEAD_LIMIT caps the suggestions and
+# users registered by other workers or imported show up within TYPEAHEAD_SYNC_INTERVAL seconds
+app.config["TYPEAHEAD_LIMIT"] = int(os.environ.get("TYPEAHEAD_LIMIT", typeahead.LIMIT))
+app.config["TYPEAHEAD_SYNC_INTERVAL"] = float(os.environ.get("TYPEAHEAD_SYNC_INTERVAL", typeahead.SYNC_INTERVAL))
+typeahead.init_app(app)
+
+# Throttle log-ins and the pool, friend and invite forms with per-user and per-address token buckets, RATE_LIMIT_BACKEND
+# picks 'sqlite' (shared by all workers through the 'rate_limits' table), 'memory' (single worker) or 'none'
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", ratelimit.DEFAULT_BACKEND)
+ratelimit.init_app(app)
+
+# Pools listed per page of the history view
+HISTORY_PAGE_SIZE = 25
+
+# Background threads set up above, started with the first request so 'flask db' commands and scripts importing the app
+# run none of them
+BACKGROUND_THREADS = ("session_sweeper", "pool_compactor", "event_relay", "ride_matcher")
+background_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_threads():
+    for name in BACKGROUND_THREADS:
+        thread = app.extensions.get(name)
+        if thread is not None and thread.ident is None:
+            with background_lock:
+                if thread.ident is None:
+                    thread.start()
+
+
+# Return the request's database connection to the pool once the request is done
+@app.teardown_appcontext
+def release_connection(exception):
+    database.release()
+
+
+# Turn away log-ins and sign-ups quickly when the hashing pool is saturated instead of queueing them
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    return apology("server busy, please try again", 503)
 
 
 @app.route("/")
@@ -43,75 +163,19 @@ def after_request(response):
 def index():
     """Shows nearby available pools"""
 
-    # Retrieve user's address from the database
-    user_address = db.execute("SELECT address FROM users WHERE id = ?", session["user_id"])[0]["address"]
-
-    # Retrieve IDs of users who are creators of nearby pools
-    creator_id = db.execute("SELECT creator FROM pools JOIN users WHERE users.id = pools.creator AND users.address = ?", user_address)
-
-    # List to hold data about nearby available pools, pool invitations, Set to store unique route pairs for both nearby and invite pools
-    nearby_data = []
-    invite_data = []
-    unique_routes = set()
-    invite_routes = set()
-
-    # Cutoff time for recent pools
-    cutoff_time = datetime.now().timestamp() - timedelta(hours=2).total_seconds()
-
-    if creator_id:
-        for creator in creator_id:
-            creator = creator["creator"]
-            if creator != session["user_id"]:
-                # Retrieve pool information from users and pools tables
-                info_dict = db.execute("SELECT username, fullname, bike, phone, origin, destination, time FROM users JOIN pools WHERE users.id = pools.creator AND users.id =  ?", creator)
-                for pool in info_dict:
-                    time = pool["time"]
-                    # Check if the pool's time is more recent than the cutoff time
-                    if float(time) > cutoff_time:
-                        # Create a tuple representing the origin-destination route
-                        route = (pool["origin"], pool["destination"])
-                        if route not in unique_routes:
-                            # Add the route to the set of unique routes
-                            unique_routes.add(route)
-                            # Append pool data to the list of nearby_data
-                            nearby_data.append(
-                                {
-                                    "username": pool["username"],
-                                    "fullname": pool["fullname"],
-                                    "bike": pool["bike"],
-                                    "phone": pool["phone"],
-                                    "origin": pool["origin"],
-                                    "destination": pool["destination"],
-                                }
-                            )
-
-    # Retrieve pool invitations for the logged-in user
-    invites = db.execute("SELECT username, fullname, bike, phone, origin, destination, time FROM users JOIN pools WHERE users.id = pools.creator AND follower = ?", session["user_id"])
-
-    if invites:
-        for invite in invites:
-            # Check if the pool's time by invitation is more recent than the cutoff time
-            if float(invite["time"]) > cutoff_time:
-                # Create a tuple representing the origin-destination route
-                route = (invite["origin"], invite["destination"])
-                if route not in invite_routes:
-                    # Add the route to the set of unique invite routes
-                    invite_routes.add(route)
-                    # Append pool data to the list of invite_data
-                    invite_data.append(
-                        {
-                            "username": invite["username"],
-                            "fullname": invite["fullname"],
-                            "bike": invite["bike"],
-                            "phone": invite["phone"],
-                            "origin": invite["origin"],
-                            "destination": invite["destination"],
-                        }
-                    )
-    return render_template("index.html", nearby_data=nearby_data, invite_data=invite_data)
+    # Optional destination the user is heading to, used to narrow nearby pools to ones going the same way
+    destination = request.args.get("destination", "").strip()
+
+    # Retrieve live nearby pools and pool invitations for the logged-in user in a fixed number of queries
+    feed = load_feed(session["user_id"], destination)
+    return render_template(
+        "index.html", nearby_data=feed.nearby, invite_data=feed.invites, recommended_data=feed.recommended, match_data=feed.matches, destination=destination,
+        live_updates=app.config["EVENTS_STREAM"],
+    )
 
 
 @app.route("/login", methods=["GET", "POST"])
+@rate_limited("login")
 def login():
     """User log-in"""
 
@@ -125,16 +189,20 @@ def login():
         elif not request.form.get("password").strip():
             return apology("provide a password", 400)
 
-        rows = db.execute("SELECT * FROM users WHERE username = ?", request.form.get("username").strip())
+        user = repository.user_by_username(request.form.get("username").strip())
 
-        if len(rows) != 1:
+        if user is None:
             return apology("enter a valid username", 400)
 
-        elif not check_password_hash(rows[0]["hash"], request.form.get("password").strip()):
+        elif not hasher.verify(user.hash, request.form.get("password").strip()):
             return apology("incorrect password", 400)
 
+        # Upgrade hashes made with an older cost in the background, the password is only known right now
+        if hasher.needs_rehash(user.hash):
+            hasher.rehash_later(user.id, user.hash, request.form.get("password").strip())
+
         # Store the user's ID in the session
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user.id
         return redirect("/")
 
     else:
@@ -152,6 +220,7 @@ def logout():
 
 
 @app.route("/create_pool", methods=["GET", "POST"])
+@rate_limited("create_pool")
 def create_pool():
     """Creates a pool by user"""
     if request.method == "POST":
@@ -163,27 +232,22 @@ def create_pool():
             return apology("must require ride destination address", 400)
 
         else:
-            # Extract and format data from the form
-            start = request.form.get("start").strip()
-            start = start[0].upper() + start[1:]
-            destination = request.form.get("destination").strip()
-            destination = destination[0].upper() + destination[1:]
-
-            # Get current timestamp for pool creation time
+            # Get current timestamp for pool creation time and the date shown in the history
             creation_time = datetime.now().timestamp()
-            db.execute("INSERT INTO pools (creator, origin, destination, time) VALUES (?, ?, ?, ?)", session["user_id"], start, destination, creation_time)
+            formatted_date = datetime.fromtimestamp(creation_time).strftime("%Y-%m-%d")
 
-        # Retrieve the pool information from the 'pools' table based on the creation time of pool that was just created above
-        pool = db.execute("SELECT * FROM pools WHERE time = ?", creation_time)[0]
+            # Intern both ends of the ride within the creator's city, places seen for the first time are geocoded
+            home = repository.user_location(session["user_id"])
+            origin = places.intern(request.form.get("start"), home.city)
+            destination = places.intern(request.form.get("destination"), home.city)
+            origin_point = (origin.latitude, origin.longitude)
 
-        # Convert the creation timestamp to a datetime object for formatting
-        datetime_obj = datetime.fromtimestamp(creation_time)
+            # Store the pool and its history entry in one transaction, the new id comes straight from the insert
+            pool_id = repository.create_pool(session["user_id"], home.city_id, origin.id, destination.id, creation_time, formatted_date)
 
-        # Format timestamp to a readable date and time
-        formatted_date = datetime_obj.strftime("%d/%m/%Y")
-        formatted_time = datetime_obj.strftime("%H/%M/%S")
-
-        db.execute("INSERT INTO history (user_id, pool_id, origin, destination, date) VALUES (?, ?, ?, ?, ?)", session["user_id"], pool["id"], pool["origin"], pool["destination"], formatted_date)
+            # Pull the new pool into this worker's nearby index and route scoring arrays, and tell riders living nearby
+            pool_created(session["user_id"], home.city_id, origin_point)
+            events.pool_created(session["user_id"], pool_id, origin.name, destination.name, origin_point, home.place_id)
         return redirect("/")
 
     else:
@@ -202,127 +266,34 @@ def register():
         bike = request.form.get("bike").strip()
         phone = request.form.get("phone").strip()
 
-        # Validation checks for user input
-        if not username:
-            return apology("must require a username", 400)
-
-        elif not fullname:
-            return apology("must require full name", 400)
-
-        elif not request.form.get("password"):
-            return apology("must require a password", 400)
-
-        elif request.form.get("password") != request.form.get("confirmation"):
-            return apology("passwords do not match", 400)
-
-        # Set default values for optional user inputs if they are not provided
-        elif not address:
-            address = "NOT AVAILABLE"
-
-        elif not city:
-            city = "NOT AVAILABLE"
-
-        elif not bike:
-            bike = "NOT AVAILABLE"
-
-        elif not phone:
-            phone = "NOT AVAILABLE"
-
-        # Validate password complexity
-        password = request.form.get("password").strip()
-        if len(password) < 8:
-            return apology("password must contain 8 characters", 400)
-
-        for char in password:
-            has_upper = False
-            for char in password:
-                if char.isupper():
-                    has_upper = True
-                    break
-
-        if not has_upper:
-            return apology("password must contain at least one uppercase character", 400)
-
-        for char in password:
-            has_lower = False
-            for char in password:
-                if char.islower():
-                    has_lower = True
-                    break
-
-        if not has_lower:
-            return apology("password must contain at least one lowercase character", 400)
-
-        for char in password:
-            has_number = False
-            for char in password:
-                if char.isdigit():
-                    has_number = True
-                    break
-
-        if not has_number:
-            return apology("password must contain at least one number", 400)
-
-        ALLOWED_SPECIAL_CHARS = set(
-            [
-                "!",
-                "@",
-                "#",
-                "$",
-                "%",
-                "^",
-                "&",
-                "*",
-                "(",
-                ")",
-                "-",
-                "_",
-                "+",
-                "=",
-                "{",
-                "}",
-                "[",
-                "]",
-                "|",
-                "\\",
-                ";",
-                ":",
-                "'",
-                '"',
-                "<",
-                ">",
-                ",",
-                ".",
-                "?",
-                "/",
-            ]
-        )
-        has_special = False
-        for char in password:
-            if char in ALLOWED_SPECIAL_CHARS:
-                has_special = True
-                break
-
-        if not has_special:
-            return apology("password must contain a special character", 400)
+        # Validation checks for user input, shared with 'flask db import'
+        password = request.form.get("password")
+        problem = accounts.check(username, fullname, password, request.form.get("confirmation"))
+        if problem:
+            return apology(problem, 400)
 
         # Check if username already exists
-        existing_user = db.execute("SELECT * FROM users WHERE username = ?", username.lower())
+        existing_user = repository.user_by_username(username.lower())
         if existing_user:
             return apology("username already exists", 400)
 
         else:
-            # Format and store user data in the database
-            username = username.lower()
-            fullname = fullname[0].upper() + fullname[1:]
-            address = address[0].upper() + address[1:]
-            city = city[0].upper() + city[1:]
-            bike = bike[0].upper() + bike[1:]
+            # Format and store user data in the database, blank optional fields become "NOT AVAILABLE"
+            profile = accounts.clean(username, fullname, address, city, bike, phone)
             # Hash the user's password
-            hash = generate_password_hash(password)
-            if phone != "NOT AVAILABLE":
-                phone = "+91-" + phone
-            db.execute("INSERT INTO users (username, fullname, hash, address, city, bike, phone) VALUES (?, ?, ?, ?, ?, ?, ?)", username, fullname, hash, address, city, bike, phone)
+            hash = hasher.hash(password.strip())
+            # Users living at the same place see each other's pools, those without an address are geocoded to their city
+            place = places.home(profile.address, profile.city)
+            latitude, longitude = (place.latitude, place.longitude) if place else geocode(profile.address, profile.city)
+            with database.transaction():
+                user_id = repository.create_user(
+                    profile.username, profile.fullname, hash, profile.address, profile.city, profile.bike, profile.phone, latitude, longitude,
+                    place.id if place else None, places.city(profile.city),
+                )
+                # Neighbours are suggested to each other before they share any friend
+                friendship.add_neighbours(user_id)
+            # Make the new user searchable in this worker right away
+            typeahead.index.sync(force=True)
             return redirect("/")
     else:
         return render_template("register.html")
@@ -344,90 +315,18 @@ def change_password():
             return apology("confirm password must be same as new password", 400)
 
         # Validate new password complexity
-        new_password = request.form.get("password").strip()
-        if len(new_password) < 8:
-            return apology("password must contain 8 characters", 400)
-
-        for char in new_password:
-            has_upper = False
-            for char in new_password:
-                if char.isupper():
-                    has_upper = True
-                    break
-
-        if not has_upper:
-            return apology("password must contain at least one uppercase character", 400)
-
-        for char in new_password:
-            has_lower = False
-            for char in new_password:
-                if char.islower():
-                    has_lower = True
-                    break
-
-        if not has_lower:
-            return apology("password must contain at least one lowercase character", 400)
-
-        for char in new_password:
-            has_number = False
-            for char in new_password:
-                if char.isdigit():
-                    has_number = True
-                    break
-
-        if not has_number:
-            return apology("password must contain at least one number", 400)
-
-        ALLOWED_SPECIAL_CHARS = set(
-            [
-                "!",
-                "@",
-                "#",
-                "$",
-                "%",
-                "^",
-                "&",
-                "*",
-                "(",
-                ")",
-                "-",
-                "_",
-                "+",
-                "=",
-                "{",
-                "}",
-                "[",
-                "]",
-                "|",
-                "\\",
-                ";",
-                ":",
-                "'",
-                '"',
-                "<",
-                ">",
-                ",",
-                ".",
-                "?",
-                "/",
-            ]
-        )
-        has_special = False
-        for char in new_password:
-            if char in ALLOWED_SPECIAL_CHARS:
-                has_special = True
-                break
-
-        if not has_special:
-            return apology("password must contain a special character", 400)
+        new_password = request.form.get("new_password").strip()
+        problem = password_policy.check(new_password)
+        if problem:
+            return apology(problem, 400)
 
         # Retrieve the old password hash from the database
-        old_hash = db.execute("SELECT hash FROM users WHERE id = ?", session["user_id"])[0]["hash"]
+        old_hash = repository.password_hash(session["user_id"])
 
-        if check_password_hash(old_hash, request.form.get("old_password").strip()):
+        if hasher.verify(old_hash, request.form.get("old_password").strip()):
             # Hash the new password and update it in the database
-            hash_new = generate_password_hash(request.form.get("new_password").strip())
-            db.execute("UPDATE users SET hash = ? WHERE id = ?", hash_new, session["user_id"])
+            hash_new = hasher.hash(new_password)
+            repository.set_password_hash(session["user_id"], hash_new)
             return redirect("/")
         else:
             return apology("incorrect password")
@@ -437,6 +336,7 @@ def change_password():
 
 @app.route("/add_friend", methods=["GET", "POST"])
 @login_required
+@rate_limited("add_friend")
 def add_friend():
     """Sends a friend request to another user"""
     if request.method == "POST":
@@ -444,35 +344,24 @@ def add_friend():
         if not request.form.get("friend_username").strip():
             return apology("must require username", 400)
 
-        rows = db.execute("SELECT * FROM users WHERE username = ?", request.form.get("friend_username").strip())
+        receiver = repository.user_id(request.form.get("friend_username").strip())
 
-        if len(rows) != 1:
+        if receiver is None:
             return apology("enter a valid user", 400)
 
         sender = session["user_id"]
-        receiver = rows[0]["id"]
 
         # Return error if sending request to oneself
         if sender == receiver:
             return apology("you can't send yourself a friend request", 400)
 
-        # Create the 'requests' table if it doesn't exist already
-        db.execute(''' CREATE TABLE IF NOT EXISTS requests (
-                           id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-                           sender INTEGER NOT NULL,
-                           receiver INTEGER NOT NULL,
-                           status TEXT DEFAULT 'pending',
-                           FOREIGN KEY (sender) REFERENCES users(id),
-                           FOREIGN KEY (receiver) REFERENCES users(id)
-                           )''')
-
         # Check if a friend request has already been sent from the current user to the specified receiver
-        request_sent = db.execute("SELECT * FROM requests WHERE sender = ? AND receiver = ?", sender, receiver)
+        request_sent = repository.friend_request(sender, receiver)
         if request_sent:
             # Render template indicating friend request already sent
             return render_template("friendreq.html", already_sent=True)
 
-        db.execute("INSERT INTO requests (sender, receiver, status) VALUES (?, ?, 'pending')", sender, receiver)
+        repository.send_friend_request(sender, receiver)
         success = True
         # Render template indicating friend request successfully sent
         return render_template("friendreq.html", success=success)
@@ -493,73 +382,35 @@ def friends():
 
         # Get the sender's username from the JSON data
         sender_name = answer["sender"]
-        sender = db.execute("SELECT id FROM users WHERE username = ?", sender_name)[0]["id"]
+        sender = repository.user_id(sender_name)
 
-        # Update the status of the friend request based on the selected option
+        # Update the status of the friend request based on the selected option and refresh both friend sets
+        friendship.answer_request(sender, session["user_id"], option)
         if option == "accept":
-            db.execute("UPDATE requests SET status = 'accepted' WHERE sender = ? AND receiver = ?", sender, session["user_id"])
-        elif option == "reject":
-            db.execute("UPDATE requests SET status = 'rejected' WHERE sender = ? AND receiver = ?", sender, session["user_id"])
+            events.request_accepted(sender, session["user_id"])
         return redirect("/friends")
     else:
-        # Get the list of senders who sent friend requests
-        rows = db.execute("SELECT sender FROM requests WHERE receiver = ? AND status = 'pending'", session["user_id"])
-        senders = []
-        for row in rows:
-            req = row["sender"]
-            # Fetch the sender's username from the database and adding the sender's username to the 'senders' list
-            sender = db.execute("SELECT username FROM users JOIN requests ON users.id = requests.sender WHERE users.id = ?", req)[0]["username"]
-            senders.append(sender)
-
-         # Get the list of friends and their details
-        friends_dict1 = db.execute("SELECT username FROM users JOIN requests ON users.id = requests.receiver WHERE requests.sender = ? AND requests.status = 'accepted'", session["user_id"])
-        friends_dict2 = db.execute("SELECT username FROM users JOIN requests ON users.id = requests.sender WHERE requests.receiver = ? AND requests.status = 'accepted'", session["user_id"])
-
-        friends_list1 = []
-        for friend in friends_dict1:
-            friends_list1.append(friend["username"])
-
-        friends_list2 = []
-        for friend in friends_dict2:
-            friends_list2.append(friend["username"])
-
-        # Combine the two lists and create a unique set of usernames using 'set', then convert back to a list
-        friends_list = list(set(friends_list1 + friends_list2))
-
-        friends_fullname = []
-        friends_address = []
-        friends_bike = []
-        for friend in friends_list:
-            # Fetch the friend's full name, address, and bike information from the database and adding the retrieved information to the respective lists
-            fullname_dict = db.execute("SELECT fullname FROM users WHERE username = ?", friend)[0]["fullname"]
-            address_dict = db.execute("SELECT address FROM users WHERE username = ?", friend)[0]["address"]
-            bike_dict = db.execute("SELECT bike FROM users WHERE username = ?", friend)[0]["bike"]
-            friends_address.append(address_dict)
-            friends_bike.append(bike_dict)
-            friends_fullname.append(fullname_dict)
-
-        # Zip friends' data together if available
-        if friends_list:
-            if friends_fullname:
-                if friends_address:
-                    if friends_bike:
-                        friends_data = zip(
-                            friends_list,
-                            friends_fullname,
-                            friends_address,
-                            friends_bike,
-                        )
-        else:
-            friends_data = []
-        return render_template("friends.html", senders=senders, friends_data=friends_data)
+        # Get the usernames of users who sent friend requests
+        senders = repository.pending_senders(session["user_id"])
+
+        # Get the list of friends and their details in one batched query
+        friends_data = [(friend.username, friend.fullname, friend.address, friend.bike) for friend in friendship.friend_profiles(session["user_id"])]
+
+        # People the user may know, read ranked from the suggestions kept up to date as requests are accepted
+        suggestions = friendship.suggestions(session["user_id"])
+        return render_template("friends.html", senders=senders, friends_data=friends_data, suggestions=suggestions)
 
 @app.route("/invite", methods=["GET", "POST"])
 @login_required
+@rate_limited("invite")
 def invite():
     """Send Invite to friends for pool"""
     if request.method == "POST":
+        # Every friend picked in the form, each gets their own invitation
+        friend_names = list(dict.fromkeys(name.strip().lower() for name in request.form.getlist("friend_username") if name.strip()))
+
         # Validation checks for user input
-        if not request.form.get("friend_username").strip():
+        if not friend_names:
             return apology("must require friend's username", 400)
 
         elif not request.form.get("origin").strip():
@@ -568,78 +419,120 @@ def invite():
         elif not request.form.get("destination").strip():
             return apology("must require destination", 400)
 
-        else:
-            # Extract and format data from the form
-            friend_name = request.form.get("friend_username").strip()
-            friend = db.execute("SELECT id FROM users WHERE username = ?", friend_name)[0]["id"]
-            origin = request.form.get("origin").strip()
-            origin = origin[0].upper() + origin[1:]
-            destination = request.form.get("destination").strip()
-            destination = destination[0].upper() + destination[1:]
-
-            # Get current timestamp for invited pool creation time
-            invite_time = datetime.now().timestamp()
-            db.execute("INSERT INTO pools (creator, follower, origin, destination, time) VALUES (?, ?, ?, ?, ?)", session["user_id"], friend, origin, destination, invite_time)
-            pool_id = db.execute("SELECT id FROM pools WHERE time = ?", invite_time)[0]["id"]
-
-            # Format timestamp to a readable date and time
-            datetime_obj = datetime.fromtimestamp(invite_time)
-            formatted_date = datetime_obj.strftime("%d/%m/%Y")
-            formatted_time = datetime_obj.strftime("%H/%M/%S")
-
-        db.execute("INSERT INTO history (user_id, pool_id, recipient_id, origin, destination, date) VALUES (?, ?, ?, ?, ?, ?)", session["user_id"], pool_id, friend, origin, destination, formatted_date)
+        # Every name must be a user, that they are all friends is checked when the invitations are stored
+        friends = repository.users_by_usernames(friend_names)
+        if len(friends) < len(friend_names):
+            return apology("you can only invite your friends", 400)
+
+        # Get current timestamp for invited pool creation time and the date shown in the history
+        invite_time = datetime.now().timestamp()
+        formatted_date = datetime.fromtimestamp(invite_time).strftime("%Y-%m-%d")
+
+        # Intern both ends of the ride within the creator's city
+        home = repository.user_location(session["user_id"])
+        origin = places.intern(request.form.get("origin"), home.city)
+        destination = places.intern(request.form.get("destination"), home.city)
+
+        # Store one pool per friend and their history entries in a single transaction
+        invited = repository.invite_friends(
+            session["user_id"], home.city_id, [friend.id for friend in friends.values()], origin.id, destination.id, invite_time, formatted_date,
+        )
+        if invited is None:
+            return apology("you can only invite your friends", 400)
+        pool_created(session["user_id"], home.city_id, (origin.latitude, origin.longitude), followers=list(invited))
+        events.friends_invited(session["user_id"], invited, origin.name, destination.name)
         return redirect("/")
     else:
         # Fetch and display the list of friends for inviting
-        friends_dict1 = db.execute("SELECT username FROM users JOIN requests ON users.id = requests.receiver WHERE requests.sender = ? AND requests.status = 'accepted'", session["user_id"])
-        friends_dict2 = db.execute("SELECT username FROM users JOIN requests ON users.id = requests.sender WHERE requests.receiver = ? AND requests.status = 'accepted'", session["user_id"])
+        friends_list = [friend.username for friend in friendship.friend_profiles(session["user_id"])]
+        return render_template("invite.html", friends_list=friends_list)
 
-        friends_list1 = []
-        for friend in friends_dict1:
-            friends_list1.append(friend["username"])
 
-        friends_list2 = []
-        for friend in friends_dict2:
-            friends_list2.append(friend["username"])
+@app.route("/api/users/search")
+@login_required
+def search_users():
+    """Suggests users whose username or name starts with the 'q' parameter, friends and friends of friends first"""
+    return jsonify(typeahead.suggest(session["user_id"], request.args.get("q", ""), app.config["TYPEAHEAD_LIMIT"]))
 
-        friends_list = list(set(friends_list1 + friends_list2))
-        return render_template("invite.html", friends_list=friends_list)
 
+@app.route("/cache_stats")
+@login_required
+def cache_stats():
+    """Shows this worker's homepage cache counters"""
+    return jsonify(fragment_cache.cache.stats())
 
-@app.route("/history")
+
+@app.route("/metrics")
+def metrics():
+    """Shows this worker's request and SQL metrics in the Prometheus text format to a scraper holding METRICS_TOKEN"""
+
+    # Statement texts and per-route timings are for the operators' scraper only, everyone else sees no such page
+    if not instrumentation.metrics.authorized(request.headers.get("Authorization")):
+        return apology("not found", 404)
+    return Response(instrumentation.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/stream")
 @login_required
-def history():
-    """Shows previous bike pools"""
-
-    # Create the 'history' table if it doesn't already exist
-    db.execute('''CREATE TABLE IF NOT EXISTS history (
-                      id INTEGER PRIMARY KEY AUTOINCREMENT,
-                      user_id INTEGER NOT NULL,
-                      pool_id INTEGER NOT NULL,
-                      recipient_id TEXT,
-                      origin TEXT NOT NULL,
-                      destination TEXT NOT NULL,
-                      date TEXT NOT NULL,
-                      FOREIGN KEY (user_id) REFERENCES users(id),
-                      FOREIGN KEY (pool_id) REFERENCES pools(id)
-                      )''')
-
-    # Fetch the user's history from the 'history' table
-    history = db.execute("SELECT * FROM history WHERE user_id = ?", session["user_id"])
-    recipient_name = []
-    for pool in history:
-        recipient_id = pool["recipient_id"]
-        if recipient_id:
-            recipient_id = int(recipient_id)
-            fullname = db.execute("SELECT fullname from users WHERE id = ?", recipient_id)[0]["fullname"]
-            recipient_name.append(fullname)
-        else:
-            recipient_name.append("EVERYONE")
+def stream():
+    """Streams new nearby pools, invites and accepted friend requests as server-sent events"""
+    if not app.config["EVENTS_STREAM"]:
+        return apology("not found", 404)
+    subscriber = events.bus.subscribe(repository.user_location(session["user_id"]))
 
-    # Zip the history information with recipient names if applicable
-    if history:
-        history_info = zip(history, recipient_name)
-        return render_template("history.html", history_info=history_info)
+    # The stream holds a worker thread for as long as it stays open, so it must not hold on to a database connection
+    # as well
+    database.release()
+    return Response(
+        events.stream(subscriber, lifetime=app.config["EVENTS_STREAM_SECONDS"]), mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/stats")
+@login_required
+def route_stats():
+    """Shows the busiest routes of the user's city and when pools are created, for the whole city or one route"""
+
+    # Everything is read from the rollups kept up to date as pools are created, never from the pools themselves
+    home = repository.user_location(session["user_id"])
+    routes = repository.top_routes(home.city_id, stats.TOP_ROUTES)
+
+    # A route picked from the table narrows the heatmap down to it
+    origin_id = request.args.get("origin", type=int)
+    destination_id = request.args.get("destination", type=int)
+    if origin_id and destination_id:
+        hours = repository.route_hours(home.city_id, origin_id, destination_id)
+        route = (repository.place_name(origin_id), repository.place_name(destination_id))
     else:
-        # Render the history page when there's no history information
-        return render_template("history.html")
+        hours = repository.city_hours(home.city_id)
+        route = None
+    return render_template("stats.html", routes=routes, heatmap=stats.heatmap(hours), days=stats.DAYS, route=route, city=home.city)
+
+
+@app.route("/history")
+@login_required
+def history():
+    """Shows previous bike pools, one page at a time"""
+
+    # Optional date range from the filter form, as inclusive YYYY-MM-DD dates
+    start = request.args.get("start") or None
+    end = request.args.get("end") or None
+    for value in (start, end):
+        if value:
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return apology("dates must be YYYY-MM-DD", 400)
+
+    # Pools older than the 'before' cursor, fetching one extra row to learn whether another page follows
+    before = request.args.get("before", type=int) or repository.FIRST_PAGE
+    pools = repository.history_page(session["user_id"], before, HISTORY_PAGE_SIZE + 1, start, end)
+    next_cursor = pools[HISTORY_PAGE_SIZE - 1].id if len(pools) > HISTORY_PAGE_SIZE else None
+    return render_template(
+        "history.html",
+        history_info=pools[:HISTORY_PAGE_SIZE],
+        next_cursor=next_cursor,
+        first_page=before == repository.FIRST_PAGE,
+        start=start or "",
+        end=end or "",
+    )
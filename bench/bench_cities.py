@@ -0,0 +1,167 @@
+"""
+Measures the homepage feed as the number of cities grows, each city holding the same riders and live pools, with
+pool storage partitioned by city and with one partition for every city: the first feed a worker serves in a city,
+which loads that city's live pools, and later feeds. Checks both layouts list the same pools, and that a rider
+without a city sees only the pools of other users without a city, and exits non-zero otherwise.
+
+Usage: python bench/bench_cities.py [--cities 1 4 16 64] [--pools-per-city 2000] [--users-per-city 200] [--lookups 400]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import feed
+import geo
+import migrations
+import scoring
+from partitions import Partitions
+
+
+# Cities are laid out this far apart in latitude, far beyond any search radius or detour
+CITY_SPACING_DEGREES = 1.0
+
+# Localities per city, scattered over a square this many degrees wide around its center
+PLACES_PER_CITY = 60
+CITY_SPAN_DEGREES = 0.2
+
+
+def generate(path, cities, pools_per_city, users_per_city, rng):
+    """Creates a migrated database of identical synthetic cities, every pool still live"""
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    now = time.time()
+    conn.execute("BEGIN")
+    users, pools = [], []
+    for number in range(cities):
+        city_id = conn.execute("INSERT INTO cities (key, name) VALUES (?, ?)", (f"city {number}", f"City {number}")).lastrowid
+        center = (10.0 + number * CITY_SPACING_DEGREES, 75.0)
+        place_ids = []
+        for place in range(PLACES_PER_CITY):
+            latitude = center[0] + rng.uniform(-CITY_SPAN_DEGREES, CITY_SPAN_DEGREES) / 2
+            longitude = center[1] + rng.uniform(-CITY_SPAN_DEGREES, CITY_SPAN_DEGREES) / 2
+            place_ids.append((conn.execute(
+                "INSERT INTO places (city, key, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                (f"city {number}", f"locality {place}", f"Locality {place}", latitude, longitude),
+            ).lastrowid, latitude, longitude))
+        first_user = len(users) + 1
+        for _ in range(users_per_city):
+            home = rng.choice(place_ids)
+            users.append((len(users) + 1, home, city_id))
+        for _ in range(pools_per_city):
+            pools.append((now - rng.uniform(0, 7000), rng.randrange(first_user, first_user + users_per_city), city_id, rng.choice(place_ids)[0], rng.choice(place_ids)[0]))
+    conn.executemany(
+        """INSERT INTO users (id, username, fullname, hash, address, city, latitude, longitude, place_id, city_id)
+           VALUES (?, ?, ?, '', ?, ?, ?, ?, ?, ?)""",
+        [(user_id, f"rider{user_id}", f"Rider {user_id}", f"Locality {home[0]}", f"City {city_id}", home[1], home[2], home[0], city_id) for user_id, home, city_id in users],
+    )
+    # Ids follow creation time, as they do in the app
+    pools.sort()
+    conn.executemany("INSERT INTO pools (time, creator, city_id, origin_id, destination_id) VALUES (?, ?, ?, ?, ?)", pools)
+    conn.execute("COMMIT")
+    conn.close()
+    return [(user_id, home[1], home[2], city_id) for user_id, home, city_id in users]
+
+
+def serve(user, cutoff, heading):
+    """Returns the nearby and recommended pool ids of one feed"""
+    nearby = feed.nearby_pools(user, cutoff)
+    recommended = feed.recommended_pools(user, cutoff, heading)
+    return [pool.id for pool in nearby], [pool.id for pool in recommended]
+
+
+def mean(values):
+    """Returns the average of the values, 0 when there are none"""
+    return sum(values) / len(values) if values else 0.0
+
+
+def run(by_city, riders, cutoff):
+    """Returns (first feed ms, later feed ms, live pools held, feeds) over the riders, from empty partitions"""
+    Partitions.by_city = by_city
+    geo.indexes.clear()
+    scoring.engines.clear()
+    first, later, feeds, seen = [], [], [], set()
+    for user, heading in riders:
+        start = time.perf_counter()
+        feeds.append(serve(user, cutoff, heading))
+        elapsed = (time.perf_counter() - start) * 1e3
+        (later if user.city_id in seen else first).append(elapsed)
+        seen.add(user.city_id)
+    held = sum(len(index) for index in geo.indexes.values())
+    return mean(first), mean(later), held, feeds
+
+
+def cityless_problems(user):
+    """Returns what went wrong listing the nearby pools of a rider without a city living where a city rider does"""
+    now = time.time()
+    with database.transaction():
+        creator = database.execute("INSERT INTO users (username, fullname, hash) VALUES ('nocity', 'No City', '')").lastrowid
+        place_id = database.query_value(
+            "SELECT id FROM places ORDER BY (latitude - ?) * (latitude - ?) + (longitude - ?) * (longitude - ?) LIMIT 1",
+            user.latitude, user.latitude, user.longitude, user.longitude,
+        )
+        pool_id = database.execute(
+            "INSERT INTO pools (time, creator, city_id, origin_id, destination_id) VALUES (?, ?, NULL, ?, ?)", now, creator, place_id, place_id,
+        ).lastrowid
+    Partitions.by_city = True
+    geo.indexes.clear()
+    cutoff = feed.cutoff_time()
+    cityless = [pool.id for pool in feed.nearby_pools(user._replace(id=creator + 1, city_id=None), cutoff)]
+    citizen = [pool.id for pool in feed.nearby_pools(user, cutoff)]
+    problems = []
+    if cityless != [pool_id]:
+        problems.append(f"a rider without a city was listed {len(cityless)} pools, expected only the one created without a city")
+    if pool_id in citizen:
+        problems.append("a city rider was listed a pool created without a city")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cities", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--pools-per-city", type=int, default=2000)
+    parser.add_argument("--users-per-city", type=int, default=200)
+    parser.add_argument("--lookups", type=int, default=400, help="feeds served at each city count")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    print(f"{args.pools_per_city} live pools and {args.users_per_city} riders per city")
+    print(f"{'cities':>7} {'layout':>7} {'first ms':>9} {'later ms':>9} {'pools held':>11}  same pools")
+    different = 0
+    for cities in args.cities:
+        rng = random.Random(args.seed)
+        path = os.path.join(folder, f"cities{cities}.db")
+        users = generate(path, cities, args.pools_per_city, args.users_per_city, rng)
+        database.configure(path)
+        cutoff = feed.cutoff_time()
+        riders = []
+        for user_id, latitude, longitude, city_id in rng.choices(users, k=args.lookups):
+            heading = (latitude + rng.uniform(-0.05, 0.05), longitude + rng.uniform(-0.05, 0.05))
+            riders.append((database.record_type(("id", "latitude", "longitude", "city_id"))(user_id, latitude, longitude, city_id), heading))
+
+        results = {}
+        for layout, by_city in (("city", True), ("none", False)):
+            first, later, held, feeds = results[layout] = run(by_city, riders, cutoff)
+            same = sum(1 for mine, theirs in zip(feeds, results["city"][3]) if mine == theirs)
+            different += len(feeds) - same
+            print(f"{cities:>7} {layout:>7} {first:>9.2f} {later:>9.2f} {held:>11}  {same}/{len(feeds)}")
+        database.release()
+    problems = cityless_problems(riders[0][0])
+    database.release()
+    Partitions.by_city = True
+    if different:
+        problems.append(f"{different} feeds listed different pools")
+    for problem in problems:
+        print(f"FAILED, {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
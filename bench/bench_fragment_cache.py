@@ -0,0 +1,97 @@
+"""
+Checks the homepage fragment cache on both backends: the least recently read fragment is the one evicted beyond the
+size limit, expired and evicted fragments are counted apart, and storing a fragment while another connection holds the
+write lock returns at once instead of waiting for it. Exits non-zero when any of these fails.
+
+Usage: python bench/bench_fragment_cache.py [--stores 200]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import fragment_cache
+import migrations
+
+
+# Stands in for a cached list of pools
+Pool = database.record_type(("id", "origin"))
+
+
+def eviction_problems(name, backend):
+    """Returns what went wrong filling a cache of three fragments with four, after reading the oldest one again"""
+    cache = fragment_cache.FragmentCache(backend)
+    later = time.time() + 60
+    for key in ("a", "b", "c"):
+        cache.set(key, [Pool(1, key)], f"tag:{key}", later)
+        # The SQLite backend tells reads apart by their timestamps
+        time.sleep(0.01)
+    cache.get("a")
+    time.sleep(0.01)
+    cache.set("d", [Pool(1, "d")], "tag:d", later)
+    problems = []
+    kept = {key for key in ("a", "b", "c", "d") if cache.get(key) is not None}
+    if kept != {"a", "c", "d"}:
+        problems.append(f"{name}: kept {sorted(kept)} after evicting one of four, expected a, c and d")
+
+    # The SQLite backend deletes an expired fragment when it trims, the memory backend when it is read
+    cache.set("gone", [Pool(1, "gone")], "tag:gone", time.time() - 1)
+    cache.get("gone")
+    stats = cache.stats()
+    if stats["evictions"] < 1 or stats["expirations"] != 1:
+        problems.append(f"{name}: counted {stats['evictions']} evictions and {stats['expirations']} expirations")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stores", type=int, default=200, help="fragments stored while another connection writes")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.close()
+    database.configure(path)
+
+    # Every read is recorded and every write trims, so three fragments are enough to see the eviction order
+    fragment_cache.TOUCH_SECONDS = 0
+    fragment_cache.TRIM_EVERY = 1
+    problems = eviction_problems("memory", fragment_cache.MemoryBackend(3))
+    problems += eviction_problems("sqlite", fragment_cache.SQLiteBackend(3))
+    database.execute("DELETE FROM fragments")
+    database.release()
+
+    # Another worker holding the write lock for the whole run, as a long import or compaction would
+    writer = sqlite3.connect(path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    cache = fragment_cache.FragmentCache(fragment_cache.SQLiteBackend())
+    timings = []
+    try:
+        for number in range(args.stores):
+            start = time.perf_counter()
+            cache.set(f"nearby:{number}", [Pool(number, "Sector 5")], f"cell:{number}")
+            timings.append(time.perf_counter() - start)
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+    database.release()
+    timings.sort()
+    print(f"{args.stores} fragments stored while another connection writes, p50 {timings[len(timings) // 2] * 1e3:.2f} ms, max {timings[-1] * 1e3:.2f} ms")
+    if timings[-1] * 1e3 >= database.BUSY_TIMEOUT_MS / 10:
+        problems.append(f"storing a fragment waited {timings[-1]:.2f} s for the write lock")
+
+    for problem in problems:
+        print(f"FAILED, {problem}")
+    if problems:
+        sys.exit(1)
+    print("eviction order and counters as expected on both backends")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Measures nearby-pool lookups on the in-process grid index at increasing numbers of live pools.
+
+Usage: python bench/bench_geo.py [--sizes 10000 100000 1000000] [--queries 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import geo
+
+
+Pool = namedtuple("Pool", "id creator follower time origin_latitude origin_longitude destination_latitude destination_longitude")
+
+# Spread pools over a 40 km square around Indore
+CENTER = (22.7196, 75.8577)
+SPREAD = 0.18
+
+
+def random_point(rng):
+    return CENTER[0] + rng.uniform(-SPREAD, SPREAD), CENTER[1] + rng.uniform(-SPREAD, SPREAD)
+
+
+def build(size, rng, now):
+    index = geo.GridIndex()
+    start = time.perf_counter()
+    for pool_id in range(1, size + 1):
+        index.add(Pool(pool_id, pool_id, None, now, *random_point(rng), *random_point(rng)))
+    return index, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--radius", type=float, default=geo.RADIUS_KM)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    now = time.time()
+    print(f"{'pools':>10} {'build s':>9} {'queries/s':>11} {'us/query':>10} {'avg hits':>9} {'+dest us':>9}")
+    for size in args.sizes:
+        index, build_time = build(size, rng, now)
+        points = [random_point(rng) for _ in range(args.queries)]
+
+        hits = 0
+        start = time.perf_counter()
+        for latitude, longitude in points:
+            hits += len(index.nearby(latitude, longitude, now - 1, args.radius))
+        elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for latitude, longitude in points:
+            index.nearby(latitude, longitude, now - 1, args.radius, destination=random_point(rng))
+        with_destination = time.perf_counter() - start
+
+        print(
+            f"{size:>10,} {build_time:>9.2f} {args.queries / elapsed:>11,.0f} {elapsed / args.queries * 1e6:>10.1f}"
+            f" {hits / args.queries:>9.1f} {with_destination / args.queries * 1e6:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Counts the bytes a browser downloads over a scripted browsing session, first with every response treated as
+no-store (the old global policy) and then honouring the Cache-Control, ETag and fingerprinted static URLs.
+
+Usage: python bench/bench_http_cache.py [--rounds 10]
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Pages a logged-in rider moves between, repeated every round
+SESSION = ["/", "/history", "/friends", "/invite", "/cache_stats", "/", "/create_pool", "/cache_stats"]
+
+# Local assets referenced by a page
+ASSET = re.compile(rb'(?:href|src)="(/static/[^"]+)"')
+
+
+class Browser:
+    """Fetches pages and their local assets, optionally keeping a cache that obeys the response headers"""
+
+    def __init__(self, client, caching):
+        self.client = client
+        self.caching = caching
+        # url -> (fresh until, etag)
+        self.cache = {}
+        self.bytes = 0
+        self.requests = 0
+        self.not_modified = 0
+
+    def fetch(self, url):
+        headers = {}
+        entry = self.cache.get(url)
+        if self.caching and entry is not None:
+            if entry[0] > time.time():
+                return b""
+            if entry[1]:
+                headers["If-None-Match"] = entry[1]
+
+        response = self.client.get(url, headers=headers)
+        body = response.get_data()
+        self.requests += 1
+        self.bytes += len(body) + sum(len(name) + len(value) + 4 for name, value in response.headers.items())
+        if response.status_code == 304:
+            self.not_modified += 1
+
+        control = response.cache_control
+        if self.caching and not control.no_store:
+            fresh_until = time.time() + (control.max_age or 0) if not control.no_cache else 0
+            self.cache[url] = (fresh_until, response.headers.get("ETag"))
+        return body
+
+    def visit(self, url):
+        page = self.fetch(url)
+        for asset in ASSET.findall(page):
+            self.fetch(asset.decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    # The app reads these while being imported
+    os.environ["SESSION_TYPE"] = "memory"
+    os.environ["EVENTS_BACKEND"] = "memory"
+    os.environ["FEED_CACHE_TYPE"] = "memory"
+    os.environ["RATE_LIMIT_BACKEND"] = "none"
+
+    import database
+    import hashing
+    from app import app
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project.db"), path)
+    database.configure(path)
+    app.config["DATABASE"] = path
+
+    password = "Commute#2024"
+    client = app.test_client()
+    client.post("/register", data=dict(username="rider", fullname="Rider", address="Sector 5", city="Mhow", bike="Pleasure", phone="9999999999", password=password, confirmation=password))
+    client.post("/login", data=dict(username="rider", password=password))
+
+    try:
+        for caching in (False, True):
+            browser = Browser(client, caching)
+            for _ in range(args.rounds):
+                for url in SESSION:
+                    browser.visit(url)
+            name = "policy" if caching else "no-store"
+            print(f"{name:<9} {browser.bytes / 1024:>10.1f} KB in {browser.requests:>4} requests, {browser.not_modified:>3} answered 304")
+    finally:
+        hashing.hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Fires simultaneous /invite and /create_pool submissions from many threads, then checks that every history row
+written points at the pool it describes, reporting throughput and SQL statements per submission. Then checks that an
+invite to a user who stopped being a friend after the friends page cached them is refused.
+
+Usage: python bench/bench_invites.py [--threads 16] [--submissions 50] [--friends 5]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import datagen
+
+
+# History rows whose pool has another creator, recipient or route than the row itself
+MISMATCHED_HISTORY = """SELECT COUNT(*) FROM history JOIN pools ON pools.id = history.pool_id
+                        WHERE history.id > ? AND (pools.creator != history.user_id OR pools.follower IS NOT history.recipient_id
+                                                  OR pools.origin_id != history.origin_id OR pools.destination_id != history.destination_id)"""
+
+
+def stale_friend_problem(app, database, rider, friend, username):
+    """Returns why inviting a friend after their friendship ended behind the friend cache's back went wrong, or None"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = rider
+    # The friends page caches the rider's friends, then the friendship ends as if on another worker
+    client.get("/friends").close()
+    database.execute(
+        "UPDATE requests SET status = 'rejected' WHERE (sender = ?1 AND receiver = ?2) OR (sender = ?2 AND receiver = ?1)", rider, friend,
+    )
+    last_pool = database.query_value("SELECT MAX(id) FROM pools")
+    response = client.post("/invite", data={"friend_username": [username], "origin": "Sector 5", "destination": "Stale Friend"})
+    stored = database.query_value("SELECT COUNT(*) FROM pools WHERE id > ?", last_pool)
+    database.release()
+    if response.status_code != 400 or stored:
+        return f"inviting a former friend answered {response.status_code} and stored {stored} pools"
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--submissions", type=int, default=50, help="submissions per thread, alternating invites and new pools")
+    parser.add_argument("--friends", type=int, default=5, help="friends invited by each invite")
+    args = parser.parse_args()
+
+    # The app reads these while being imported, queries are counted by its SQL instrumentation
+    os.environ.setdefault("SESSION_TYPE", "memory")
+    os.environ.setdefault("EVENTS_BACKEND", "memory")
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "none")
+    os.environ["SQL_INSTRUMENTATION"] = "on"
+    # Threads queueing for the write lock are expected here, not worth a slow-statement warning each
+    os.environ.setdefault("SQL_SLOW_SECONDS", "10")
+
+    import database
+    import hashing
+    import instrumentation
+    from app import app
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    datagen.generate(path, users=2000, pools=5000, requests=20000, history=5000)
+    database.configure(path)
+    app.config["DATABASE"] = path
+
+    # Riders with enough accepted friends to invite, each driven by its own thread
+    friends = {}
+    for sender, receiver in database.query("SELECT sender, receiver FROM requests WHERE status = 'accepted'"):
+        friends.setdefault(sender, []).append(receiver)
+        friends.setdefault(receiver, []).append(sender)
+    usernames = dict(database.query("SELECT id, username FROM users"))
+    riders = [rider for rider, known in friends.items() if len(known) >= args.friends][: args.threads]
+    last_history = database.query_value("SELECT MAX(id) FROM history")
+    last_pool = database.query_value("SELECT MAX(id) FROM pools")
+    database.release()
+
+    start_line = threading.Barrier(len(riders) + 1)
+    failures = []
+
+    def submit(rider, seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = rider
+        start_line.wait()
+        for number in range(args.submissions):
+            if number % 2:
+                response = client.post("/create_pool", data=dict(start="Sector 5", destination=f"Place {rider}-{number}"))
+            else:
+                invited = rng.sample(friends[rider], args.friends)
+                response = client.post(
+                    "/invite",
+                    data={"friend_username": [usernames[friend] for friend in invited], "origin": "Sector 5", "destination": f"Place {rider}-{number}"},
+                )
+            if response.status_code != 302:
+                failures.append(response.status_code)
+
+    threads = [threading.Thread(target=submit, args=(rider, seed)) for seed, rider in enumerate(riders)]
+    for thread in threads:
+        thread.start()
+    queries = instrumentation.metrics.queries()
+    start_line.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    queries = instrumentation.metrics.queries() - queries
+
+    submissions = len(riders) * args.submissions
+    pools = database.query_value("SELECT COUNT(*) FROM pools WHERE id > ?", last_pool)
+    history = database.query_value("SELECT COUNT(*) FROM history WHERE id > ?", last_history)
+    mismatched = database.query_value(MISMATCHED_HISTORY, last_history)
+    database.release()
+    stale = stale_friend_problem(app, database, riders[0], friends[riders[0]][0], usernames[friends[riders[0]][0]])
+    hashing.hasher.shutdown()
+
+    print(f"{submissions} submissions from {len(riders)} threads in {elapsed:.2f} s ({submissions / elapsed:.0f}/s), {queries / submissions:.1f} queries each")
+    print(f"{pools} pools, {history} history rows, {mismatched} pointing at the wrong pool, {len(failures)} failed submissions")
+    # Odd submissions create one pool, even ones one pool per invited friend
+    expected = len(riders) * (args.submissions // 2 + (args.submissions + 1) // 2 * args.friends)
+    if failures or mismatched or pools != history or pools != expected:
+        print(f"FAILED, expected {expected} pools with one history row each")
+        sys.exit(1)
+    if stale:
+        print(f"FAILED, {stale}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Load-tests password verification at log-in: many concurrent request threads hashing inline on the
+request thread against the bounded hashing process pool, reporting latency percentiles and rejections.
+
+Usage: python bench/bench_login.py [--clients 32] [--logins 256] [--method pbkdf2:sha256:600000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import hashing
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(name, verify, clients, logins):
+    """Runs 'logins' verifications spread over 'clients' threads and prints latency and rejection figures"""
+    latencies = []
+    rejected = 0
+    lock = threading.Lock()
+    per_client = logins // clients
+
+    def client():
+        nonlocal rejected
+        for _ in range(per_client):
+            start = time.perf_counter()
+            try:
+                assert verify()
+            except hashing.HashingBusy:
+                with lock:
+                    rejected += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = per_client * clients
+    print(
+        f"{name:<8} {len(latencies) / elapsed:>8.1f} logins/s"
+        f"  p50 {statistics.median(latencies) * 1e3:>8.1f} ms  p99 {percentile(latencies, 0.99) * 1e3:>8.1f} ms"
+        f"  rejected {rejected / total:>6.1%}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--logins", type=int, default=256)
+    parser.add_argument("--method", default=hashing.HASH_METHOD)
+    args = parser.parse_args()
+
+    password = "correct horse battery staple"
+    hash = generate_password_hash(password, args.method)
+
+    # Every thread hashes on its own, the way the app verified passwords before the pool
+    run("inline", lambda: check_password_hash(hash, password), args.clients, args.logins)
+
+    hashing.hasher.configure(args.method)
+    # Start the worker processes before timing
+    hashing.hasher.verify(hash, password)
+    try:
+        run("pool", lambda: hashing.hasher.verify(hash, password), args.clients, args.logins)
+    finally:
+        hashing.hasher.shutdown()
+
+
+if __name__ == "__main__":
+    main()
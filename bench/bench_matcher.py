@@ -0,0 +1,162 @@
+"""
+Times the ride matcher on a synthetic batch of ride requests and bike owners' pools crowded into a few hot
+localities, then checks its results: every match within the limits, nobody matched twice, the same output on a
+second run, and small groups matched as well as trying every pairing. Exits non-zero on a failed check or when
+the batch takes longer than the budget.
+
+Usage: python bench/bench_matcher.py [--requests 10000] [--offers 10000] [--budget 1.0] [--checks 300]
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import datagen
+import matcher
+from geo import haversine_km
+
+
+# Spread of trip ends around their gazetteer place, in degrees, about 600 m
+JITTER_DEGREES = 0.0055
+
+# Length of the batch's departure window, that of a pool's lifetime
+WINDOW_SECONDS = 2 * 60 * 60
+
+
+def synthetic_trips(count, first_pool_id, first_user_id, rng, places, weights):
+    """Returns Trips leaving from and heading to places in one city, picked with the given weights"""
+    by_city = {}
+    for place in places:
+        by_city.setdefault(place[1], []).append(place)
+    trips = []
+    for number, origin in enumerate(rng.choices(places, weights, k=count)):
+        destination = rng.choice(by_city[origin[1]])
+        trips.append(matcher.Trip(
+            first_pool_id + number,
+            first_user_id + number,
+            rng.uniform(0, WINDOW_SECONDS),
+            (origin[2] + rng.uniform(-JITTER_DEGREES, JITTER_DEGREES), origin[3] + rng.uniform(-JITTER_DEGREES, JITTER_DEGREES)),
+            (destination[2] + rng.uniform(-JITTER_DEGREES, JITTER_DEGREES), destination[3] + rng.uniform(-JITTER_DEGREES, JITTER_DEGREES)),
+        ))
+    return trips
+
+
+def batch(requests, offers, seed):
+    """Returns (requests, offers) of a seeded synthetic batch, requests and offers sharing hot localities"""
+    rng = random.Random(seed)
+    places = datagen.load_places()
+    rng.shuffle(places)
+    weights = datagen.zipf_weights(len(places))
+    return (
+        synthetic_trips(requests, 1, 1, rng, places, weights),
+        synthetic_trips(offers, requests + 1, requests + 1, rng, places, weights),
+    )
+
+
+def problems(matches):
+    """Returns descriptions of every match breaking the matcher's limits or reusing a rider or owner"""
+    found = []
+    riders, owners = set(), set()
+    for match in matches:
+        if match.request.user_id in riders or match.offer.user_id in owners:
+            found.append(f"pool {match.request.pool_id} or {match.offer.pool_id} matched twice")
+        riders.add(match.request.user_id)
+        owners.add(match.offer.user_id)
+        # The matcher measures on a plane, allow for its difference from the great circle
+        if haversine_km(*match.request.origin, *match.offer.origin) > matcher.ORIGIN_KM * 1.01:
+            found.append(f"pools {match.request.pool_id} and {match.offer.pool_id} start too far apart")
+        if haversine_km(*match.request.destination, *match.offer.destination) > matcher.DESTINATION_KM * 1.01:
+            found.append(f"pools {match.request.pool_id} and {match.offer.pool_id} end too far apart")
+        if abs(match.request.time - match.offer.time) > matcher.MAX_WAIT_SECONDS:
+            found.append(f"pools {match.request.pool_id} and {match.offer.pool_id} leave too far apart")
+    return found
+
+
+def best_by_trying_all(edges):
+    """Returns (pairs, cost) of the fullest, then cheapest, matching of a few edges, trying every subset of them"""
+    best = (0, 0.0)
+    for size in range(len(edges), 0, -1):
+        for chosen in itertools.combinations(edges, size):
+            if len({edge[1] for edge in chosen}) == size and len({edge[2] for edge in chosen}) == size:
+                cost = sum(edge[0] for edge in chosen)
+                if best[0] < size or cost < best[1]:
+                    best = (size, cost)
+        if best[0]:
+            return best
+    return best
+
+
+def check_optimal(checks, seed):
+    """Returns how many random small groups optimal() matched worse than trying every pairing"""
+    rng = random.Random(seed)
+    worse = 0
+    for _ in range(checks):
+        riders, owners = rng.randint(1, 5), rng.randint(1, 5)
+        edges = [
+            (round(rng.uniform(0, 10), 3), rider, owner, 0.0, 0.0, 0.0)
+            for rider in range(riders)
+            for owner in range(owners)
+            if rng.random() < 0.6
+        ][:10]
+        if not edges:
+            continue
+        taken = matcher.optimal(edges)
+        size, cost = best_by_trying_all(edges)
+        if len(taken) != size or sum(edge[0] for edge in taken) > cost + 1e-9 or problems_in_edges(taken):
+            worse += 1
+    return worse
+
+
+def problems_in_edges(edges):
+    """Returns whether a set of edges uses a rider or an owner twice"""
+    return len({edge[1] for edge in edges}) != len(edges) or len({edge[2] for edge in edges}) != len(edges)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=10000, help="riders without a bike asking for a ride")
+    parser.add_argument("--offers", type=int, default=10000, help="bike owners' pools")
+    parser.add_argument("--budget", type=float, default=1.0, help="seconds the batch may take")
+    parser.add_argument("--checks", type=int, default=300, help="small random groups compared with trying every pairing")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    requests, offers = batch(args.requests, args.offers, args.seed)
+    start = time.perf_counter()
+    edges = matcher.candidates(requests, offers)
+    found = time.perf_counter() - start
+    groups = matcher.groups(edges)
+    start = time.perf_counter()
+    matches = matcher.match(requests, offers)
+    elapsed = time.perf_counter() - start
+
+    optimal_groups = sum(1 for group in groups if max(len({edge[1] for edge in group}), len({edge[2] for edge in group})) <= matcher.OPTIMAL_SIZE)
+    print(f"{args.requests} requests and {args.offers} offers: {len(edges)} candidate pairs in {found:.3f} s")
+    print(f"{len(groups)} groups, {optimal_groups} matched optimally and {len(groups) - optimal_groups} greedily")
+    print(
+        f"{len(matches)} matches in {elapsed:.3f} s, mean cost {sum(match.cost for match in matches) / max(len(matches), 1):.2f}, "
+        f"mean pick-up distance {sum(match.origin_km for match in matches) / max(len(matches), 1):.2f} km"
+    )
+
+    failures = problems(matches)
+    if matcher.match(requests, offers) != matches:
+        failures.append("a second run matched differently")
+    worse = check_optimal(args.checks, args.seed)
+    if worse:
+        failures.append(f"{worse} of {args.checks} small groups matched worse than trying every pairing")
+    print(f"checked {len(matches)} matches and {args.checks} small groups, {len(failures)} problems")
+    for failure in failures[:20]:
+        print("  " + failure)
+    if elapsed > args.budget:
+        failures.append(f"the batch took {elapsed:.3f} s, more than the {args.budget} s budget")
+        print(f"FAILED, {failures[-1]}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Compares the compiled password policy with the nested-loop checks it replaced, after fuzzing both with
+random passwords to confirm they accept and reject the same ones. Then starts the app with a non-default
+PASSWORD_MIN_LENGTH and exits non-zero unless both register and change_password enforce it.
+
+Usage: python bench/bench_password_policy.py [--fuzz 100000] [--lengths 8 64 1024] [--checks 2000] [--min-length 12]
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import password_policy
+
+
+def legacy_check(password):
+    """The validation register() and change_password() used to run inline, quadratic in the password length"""
+    if len(password) < 8:
+        return "password must contain 8 characters"
+
+    for char in password:
+        has_upper = False
+        for char in password:
+            if char.isupper():
+                has_upper = True
+                break
+    if not has_upper:
+        return "password must contain at least one uppercase character"
+
+    for char in password:
+        has_lower = False
+        for char in password:
+            if char.islower():
+                has_lower = True
+                break
+    if not has_lower:
+        return "password must contain at least one lowercase character"
+
+    for char in password:
+        has_number = False
+        for char in password:
+            if char.isdigit():
+                has_number = True
+                break
+    if not has_number:
+        return "password must contain at least one number"
+
+    ALLOWED_SPECIAL_CHARS = set(["!", "@", "#", "$", "%", "^", "&", "*", "(", ")", "-", "_", "+", "=", "{", "}", "[", "]", "|", "\\", ";", ":", "'", '"', "<", ">", ",", ".", "?", "/"])
+    has_special = False
+    for char in password:
+        if char in ALLOWED_SPECIAL_CHARS:
+            has_special = True
+            break
+    if not has_special:
+        return "password must contain a special character"
+    return None
+
+
+# Characters the fuzzer draws from, including non-ASCII letters and digits and characters of no class
+ALPHABET = string.ascii_letters + string.digits + string.punctuation + " ~`" + "ÄéßΩж٣１ \t"
+
+
+def fuzz(policy, count, rng):
+    """Checks random passwords with both validators and fails on the first disagreement"""
+    for _ in range(count):
+        # Mostly short passwords around the length limit, where the rules interact
+        length = rng.choice((rng.randint(0, 12), rng.randint(0, 64)))
+        password = "".join(rng.choice(ALPHABET) for _ in range(length))
+        if password.lower() in policy.denylist:
+            continue
+        expected, actual = legacy_check(password), policy.check(password)
+        assert expected == actual, f"{password!r}: legacy {expected!r}, policy {actual!r}"
+    print(f"fuzz: {count:,} random passwords, both validators agree")
+
+
+def measure(policy, length, checks, rng):
+    # Valid passwords are the worst case for the old code, every rule runs to completion
+    body = "".join(rng.choice(string.ascii_lowercase) for _ in range(length - 3))
+    password = body + "A1!"
+    assert legacy_check(password) is None and policy.check(password) is None
+
+    timings = []
+    for check in (legacy_check, policy.check):
+        # Long passwords make the quadratic version slow, so it runs fewer times
+        runs = max(1, checks // max(1, length // 8) ** 2) if check is legacy_check else checks
+        start = time.perf_counter()
+        for _ in range(runs):
+            check(password)
+        timings.append((time.perf_counter() - start) / runs)
+    print(f"length {length:>6}  legacy {timings[0] * 1e6:>12.1f} us  policy {timings[1] * 1e6:>8.2f} us  {timings[0] / timings[1]:>10.0f}x")
+
+
+def settings_problems(min_length):
+    """Returns what register and change_password let through when PASSWORD_MIN_LENGTH is min_length"""
+    # The app reads these while being imported, and no background thread runs
+    os.environ.update(
+        PASSWORD_MIN_LENGTH=str(min_length), SESSION_TYPE="memory", FEED_CACHE_TYPE="none", EVENTS_BACKEND="memory",
+        RATE_LIMIT_BACKEND="none", SQL_INSTRUMENTATION="off", MATCH_INTERVAL="0", COMPACTION_INTERVAL="0",
+    )
+    import database
+    import migrations
+    import repository
+    from app import app
+
+    path = os.path.join(tempfile.mkdtemp(), "policy.db")
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.close()
+    database.configure(path)
+
+    # One character short of the configured length, and exactly long enough, both meeting every other rule
+    short, enough = "Aa1!" + "x" * (min_length - 5), "Aa1!" + "x" * (min_length - 4)
+    problems = []
+    client = app.test_client()
+
+    def register(username, password):
+        form = dict(username=username, fullname="Policy Check", password=password, confirmation=password,
+                    address="", city="Mhow", bike="", phone="")
+        return client.post("/register", data=form).status_code
+
+    if register("shortpassword", short) != 400:
+        problems.append(f"register accepted a {len(short)} character password")
+    if register("longpassword", enough) != 302:
+        problems.append(f"register refused a {len(enough)} character password")
+
+    user_id = repository.user_id("longpassword")
+    if user_id is not None:
+        with client.session_transaction() as session:
+            session["user_id"] = user_id
+        for password, expected in ((short, 400), (enough + "y", 302)):
+            form = dict(old_password=enough, new_password=password, confirmation=password)
+            status = client.post("/change_password", data=form).status_code
+            if status != expected:
+                problems.append(f"change_password answered {status} to a {len(password)} character password")
+    database.release()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=100000)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[8, 64, 1024])
+    parser.add_argument("--checks", type=int, default=2000)
+    parser.add_argument("--min-length", type=int, default=12, help="PASSWORD_MIN_LENGTH the app is started with")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    policy = password_policy.PasswordPolicy()
+    fuzz(policy, args.fuzz, rng)
+    for length in args.lengths:
+        measure(policy, length, args.checks, rng)
+
+    problems = settings_problems(args.min_length)
+    print(f"settings: PASSWORD_MIN_LENGTH={args.min_length}, {len(problems)} problems in register and change_password")
+    for problem in problems:
+        print(f"FAILED, {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Compares the interned place layout with the free-text one it replaced on the same synthetic data: file and
+per-table sizes, and the time of the nearby, invitation, history and route queries under each, checking both
+return the same rows.
+
+Usage: python bench/bench_places.py [--users 5000] [--pools 200000] [--history 200000] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import datagen
+import migrations
+import repository
+
+
+# The tables as they were before migration 13, with their indexes
+TEXT_SCHEMA = (
+    """CREATE TABLE users (
+           id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, username TEXT NOT NULL, fullname TEXT NOT NULL, hash TEXT NOT NULL,
+           address TEXT, city TEXT, bike TEXT, phone TEXT, latitude REAL, longitude REAL)""",
+    """CREATE TABLE pools (
+           id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, creator INTEGER NOT NULL, follower INTEGER,
+           origin TEXT NOT NULL, destination TEXT NOT NULL, time REAL NOT NULL,
+           origin_latitude REAL, origin_longitude REAL, destination_latitude REAL, destination_longitude REAL)""",
+    """CREATE TABLE history (
+           id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, pool_id INTEGER NOT NULL, recipient_id INTEGER,
+           origin TEXT NOT NULL, destination TEXT NOT NULL, date TEXT NOT NULL)""",
+    "CREATE UNIQUE INDEX users_username ON users (username)",
+    "CREATE INDEX pools_time ON pools (time)",
+    "CREATE INDEX pools_follower_time ON pools (follower, time)",
+    "CREATE INDEX pools_creator ON pools (creator)",
+    "CREATE INDEX history_user_id ON history (user_id, id)",
+    "CREATE INDEX history_user_date ON history (user_id, date)",
+)
+
+# The same rows written out as text, each pool and history row carrying its places' names
+TEXT_COPY = (
+    "INSERT INTO users SELECT id, username, fullname, hash, address, city, bike, phone, latitude, longitude FROM placed.users",
+    """INSERT INTO pools SELECT pools.id, pools.creator, pools.follower, origins.name, destinations.name, pools.time,
+                                origins.latitude, origins.longitude, destinations.latitude, destinations.longitude
+       FROM placed.pools AS pools
+       JOIN placed.places AS origins ON origins.id = pools.origin_id
+       JOIN placed.places AS destinations ON destinations.id = pools.destination_id""",
+    """INSERT INTO history SELECT history.id, history.user_id, history.pool_id, history.recipient_id, origins.name, destinations.name, history.date
+       FROM placed.history AS history
+       JOIN placed.places AS origins ON origins.id = history.origin_id
+       JOIN placed.places AS destinations ON destinations.id = history.destination_id""",
+)
+
+# The queries as the app issued them against the text layout
+TEXT_NEARBY_POOLS = """SELECT MIN(pools.id) AS id, users.username, users.fullname, users.bike, users.phone, pools.origin, pools.destination
+                       FROM pools
+                       JOIN users ON users.id = pools.creator
+                       JOIN users AS me ON me.address = users.address
+                       WHERE me.id = ? AND pools.creator != me.id AND pools.time > ?
+                       GROUP BY pools.origin, pools.destination
+                       ORDER BY id"""
+TEXT_INVITED_POOLS = """SELECT MIN(pools.id) AS id, users.username, users.fullname, users.bike, users.phone, pools.origin, pools.destination
+                        FROM pools
+                        JOIN users ON users.id = pools.creator
+                        WHERE pools.follower = ? AND pools.time > ?
+                        GROUP BY pools.origin, pools.destination
+                        ORDER BY id"""
+TEXT_HISTORY_PAGE = """SELECT history.id, history.origin, history.destination, history.date, recipients.fullname AS recipient
+                       FROM history LEFT JOIN users AS recipients ON recipients.id = history.recipient_id
+                       WHERE history.user_id = ? AND history.id < ?
+                       ORDER BY history.id DESC LIMIT ?"""
+
+# Busiest routes of one creator's city, the grouping a route report runs over every pool
+TEXT_ROUTES = """SELECT pools.origin, pools.destination, COUNT(*) AS pools FROM pools
+                 JOIN users ON users.id = pools.creator
+                 WHERE users.city = (SELECT city FROM users WHERE id = ?)
+                 GROUP BY pools.origin, pools.destination
+                 ORDER BY pools DESC, pools.origin, pools.destination LIMIT 10"""
+PLACED_ROUTES = """SELECT origins.name AS origin, destinations.name AS destination, routes.pools FROM (
+                       SELECT pools.origin_id, pools.destination_id, COUNT(*) AS pools FROM pools
+                       JOIN users ON users.id = pools.creator
+                       WHERE users.city = (SELECT city FROM users WHERE id = ?)
+                       GROUP BY pools.origin_id, pools.destination_id
+                   ) AS routes
+                   JOIN places AS origins ON origins.id = routes.origin_id
+                   JOIN places AS destinations ON destinations.id = routes.destination_id
+                   ORDER BY routes.pools DESC, origins.name, destinations.name LIMIT 10"""
+
+
+def table_sizes(conn):
+    """Returns {table: bytes} counting each table's pages together with those of its indexes"""
+    owners = dict(conn.execute("SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')"))
+    sizes = {}
+    for name, size in conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name"):
+        table = owners.get(name, name)
+        sizes[table] = sizes.get(table, 0) + size
+    return sizes
+
+
+def timed(conn, sql, params):
+    """Returns (mean milliseconds, rows of every call) running the query once per parameter tuple"""
+    results = []
+    start = time.perf_counter()
+    for values in params:
+        results.append(conn.execute(sql, values).fetchall())
+    return (time.perf_counter() - start) * 1e3 / len(params), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--pools", type=int, default=200000)
+    parser.add_argument("--history", type=int, default=200000)
+    parser.add_argument("--lookups", type=int, default=2000, help="users each query is run for")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    placed_path, text_path = os.path.join(folder, "placed.db"), os.path.join(folder, "text.db")
+    datagen.generate(placed_path, users=args.users, pools=args.pools, requests=args.users * 4, history=args.history, seed=args.seed)
+    conn = migrations.connect(text_path)
+    conn.execute("ATTACH DATABASE ? AS placed", (placed_path,))
+    conn.execute("BEGIN")
+    for statement in TEXT_SCHEMA + TEXT_COPY:
+        conn.execute(statement)
+    conn.execute("COMMIT")
+    conn.execute("DETACH DATABASE placed")
+    conn.execute("VACUUM")
+    placed = migrations.connect(placed_path)
+    placed.execute("VACUUM")
+
+    # Only the tables the two layouts store differently
+    text_sizes, placed_sizes = table_sizes(conn), table_sizes(placed)
+    print(f"{args.users} users, {args.pools} pools, {args.history} history rows, {placed.execute('SELECT COUNT(*) FROM places').fetchone()[0]} places")
+    print(f"{'table':<10} {'text KiB':>10} {'placed KiB':>11} {'change':>8}")
+    text_total = placed_total = 0
+    for table in ("users", "pools", "history", "places"):
+        before, after = text_sizes.get(table, 0), placed_sizes.get(table, 0)
+        text_total += before
+        placed_total += after
+        change = f"{(after - before) / before:+.0%}" if before else ""
+        print(f"{table:<10} {before / 1024:>10.0f} {after / 1024:>11.0f} {change:>8}")
+    print(f"{'total':<10} {text_total / 1024:>10.0f} {placed_total / 1024:>11.0f} {(placed_total - text_total) / text_total:>+8.0%}")
+
+    rng = random.Random(args.seed)
+    users = rng.choices(range(1, args.users + 1), k=args.lookups)
+    cutoff = time.time() - 2 * 60 * 60
+    queries = (
+        ("nearby pools", TEXT_NEARBY_POOLS, repository.NEARBY_POOLS, [(user, cutoff) for user in users]),
+        ("invited pools", TEXT_INVITED_POOLS, repository.INVITED_POOLS, [(user, cutoff) for user in users]),
+        ("history page", TEXT_HISTORY_PAGE, repository.HISTORY_PAGE, [(user, repository.FIRST_PAGE, 25) for user in users]),
+        ("city routes", TEXT_ROUTES, PLACED_ROUTES, [(user,) for user in users[: max(1, args.lookups // 20)]]),
+    )
+    print(f"{'query':<14} {'text ms':>9} {'placed ms':>10} {'speedup':>8}  same rows")
+    different = 0
+    for name, text_sql, placed_sql, params in queries:
+        text_ms, text_rows = timed(conn, text_sql, params)
+        placed_ms, placed_rows = timed(placed, placed_sql, params)
+        same = sum(1 for before, after in zip(text_rows, placed_rows) if before == after)
+        different += len(params) - same
+        print(f"{name:<14} {text_ms:>9.3f} {placed_ms:>10.3f} {text_ms / placed_ms:>7.1f}x  {same}/{len(params)}")
+    conn.close()
+    placed.close()
+    if different:
+        print(f"FAILED, {different} calls returned different rows")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
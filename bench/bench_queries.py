@@ -0,0 +1,137 @@
+"""
+Counts the SQL statements the homepage, friends page and history page run for their busiest riders, on a small and a
+ten times larger synthetic database. Exits non-zero when a page runs more statements than its fixed budget on either
+database or runs one statement more than SQL_REPEAT_LIMIT times in a request, the signs of an N+1 query creeping back
+in.
+
+Usage: python bench/bench_queries.py [--users 2000] [--pools 2000] [--scale 10] [--riders 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import datagen
+
+
+ROUTES = ("/", "/friends", "/history")
+
+# Statements each page may run however many pools, friends or rides it lists. The homepage reads the rider's matches,
+# location, nearby pools and invitations, and when each list expires
+BUDGETS = {"/": 6, "/friends": 3, "/history": 1}
+
+# Riders with the most of what each page lists, where a per-row query would cost the most
+BUSIEST = {
+    "/": """SELECT users.id FROM users JOIN pools ON pools.city_id = users.city_id
+            WHERE pools.time > strftime('%s', 'now') - 7200
+            GROUP BY users.id ORDER BY COUNT(*) DESC LIMIT ?""",
+    "/friends": """SELECT id FROM (SELECT sender AS id FROM requests UNION ALL SELECT receiver FROM requests)
+                   GROUP BY id ORDER BY COUNT(*) DESC LIMIT ?""",
+    "/history": "SELECT user_id FROM history GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT ?",
+}
+
+
+class StatementLog:
+    """Database observer keeping the statements run by this thread since the last reset"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __call__(self, sql, seconds):
+        statements = getattr(self._local, "statements", None)
+        if statements is not None:
+            statements.append(sql)
+
+    def reset(self):
+        self._local.statements = []
+
+    def take(self):
+        statements, self._local.statements = self._local.statements, None
+        return statements
+
+
+def count(app, log, path, routes, riders):
+    """Returns {route: (most statements in a request, most runs of one statement in a request)} over the riders"""
+    import database
+    import geo
+    import scoring
+
+    database.configure(path)
+    geo.indexes.clear()
+    scoring.engines.clear()
+    found = {}
+    for route in routes:
+        most = repeats = 0
+        user_ids = database.column(BUSIEST[route], riders)
+        database.release()
+        for user_id in user_ids:
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+            # The first request may load the rider's city into this worker, only the steady state is counted
+            client.get(route).close()
+            log.reset()
+            response = client.get(route)
+            statements = log.take()
+            response.close()
+            if response.status_code != 200:
+                raise SystemExit(f"FAILED, {route} answered {response.status_code} for user {user_id}")
+            most = max(most, len(statements))
+            repeats = max(repeats, max(Counter(statements).values(), default=0))
+        found[route] = (most, repeats)
+    database.release()
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--pools", type=int, default=2000, help="pools, friend requests and history rows in the small database")
+    parser.add_argument("--scale", type=int, default=10, help="how many times more rows the large database holds")
+    parser.add_argument("--riders", type=int, default=20, help="busiest riders requesting each page")
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    args = parser.parse_args()
+
+    # The app reads these while being imported, sessions and feeds stay in memory so only the pages' own statements
+    # are counted, and no background thread runs
+    os.environ.update(
+        SESSION_TYPE="memory", FEED_CACHE_TYPE="none", EVENTS_BACKEND="memory", RATE_LIMIT_BACKEND="none",
+        SQL_INSTRUMENTATION="off", MATCH_INTERVAL="0", COMPACTION_INTERVAL="0",
+    )
+    import database
+    from app import app
+
+    log = StatementLog()
+    database.observer = log
+
+    folder = tempfile.mkdtemp()
+    results = []
+    for size in (args.pools, args.pools * args.scale):
+        path = os.path.join(folder, f"queries{size}.db")
+        datagen.generate(path, users=args.users, pools=size, requests=size, history=size)
+        results.append((size, count(app, log, path, args.routes, args.riders)))
+
+    failures = []
+    limit = app.config["SQL_REPEAT_LIMIT"]
+    print(f"statements per request for the {args.riders} busiest riders of each page, {args.users} riders")
+    print(f"{'route':<10} {'budget':>7} " + " ".join(f"{f'{size} rows':>12} {'repeats':>8}" for size, found in results))
+    for route in args.routes:
+        print(f"{route:<10} {BUDGETS[route]:>7} " + " ".join(f"{found[route][0]:>12} {found[route][1]:>8}" for size, found in results))
+        for size, found in results:
+            if found[route][0] > BUDGETS[route]:
+                failures.append(f"{route} ran {found[route][0]} statements with {size} rows, over its budget of {BUDGETS[route]}")
+            if found[route][1] > limit:
+                failures.append(f"{route} ran one statement {found[route][1]} times in a request with {size} rows")
+
+    for failure in failures:
+        print(f"FAILED, {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Times rate-limit checks on the memory and SQLite token buckets against a per-check budget, then checks the buckets:
+a full bucket allows its burst and then reports the wait until its next token, and several processes drawing from
+one SQLite bucket at once are allowed no more than its burst plus its refill. Exits non-zero on a failed check or
+when a check takes longer than the budget.
+
+Usage: python bench/bench_ratelimit.py [--checks 20000] [--users 5000] [--processes 4] [--seconds 2] [--budget 100]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import migrations
+import ratelimit
+
+
+# Bucket shared by the processes of the cross-worker check
+SHARED_KEY = "create_pool:ip:192.168.0.1"
+SHARED_LIMIT = ratelimit.Limit(50, 600)
+
+
+def percentile(ordered, fraction):
+    """Returns the value below which the given fraction of a sorted list falls"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def timed_checks(limiter, checks, users, rng):
+    """Returns the sorted microseconds of each check, users submitting pools from a handful of addresses"""
+    addresses = [f"10.0.{number // 256}.{number % 256}" for number in range(max(1, users // 50))]
+    submissions = [(rng.randint(1, users), rng.choice(addresses)) for _ in range(checks)]
+    timings = []
+    for user_id, address in submissions:
+        start = time.perf_counter()
+        limiter.check("create_pool", user_id, address)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return timings
+
+
+def bucket_problems(backend):
+    """Returns descriptions of every way a fresh bucket of 5 tokens refilling one a second misbehaves"""
+    found = []
+    waits = [backend.take("check:user:1", 5, 1.0, 1000.0) for _ in range(6)]
+    if waits[:5] != [0] * 5:
+        found.append(f"a full bucket refused part of its burst: {waits[:5]}")
+    if abs(waits[5] - 1.0) > 1e-6:
+        found.append(f"an empty bucket asked to wait {waits[5]:.3f} s instead of 1 s")
+    wait = backend.take("check:user:1", 5, 1.0, 1000.5)
+    if abs(wait - 0.5) > 1e-6:
+        found.append(f"half a second later the wait was {wait:.3f} s instead of 0.5 s")
+    if backend.take("check:user:1", 5, 1.0, 1001.0) != 0:
+        found.append("the bucket had no token a second after emptying")
+    if backend.take("check:user:2", 5, 1.0, 1001.0) != 0:
+        found.append("emptying one bucket emptied another")
+    return found
+
+
+def drain(path, seconds, start, allowed):
+    """Takes tokens from the shared bucket until the deadline, adding the number allowed to the shared counter"""
+    database.configure(path)
+    backend = ratelimit.SQLiteBackend()
+    count = 0
+    while time.time() < start:
+        time.sleep(0.001)
+    while time.time() < start + seconds:
+        if backend.take(SHARED_KEY, SHARED_LIMIT.burst, SHARED_LIMIT.per_minute / 60, time.time()) == 0:
+            count += 1
+    with allowed.get_lock():
+        allowed.value += count
+    database.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--checks", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--processes", type=int, default=4, help="processes sharing one bucket")
+    parser.add_argument("--seconds", type=float, default=2.0, help="how long the processes draw from it")
+    parser.add_argument("--budget", type=float, default=100.0, help="mean microseconds allowed per check")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "ratelimit.db")
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.close()
+    database.configure(path)
+
+    failures = []
+    print(f"{args.checks} pool submissions from {args.users} users, two buckets each")
+    print(f"{'backend':<8} {'mean us':>8} {'p50 us':>8} {'p99 us':>8} {'buckets':>8}")
+    for name, backend in (("memory", ratelimit.MemoryBackend()), ("sqlite", ratelimit.SQLiteBackend())):
+        timings = timed_checks(ratelimit.RateLimiter(backend), args.checks, args.users, random.Random(args.seed))
+        mean = sum(timings) / len(timings)
+        print(f"{name:<8} {mean:>8.1f} {percentile(timings, 0.5):>8.1f} {percentile(timings, 0.99):>8.1f} {len(backend):>8}")
+        if mean > args.budget:
+            failures.append(f"{name} checks took {mean:.1f} us, over the {args.budget:.0f} us budget")
+        failures.extend(f"{name}: {problem}" for problem in bucket_problems(backend))
+    database.release()
+
+    # Every process draws as fast as it can, the bucket must hand out its burst and refill once between them all
+    # Spawned rather than forked, so no process inherits another's SQLite connections
+    context = multiprocessing.get_context("spawn")
+    allowed = context.Value("i", 0)
+    start = time.time() + 2.0
+    workers = [context.Process(target=drain, args=(path, args.seconds, start, allowed)) for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    limit = SHARED_LIMIT.burst + SHARED_LIMIT.per_minute / 60 * args.seconds
+    print(f"{args.processes} processes allowed {allowed.value} requests from one bucket in {args.seconds:.1f} s, limit {limit:.0f}")
+    if not limit - 2 <= allowed.value <= limit + 1:
+        failures.append(f"the shared bucket allowed {allowed.value} requests instead of {limit:.0f}")
+
+    for failure in failures:
+        print(f"FAILED, {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
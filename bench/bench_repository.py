@@ -0,0 +1,65 @@
+"""
+Compares per-query overhead of the cs50 SQL wrapper with the pooled repository layer.
+
+Usage: python bench/bench_repository.py [--queries 20000] [--users 1000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import migrations
+import repository
+
+
+def seed(path, users):
+    """Creates a database at the current schema holding 'users' rows"""
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.executemany(
+        "INSERT INTO users (username, fullname, hash, address, city, bike, phone) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((f"user{i}", f"User {i}", "hash", f"Address {i % 50}", "Mhow", "Pleasure", "NOT AVAILABLE") for i in range(users)),
+    )
+    conn.close()
+
+
+def measure(label, lookup, queries, users):
+    """Runs 'queries' lookups by username and prints the per-query cost"""
+    start = time.perf_counter()
+    for i in range(queries):
+        lookup(f"user{i % users}")
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {queries / elapsed:>12,.0f} queries/s {elapsed / queries * 1e6:>10.1f} us/query")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    seed(path, args.users)
+
+    database.configure(path)
+    pooled = measure("repository", repository.user_by_username, args.queries, args.users)
+    database.release()
+
+    try:
+        from cs50 import SQL
+    except ImportError:
+        print("cs50 is not installed, skipping the baseline")
+        return
+
+    db = SQL("sqlite:///" + path)
+    wrapped = measure("cs50.SQL", lambda username: db.execute("SELECT * FROM users WHERE username = ?", username), args.queries, args.users)
+    print(f"speedup      {wrapped / pooled:>12.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Drives every route of the app through Flask's test client from several worker processes against a synthetic
+database, reporting throughput, p50/p95/p99 latency and SQL statements per request for each route.
+
+Usage: python bench/bench_routes.py [--db FILE] [--workers 4] [--requests 200] [--login-requests 20] [--save FILE] [--compare FILE]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import datagen
+
+
+# Routes in the order they are measured, each run by every worker at once
+ROUTES = ("GET /", "GET /friends", "GET /invite", "GET /history", "GET /stats", "POST /create_pool", "POST /add_friend", "POST /login")
+
+# A route regresses when its p95 latency or queries per request grow by more than this fraction of the baseline
+THRESHOLD = 0.2
+
+
+def percentile(ordered, fraction):
+    """Returns the value below which the given fraction of a sorted list falls"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Worker:
+    """One process's app and test clients"""
+
+    def __init__(self, path, seed):
+        # The app reads its settings while being imported, queries are counted by its SQL instrumentation
+        os.environ["SQL_INSTRUMENTATION"] = "on"
+        import database
+        import instrumentation
+        import ratelimit
+        from app import app
+
+        database.configure(path)
+        # Every request comes from one address, limits far above the load keep the cost of the shared token buckets in
+        # the measurement without turning requests away
+        ratelimit.limiter.limits = {
+            endpoint: {scope: ratelimit.Limit(10 ** 9, 10 ** 9) for scope in scopes} for endpoint, scopes in ratelimit.LIMITS.items()
+        }
+        app.config["DATABASE"] = path
+        self.app = app
+        self.metrics = instrumentation.metrics
+        self.rng = random.Random(seed)
+
+        # Riders and the places their pools may go to
+        self.riders = database.query("SELECT id, username, address, city FROM users")
+        database.release()
+        self.places = {}
+        for name, city, latitude, longitude in datagen.load_places():
+            self.places.setdefault(city, []).append(name)
+        self.clients = {}
+
+    def client(self, rider):
+        """Returns a test client logged in as the rider"""
+        client = self.clients.get(rider.id)
+        if client is None:
+            client = self.clients[rider.id] = self.app.test_client()
+            with client.session_transaction() as session:
+                session["user_id"] = rider.id
+        return client
+
+    def request(self, route):
+        """Sends one request to the route as a random rider and returns whether it succeeded"""
+        rider = self.rng.choice(self.riders)
+        method, path = route.split(" ")
+        if route == "POST /login":
+            response = self.app.test_client().post(path, data=dict(username=rider.username, password=datagen.PASSWORD))
+        elif route == "POST /create_pool":
+            destination = self.rng.choice(self.places.get(rider.city) or [rider.address])
+            response = self.client(rider).post(path, data=dict(start=rider.address, destination=destination))
+        elif route == "POST /add_friend":
+            response = self.client(rider).post(path, data=dict(friend_username=self.rng.choice(self.riders).username))
+        else:
+            response = self.client(rider).get(path)
+        response.close()
+        return response.status_code < 400
+
+    def run(self, route, count):
+        """Sends count requests to the route and returns their latencies, failures and query total"""
+        queries = self.metrics.queries()
+        latencies = []
+        failures = 0
+        for _ in range(count):
+            start = time.perf_counter()
+            if not self.request(route):
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+        return latencies, failures, self.metrics.queries() - queries
+
+
+def work(path, seed, plan, barrier, results):
+    """Runs each route of the plan in step with the other workers, reporting to the results queue"""
+    worker = Worker(path, seed)
+    try:
+        for route, count, warmup in plan:
+            worker.run(route, warmup)
+            barrier.wait()
+            results.put((route, worker.run(route, count)))
+            barrier.wait()
+    finally:
+        import hashing
+
+        hashing.hasher.shutdown()
+
+
+def measure(path, workers, plan):
+    """Returns per-route statistics of the plan run by the given number of worker processes"""
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers + 1)
+    results = context.Queue()
+    processes = [context.Process(target=work, args=(path, seed, plan, barrier, results)) for seed in range(workers)]
+    for process in processes:
+        process.start()
+
+    report = {}
+    try:
+        for route, count, warmup in plan:
+            # Start the clock once every worker has warmed up and stop it once the last one is done
+            barrier.wait(timeout=600)
+            start = time.perf_counter()
+            barrier.wait(timeout=600)
+            elapsed = time.perf_counter() - start
+
+            latencies, failures, queries = [], 0, 0
+            for _ in range(workers):
+                route_latencies, route_failures, route_queries = results.get()[1]
+                latencies.extend(route_latencies)
+                failures += route_failures
+                queries += route_queries
+            latencies.sort()
+            report[route] = {
+                "requests": len(latencies),
+                "failures": failures,
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1e3,
+                "p95_ms": percentile(latencies, 0.95) * 1e3,
+                "p99_ms": percentile(latencies, 0.99) * 1e3,
+                "queries": queries / len(latencies),
+            }
+    finally:
+        for process in processes:
+            process.join(timeout=60)
+            if process.is_alive():
+                process.terminate()
+    return report
+
+
+def compare(report, baseline, threshold):
+    """Prints each route's change against the baseline and returns the routes that regressed"""
+    regressions = []
+    print(f"\n{'route':<18} {'p95 ms':>9} {'change':>8} {'queries':>8} {'change':>8}")
+    for route, stats in report.items():
+        before = baseline.get(route)
+        if before is None:
+            continue
+        latency_change = stats["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        query_change = stats["queries"] / before["queries"] - 1 if before["queries"] else 0.0
+        flag = ""
+        if latency_change > threshold or query_change > threshold:
+            regressions.append(route)
+            flag = "  REGRESSED"
+        print(f"{route:<18} {stats['p95_ms']:>9.2f} {latency_change:>+8.0%} {stats['queries']:>8.1f} {query_change:>+8.0%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", help="database to copy and run against, generated with datagen.py when left out")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--pools", type=int, default=50000)
+    parser.add_argument("--friend-requests", type=int, default=20000)
+    parser.add_argument("--history", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200, help="requests per worker and route")
+    parser.add_argument("--login-requests", type=int, default=20, help="requests per worker to the deliberately slow /login")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per worker before each route")
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=ROUTES)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="compare against a JSON baseline and exit non-zero on regressions")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    # Work on a copy, since the POST routes write to the database
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    if args.db:
+        shutil.copy(args.db, path)
+    else:
+        start = time.perf_counter()
+        datagen.generate(path, args.users, args.pools, args.friend_requests, args.history)
+        print(f"generated {args.users} users, {args.pools} pools, {args.friend_requests} friend requests and {args.history} history rows in {time.perf_counter() - start:.1f} s")
+
+    plan = [(route, args.login_requests if route == "POST /login" else args.requests, args.warmup) for route in args.routes]
+    report = measure(path, args.workers, plan)
+
+    print(f"\n{args.workers} workers")
+    print(f"{'route':<18} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8} {'failed':>7}")
+    for route, stats in report.items():
+        print(
+            f"{route:<18} {stats['throughput']:>9.1f} {stats['p50_ms']:>9.2f} {stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['queries']:>8.1f} {stats['failures']:>7}"
+        )
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"workers": args.workers, "routes": report}, file, indent=2)
+        print(f"\nsaved baseline to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline["routes"], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} routes regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
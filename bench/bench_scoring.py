@@ -0,0 +1,57 @@
+"""
+Measures route-similarity scoring throughput, in pools scored per second, at increasing numbers of live pools.
+
+Usage: python bench/bench_scoring.py [--sizes 10000 100000 1000000] [--trips 200]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import scoring
+
+
+Pool = namedtuple("Pool", "id creator follower time origin_latitude origin_longitude destination_latitude destination_longitude")
+
+# Spread pools over a 40 km square around Indore
+CENTER = (22.7196, 75.8577)
+SPREAD = 0.18
+
+
+def random_point(rng):
+    return CENTER[0] + rng.uniform(-SPREAD, SPREAD), CENTER[1] + rng.uniform(-SPREAD, SPREAD)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--trips", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    now = time.time()
+    print(f"{'pools':>10} {'load s':>8} {'ms/trip':>9} {'scores/s':>14}")
+    for size in args.sizes:
+        engine = scoring.RouteScorer()
+        start = time.perf_counter()
+        engine.add_many(
+            Pool(pool_id, pool_id, None, now - rng.uniform(0, scoring.LIFETIME_SECONDS), *random_point(rng), *random_point(rng))
+            for pool_id in range(1, size + 1)
+        )
+        load_time = time.perf_counter() - start
+
+        trips = [(random_point(rng), random_point(rng)) for _ in range(args.trips)]
+        start = time.perf_counter()
+        for origin, destination in trips:
+            engine.score(0, origin, destination, now)
+        elapsed = time.perf_counter() - start
+
+        print(f"{size:>10,} {load_time:>8.2f} {elapsed / args.trips * 1e3:>9.2f} {size * args.trips / elapsed:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
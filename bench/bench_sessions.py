@@ -0,0 +1,183 @@
+"""
+Measures session lookup latency of each session backend, the work done before every logged-in request, and the SQL
+statements each lookup runs. Then checks that each server-side backend issues a new session id when a user logs in
+and forgets it when they log out, and that a session logged out in one worker leaves another worker's session cache
+once the event relay hands the logout over. Exits non-zero when a check fails.
+
+Usage: python bench/bench_sessions.py [--sessions 10000] [--lookups 20000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask
+
+import database
+import events
+import migrations
+import sessions
+
+
+def make_app(backend, **config):
+    app = Flask(__name__)
+    app.secret_key = "bench"
+    app.config["SESSION_TYPE"] = backend
+    app.config["SESSION_SWEEP_INTERVAL"] = 3600
+    app.config.update(config)
+    sessions.init_app(app)
+    return app
+
+
+def login_cookies(app, count):
+    """Creates 'count' logged-in sessions and returns their cookie values"""
+    cookies = []
+    interface = app.session_interface
+    for user_id in range(count):
+        with app.test_request_context("/"):
+            session = interface.open_session(app, app.request_class({}))
+            session["user_id"] = user_id
+            response = app.response_class()
+            interface.save_session(app, session, response)
+            cookies.append(response.headers["Set-Cookie"].split(";")[0].split("=", 1)[1])
+    return cookies
+
+
+def cookie_sid(app, response):
+    """Returns the session id the response's cookie carries, or None when it sets none or deletes it"""
+    for header in response.headers.getlist("Set-Cookie"):
+        name, value = header.split(";")[0].split("=", 1)
+        if name == app.config["SESSION_COOKIE_NAME"] and value:
+            return value
+    return None
+
+
+def request_with(app, cookie, change):
+    """Opens the session of the cookie, applies change(session) and returns the response saving it"""
+    interface = app.session_interface
+    environ = {"HTTP_COOKIE": f"{app.config['SESSION_COOKIE_NAME']}={cookie}"} if cookie else {}
+    with app.test_request_context("/", environ_base=environ):
+        session = interface.open_session(app, app.request_class(environ))
+        change(session)
+        response = app.response_class()
+        interface.save_session(app, session, response)
+        return response
+
+
+def fixation_problems(backend):
+    """Returns descriptions of every way logging in or out leaves a session id usable by someone else"""
+    app = make_app(backend)
+    found = []
+
+    def log_in(session):
+        session.clear()
+        session["user_id"] = 1
+
+    # An attacker's anonymous session, planted in the victim's browser before they log in
+    planted = cookie_sid(app, request_with(app, None, lambda session: session.update(_flashes=[("message", "hello")])))
+    logged_in = cookie_sid(app, request_with(app, planted, log_in))
+    if logged_in is None or logged_in == planted:
+        found.append("logging in kept the session id the browser arrived with")
+    attacker = request_with(app, planted, lambda session: found.append(f"the planted id resolved to user {session['user_id']}") if "user_id" in session else None)
+    if cookie_sid(app, attacker) == planted:
+        found.append("the planted id was saved again after logging in")
+
+    # Logging out must leave nothing behind for the logged-in id
+    request_with(app, logged_in, lambda session: session.clear())
+    request_with(app, logged_in, lambda session: found.append("the session outlived logging out") if session else None)
+    database.release()
+    if "session_sweeper" in app.extensions:
+        app.extensions["session_sweeper"].stop()
+    return found
+
+
+def measure(backend, count, lookups, rng, **config):
+    app = make_app(backend, **config)
+    cookies = login_cookies(app, count)
+    database.release()
+    name = app.config["SESSION_COOKIE_NAME"]
+    interface = app.session_interface
+    environs = [{"HTTP_COOKIE": f"{name}={rng.choice(cookies)}"} for _ in range(lookups)]
+
+    statements = []
+    database.observer = lambda sql, seconds: statements.append(sql)
+    start = time.perf_counter()
+    for environ in environs:
+        session = interface.open_session(app, app.request_class(environ))
+        assert session.get("user_id") is not None
+    elapsed = time.perf_counter() - start
+    database.observer = None
+    database.release()
+    if "session_sweeper" in app.extensions:
+        app.extensions["session_sweeper"].stop()
+    print(f"{backend:<8} {elapsed / lookups * 1e6:>10.1f} us/lookup {lookups / elapsed:>12,.0f} lookups/s {len(statements) / lookups:>6.2f} queries/lookup")
+
+
+def relay_problems(wait=2.0):
+    """Returns what went wrong when a session cached by one worker is logged out in another, the two workers sharing
+    the database and the event relay"""
+    # The second app's store is the one the relay hands deleted sessions to, as it would be in its own worker
+    first, second = make_app("sqlite"), make_app("sqlite", SESSION_CACHE_SECONDS=60)
+    events.bus.shared = True
+    relay = events.Relay(events.bus, interval=0.05)
+    relay.start()
+    found = []
+    try:
+        cookie = cookie_sid(first, request_with(first, None, lambda session: session.update(user_id=1)))
+        request_with(second, cookie, lambda session: None)
+        statements = []
+        database.observer = lambda sql, seconds: statements.append(sql)
+        request_with(second, cookie, lambda session: None if session.get("user_id") == 1 else found.append("the cached session lost its user"))
+        database.observer = None
+        if statements:
+            found.append(f"reading a cached session ran {len(statements)} statements")
+
+        request_with(first, cookie, lambda session: session.clear())
+        deadline = time.monotonic() + wait
+        alive = [True]
+        while alive[0] and time.monotonic() < deadline:
+            time.sleep(0.05)
+            request_with(second, cookie, lambda session: alive.__setitem__(0, bool(session)))
+        if alive[0]:
+            found.append(f"another worker still served the session {wait:.0f} s after logging out")
+    finally:
+        database.observer = None
+        relay.stop()
+        relay.join()
+        events.bus.shared = False
+        database.release()
+        for app in (first, second):
+            app.extensions["session_sweeper"].stop()
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.close()
+    database.configure(path)
+
+    rng = random.Random(42)
+    for backend in ("cookie", "memory", "sqlite"):
+        measure(backend, args.sessions, args.lookups, rng)
+
+    failures = [f"{backend}: {problem}" for backend in ("memory", "sqlite") for problem in fixation_problems(backend)]
+    failures += [f"sqlite: {problem}" for problem in relay_problems()]
+    for failure in failures:
+        print(f"FAILED, {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Times the /stats reads, the busiest routes of a city and its hour-of-week heatmap, from the route rollups and from a
+scan over every live and archived pool as the pool count grows, and the rollup upkeep added to each new pool. Then
+recounts the rollups from scratch and checks they match what the incremental updates left. Exits non-zero when they
+differ.
+
+Usage: python bench/bench_stats.py [--pools 20000 100000 400000] [--users 5000] [--archived 0.5] [--creates 500] [--lookups 200]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import datagen
+import repository
+import stats
+
+
+# What the /stats page would read without the rollups
+SCAN_TOP_ROUTES = """SELECT origin_id, destination_id, COUNT(*) AS pools
+                     FROM (SELECT city_id, origin_id, destination_id FROM pools
+                           UNION ALL
+                           SELECT city_id, origin_id, destination_id FROM pools_archive)
+                     WHERE city_id = ?
+                     GROUP BY origin_id, destination_id
+                     ORDER BY pools DESC
+                     LIMIT ?"""
+SCAN_CITY_HOURS = f"""SELECT {repository._HOUR_OF_WEEK} AS hour, COUNT(*)
+                      FROM (SELECT city_id, time FROM pools UNION ALL SELECT city_id, time FROM pools_archive) AS pools
+                      WHERE city_id = ?
+                      GROUP BY hour"""
+
+ROLLUPS = ("route_hours", "route_totals", "city_hours")
+
+
+def mean_ms(function, arguments):
+    """Returns the mean milliseconds of calling the function once with each tuple of arguments"""
+    start = time.perf_counter()
+    for each in arguments:
+        function(*each)
+    return (time.perf_counter() - start) * 1e3 / len(arguments)
+
+
+def create_pools(creators, rng, count, with_rollups):
+    """Creates pools as the app does and returns the mean milliseconds, counting them in the rollups or not"""
+    count_routes = repository.count_routes
+    if not with_rollups:
+        repository.count_routes = lambda first_pool_id, last_pool_id: None
+    try:
+        timings = []
+        for _ in range(count):
+            creator, city_id, place_ids = rng.choice(creators)
+            origin_id, destination_id = rng.sample(place_ids, 2)
+            start = time.perf_counter()
+            repository.create_pool(creator, city_id, origin_id, destination_id, time.time(), datetime.now().strftime("%Y-%m-%d"))
+            timings.append((time.perf_counter() - start) * 1e3)
+    finally:
+        repository.count_routes = count_routes
+    return sum(timings) / len(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pools", type=int, nargs="+", default=[20000, 100000, 400000])
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--archived", type=float, default=0.5, help="fraction of the pools moved to the archive")
+    parser.add_argument("--creates", type=int, default=500, help="pools created with and without rollup upkeep")
+    parser.add_argument("--lookups", type=int, default=200, help="stats pages read")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    print(f"{args.users} riders, {args.archived:.0%} of pools archived, means in ms")
+    print(f"{'pools':>8} {'scan read':>10} {'rollup read':>12} {'create':>8} {'+ rollups':>10} {'recount s':>10}  differing rows")
+    different = 0
+    for pools in args.pools:
+        rng = random.Random(args.seed)
+        path = os.path.join(folder, f"stats{pools}.db")
+        datagen.generate(path, users=args.users, pools=pools, requests=1000, history=0, seed=args.seed)
+        database.configure(path)
+        cutoff = database.query_value("SELECT time FROM pools ORDER BY time LIMIT 1 OFFSET ?", int(pools * args.archived))
+        repository.archive_expired_pools(cutoff, pools, time.time())
+
+        # Cities weighted by their riders, as the page is read by whoever is logged in
+        cities = database.column("SELECT city_id FROM users WHERE city_id IS NOT NULL")
+        cities = [(city_id, stats.TOP_ROUTES) for city_id in rng.choices(cities, k=args.lookups)]
+        scan = mean_ms(lambda city_id, limit: (database.query(SCAN_TOP_ROUTES, city_id, limit), database.query(SCAN_CITY_HOURS, city_id)), cities)
+        rollup = mean_ms(lambda city_id, limit: (repository.top_routes(city_id, limit), repository.city_hours(city_id)), cities)
+
+        places = {}
+        for place_id, city_id in database.query("SELECT places.id, cities.id FROM places JOIN cities ON cities.key = places.city"):
+            places.setdefault(city_id, []).append(place_id)
+        creators = [
+            (user_id, city_id, places[city_id])
+            for user_id, city_id in database.query("SELECT id, city_id FROM users WHERE city_id IS NOT NULL")
+            if len(places.get(city_id, ())) > 1
+        ]
+        without = create_pools(creators, rng, args.creates, False)
+        # Pools created without upkeep are counted now, so the recount below checks only the incremental updates
+        first = database.query_value("SELECT MAX(id) FROM pools") - args.creates + 1
+        repository.count_routes(first, first + args.creates - 1)
+        with_rollups = create_pools(creators, rng, args.creates, True)
+
+        # The incremental result must be exactly what a recount from every pool gives
+        for table in ROLLUPS:
+            database.execute(f"CREATE TEMP TABLE incremental_{table} AS SELECT * FROM {table}")
+        start = time.perf_counter()
+        repository.rollup_routes()
+        recount = time.perf_counter() - start
+        differing = sum(
+            database.query_value(f"SELECT COUNT(*) FROM (SELECT * FROM {mine} EXCEPT SELECT * FROM {theirs})")
+            for table in ROLLUPS
+            for mine, theirs in ((table, f"incremental_{table}"), (f"incremental_{table}", table))
+        )
+        different += differing
+        print(f"{pools:>8} {scan:>10.2f} {rollup:>12.2f} {without:>8.2f} {with_rollups:>10.2f} {recount:>10.1f}  {differing}")
+        database.release()
+    if different:
+        print(f"FAILED, {different} rollup rows differ from a recount")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
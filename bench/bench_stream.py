@@ -0,0 +1,144 @@
+"""
+Opens many idle /stream connections against one threaded worker, reporting the memory and threads each one
+costs and how long a single event takes to reach all of them. Then waits for the streams to end after
+EVENTS_STREAM_SECONDS, and exits non-zero when one outlives it.
+
+Usage: python bench/bench_stream.py [--connections 500] [--backend memory|sqlite] [--lifetime 10]
+"""
+import argparse
+import logging
+import os
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def rss_kb():
+    """Returns this process's resident memory in kilobytes"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--lifetime", type=float, default=10, help="seconds each stream stays open")
+    args = parser.parse_args()
+
+    # The app reads these while being imported
+    os.environ["SESSION_TYPE"] = "memory"
+    os.environ["EVENTS_STREAM"] = "on"
+    os.environ["EVENTS_STREAM_SECONDS"] = str(args.lifetime)
+    os.environ["EVENTS_BACKEND"] = args.backend
+
+    from werkzeug.serving import make_server
+
+    import database
+    import events
+    import migrations
+    from app import app
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+    conn.close()
+    database.configure(path)
+    app.config["DATABASE"] = path
+
+    # One rider per connection, all living at the same spot, plus the creator of the pool that is announced
+    with database.transaction():
+        for number in range(args.connections + 1):
+            database.execute(
+                "INSERT INTO users (username, fullname, hash, address, city, latitude, longitude) VALUES (?, ?, '', 'Sector 5', 'Mhow', 22.55, 75.76)",
+                f"rider{number}",
+                f"Rider {number}",
+            )
+    database.release()
+
+    # Log every rider in by writing their session straight into the session store
+    cookies = []
+    interface = app.session_interface
+    for user_id in range(1, args.connections + 1):
+        with app.test_request_context("/"):
+            session = interface.open_session(app, app.request_class({}))
+            session["user_id"] = user_id
+            response = app.response_class()
+            interface.save_session(app, session, response)
+            cookies.append(response.headers["Set-Cookie"].split(";")[0])
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    memory_before, threads_before = rss_kb(), threading.active_count()
+    selector = selectors.DefaultSelector()
+    start = time.perf_counter()
+    for cookie in cookies:
+        client = socket.create_connection(("127.0.0.1", port))
+        client.sendall(f"GET /stream HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\n\r\n".encode())
+        selector.register(client, selectors.EVENT_READ, bytearray())
+
+    # Every stream has started once each client has seen the 'retry' line
+    waiting = len(cookies)
+    while waiting:
+        for key, mask in selector.select(timeout=30):
+            key.data.extend(key.fileobj.recv(65536))
+            if b"retry:" in key.data and not key.data.startswith(b"!"):
+                key.data[:0] = b"!"
+                waiting -= 1
+    connected = time.perf_counter() - start
+    while len(events.bus) < args.connections:
+        time.sleep(0.01)
+
+    memory_after, threads_after = rss_kb(), threading.active_count()
+    print(f"{args.connections} idle streams opened in {connected:.2f} s ({args.backend} bus)")
+    print(f"memory  {(memory_after - memory_before) / args.connections:>8.1f} KB per stream  ({memory_after / 1024:.0f} MB resident)")
+    print(f"threads {(threads_after - threads_before) / args.connections:>8.2f} per stream  ({threads_after} running)")
+
+    # Announce one pool and time how long until every stream has received it
+    start = time.perf_counter()
+    events.pool_created(args.connections + 1, 1, "Sector 5", "Indore", (22.55, 75.76), None)
+    database.release()
+    pending = set(key.fileobj for key in selector.get_map().values())
+    latencies = []
+    while pending:
+        for key, mask in selector.select(timeout=30):
+            chunk = key.fileobj.recv(65536)
+            if key.fileobj in pending and b"event: pool" in chunk:
+                pending.discard(key.fileobj)
+                latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(f"fan-out p50 {latencies[len(latencies) // 2] * 1e3:>8.1f} ms  max {latencies[-1] * 1e3:>8.1f} ms to {len(latencies)} streams")
+
+    # Every stream ends on its own once its lifetime is up, closing the connection and freeing its thread
+    pending = set(key.fileobj for key in selector.get_map().values())
+    deadline = start + args.lifetime + 5
+    while pending and time.perf_counter() < deadline:
+        for key, mask in selector.select(timeout=1):
+            if not key.fileobj.recv(65536):
+                pending.discard(key.fileobj)
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    print(f"lifetime {args.lifetime:.0f} s, {len(pending)} streams still open {deadline - start:.0f} s after the pool was announced")
+
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    server.shutdown()
+    if pending:
+        print(f"FAILED, {len(pending)} streams outlived EVENTS_STREAM_SECONDS")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Accepts pending friend requests on a synthetic power-law friend graph, timing the incremental upkeep of the
+materialized friend suggestions and the friends-page read, then rebuilds the suggestions from scratch and checks
+they match what the incremental updates left. Every user is first suggested their neighbours as on sign-up, and a
+newcomer without friends must be suggested the users living at their place. Exits non-zero when either check fails.
+
+Usage: python bench/bench_suggestions.py [--users 100000] [--requests 400000] [--accepts 2000] [--lookups 2000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import database
+import datagen
+import friendship
+import repository
+
+
+def percentile(ordered, fraction):
+    """Returns the value below which the given fraction of a sorted list falls"""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summary(timings):
+    """Returns 'mean / p50 / p99 / max' of a list of milliseconds"""
+    timings = sorted(timings)
+    return f"{sum(timings) / len(timings):.2f} / {percentile(timings, 0.5):.2f} / {percentile(timings, 0.99):.2f} / {timings[-1]:.2f}"
+
+
+def newcomer_problems():
+    """Returns what went wrong suggesting neighbours to a new user without friends, living where the newest user lives"""
+    home = database.query_one("SELECT id, address, city, place_id, city_id FROM users WHERE place_id IS NOT NULL ORDER BY id DESC LIMIT 1")
+    with database.transaction():
+        user_id = repository.create_user("newcomer", "New Comer", "hash", home.address, home.city, "NOT OWNED", "NOT AVAILABLE", None, None, home.place_id, home.city_id)
+        friendship.add_neighbours(user_id)
+    problems = []
+    found = friendship.suggestions(user_id)
+    if not found or found[0].nearby != 2 or any(suggestion.mutual for suggestion in found):
+        problems.append(f"a newcomer was suggested {[(suggestion.mutual, suggestion.nearby) for suggestion in found]}, expected neighbours at their place first")
+    # Ranked below the neighbour's mutual friends, so looked up directly
+    nearby = database.query_value("SELECT nearby FROM suggestions WHERE user_id = ? AND candidate_id = ?", home.id, user_id)
+    if nearby != 2:
+        problems.append(f"the newcomer was suggested to the user living at the same place with nearby {nearby}, expected 2")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=400000, help="friend requests in the generated graph")
+    parser.add_argument("--accepts", type=int, default=2000, help="pending requests accepted")
+    parser.add_argument("--lookups", type=int, default=2000, help="friends pages read")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "suggestions.db")
+    start = time.perf_counter()
+    datagen.generate(path, users=args.users, pools=1000, requests=args.requests, history=0, seed=args.seed)
+    database.configure(path)
+    rows = database.query_value("SELECT COUNT(*) FROM suggestions")
+    size = database.query_value("SELECT SUM(pgsize) FROM dbstat WHERE name IN ('suggestions', 'suggestions_rank')")
+    degrees = sorted(database.column(
+        "SELECT COUNT(*) FROM (SELECT sender AS id FROM requests WHERE status = 'accepted' UNION ALL SELECT receiver FROM requests WHERE status = 'accepted') GROUP BY id"
+    ))
+    print(f"{args.users} users, {sum(degrees) // 2} friendships, friends per user p50 {percentile(degrees, 0.5)} p99 {percentile(degrees, 0.99)} max {degrees[-1]}")
+    print(f"generated in {time.perf_counter() - start:.1f} s, {rows} suggestions taking {size / 2 ** 20:.1f} MiB")
+
+    # Every user suggested to their neighbours in sign-up order, as register() does
+    user_ids = database.column("SELECT id FROM users ORDER BY id")
+    start = time.perf_counter()
+    with database.transaction():
+        for user_id in user_ids:
+            friendship.add_neighbours(user_id)
+    print(f"neighbours suggested on sign-up, ms mean: {(time.perf_counter() - start) * 1e3 / len(user_ids):.3f}")
+    problems = newcomer_problems()
+
+    rng = random.Random(args.seed)
+    pending = database.query("SELECT sender, receiver FROM requests WHERE status = 'pending'")
+    accepted = rng.sample(pending, min(args.accepts, len(pending)))
+    timings = []
+    for sender, receiver in accepted:
+        start = time.perf_counter()
+        friendship.answer_request(sender, receiver, "accept")
+        timings.append((time.perf_counter() - start) * 1e3)
+    print(f"accept and update suggestions, ms mean / p50 / p99 / max: {summary(timings)} over {len(accepted)} accepts")
+
+    users = rng.choices(range(1, args.users + 1), k=args.lookups)
+    timings = []
+    for user_id in users:
+        start = time.perf_counter()
+        friendship.suggestions(user_id)
+        timings.append((time.perf_counter() - start) * 1e3)
+    print(f"friends page suggestions, ms mean / p50 / p99 / max: {summary(timings)} over {len(users)} users")
+
+    # The incremental result must be exactly what a rebuild from the graph gives
+    database.execute("CREATE TEMP TABLE incremental AS SELECT * FROM suggestions")
+    start = time.perf_counter()
+    repository.rebuild_suggestions(friendship.CONNECTOR_LIMIT)
+    rebuild = time.perf_counter() - start
+    missing = database.query_value("SELECT COUNT(*) FROM (SELECT * FROM suggestions EXCEPT SELECT * FROM incremental)")
+    extra = database.query_value("SELECT COUNT(*) FROM (SELECT * FROM incremental EXCEPT SELECT * FROM suggestions)")
+    print(f"full rebuild {rebuild:.1f} s, {missing} rows missing from and {extra} extra in the incremental table")
+    database.release()
+    if missing or extra:
+        problems.append("the incremental suggestions differ from a rebuild")
+    for problem in problems:
+        print(f"FAILED, {problem}")
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
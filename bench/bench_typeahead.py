@@ -0,0 +1,135 @@
+"""
+Builds the username typeahead index over synthetic users and times prefix lookups, ranked against a random circle
+of friends of friends, plus single sign-ups added to the built index, then checks that users signing up while the
+buffer is merged into the arrays stay searchable. Exits non-zero when p99 exceeds the budget or the check fails.
+
+Usage: python bench/bench_typeahead.py [--users 1000000] [--lookups 20000] [--circle 500] [--budget-ms 1.0]
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import typeahead
+from bench_routes import percentile
+
+
+FIRST_NAMES = (
+    "Aarav", "Aditi", "Akash", "Ananya", "Arjun", "Deepa", "Divya", "Gaurav", "Ishaan", "Kavya", "Kiran", "Lakshmi",
+    "Manish", "Meera", "Neha", "Nikhil", "Pooja", "Priya", "Rahul", "Rohan", "Sanjay", "Satvik", "Shreya", "Sneha",
+    "Suresh", "Tanvi", "Varun", "Vikram", "Yash", "Zoya",
+)
+LAST_NAMES = (
+    "Agarwal", "Bhat", "Chopra", "Das", "Gupta", "Iyer", "Jain", "Joshi", "Kapoor", "Kumar", "Mehta", "Menon", "Nair",
+    "Pathak", "Patel", "Rao", "Reddy", "Shah", "Sharma", "Singh", "Verma",
+)
+
+
+def synthetic_users(count, rng, first_id=1):
+    """Yields (id, username, fullname) rows with names drawn from common first and last names"""
+    for user_id in range(first_id, first_id + count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        yield user_id, f"{first.lower()}{last[0].lower()}{user_id}", f"{first} {last}"
+
+
+def merge_problems(rng):
+    """Returns descriptions of every way a user goes missing when they sign up while the buffer is being merged"""
+    index = typeahead.PrefixIndex()
+    index.add(synthetic_users(typeahead.BUFFER_KEYS, rng))
+    sign_ups = list(synthetic_users(typeahead.BUFFER_KEYS, rng, first_id=index.last_id + 1))
+    # Signs up while the merge runs, between taking the buffer out and swapping the merged arrays in
+    late = (sign_ups[-1][0] + 1, "zelda", "Zelda Zapata")
+    first = sign_ups[0]
+    merging = typeahead._merged
+    found = []
+
+    def merged_with_sign_up(keys, ids, entries):
+        merged = merging(keys, ids, entries)
+        index.add([late])
+        if index.search(late[1]) != [late[0]]:
+            found.append("a user signing up during the merge was not found before the swap")
+        if index.search(first[1]) != [first[0]]:
+            found.append("a user being merged was not found before the swap")
+        typeahead._merged = merging
+        return merged
+
+    # Single sign-ups until the buffer overflows and the next one merges it
+    typeahead._merged = merged_with_sign_up
+    try:
+        for user in sign_ups:
+            index.add([user])
+            if typeahead._merged is merging:
+                break
+    finally:
+        typeahead._merged = merging
+    if index.search(late[1]) != [late[0]]:
+        found.append("a user signing up during the merge was lost after the swap")
+    if index.search(first[1]) != [first[0]]:
+        found.append("a merged user was lost after the swap")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--circle", type=int, default=500, help="friends and friends of friends of the searching user")
+    parser.add_argument("--sign-ups", type=int, default=1000, help="users added one at a time after the build")
+    parser.add_argument("--budget-ms", type=float, default=1.0, help="p99 lookup latency to stay under")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    index = typeahead.PrefixIndex()
+    start = time.perf_counter()
+    index.add(synthetic_users(args.users, rng))
+    elapsed = time.perf_counter() - start
+    rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"indexed {args.users} users as {len(index)} keys in {elapsed:.1f} s, peak RSS {rss_mib:.0f} MiB")
+
+    # Prefixes of one to six characters cut from usernames and full names, as typed into the search box
+    samples = [rng.choice((username, fullname)) for user_id, username, fullname in synthetic_users(min(args.users, 10000), rng)]
+    prefixes = [sample[: rng.randint(1, 6)] for sample in rng.choices(samples, k=args.lookups)]
+    circle = frozenset(rng.sample(range(1, args.users + 1), min(args.circle, args.users)))
+
+    latencies = []
+    found = 0
+    for prefix in prefixes:
+        start = time.perf_counter()
+        found += len(index.search(prefix, circle, exclude=1))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(
+        f"{args.lookups} lookups: p50 {percentile(latencies, 0.50) * 1e3:.3f} ms, p95 {percentile(latencies, 0.95) * 1e3:.3f} ms, "
+        f"p99 {percentile(latencies, 0.99) * 1e3:.3f} ms, max {latencies[-1] * 1e3:.3f} ms, {found / args.lookups:.1f} results each"
+    )
+
+    # What register() does to the built index, one insertion per key
+    sign_ups = list(synthetic_users(args.sign_ups, rng, first_id=args.users + 1))
+    additions = []
+    for user in sign_ups:
+        start = time.perf_counter()
+        index.add([user])
+        additions.append(time.perf_counter() - start)
+    additions.sort()
+    # The slowest one merges the buffer of new keys into the arrays, lookups carry on meanwhile
+    print(
+        f"{args.sign_ups} sign-ups added one at a time: p50 {percentile(additions, 0.50) * 1e3:.3f} ms, "
+        f"max {additions[-1] * 1e3:.0f} ms, {len(index)} keys"
+    )
+
+    failures = merge_problems(rng)
+    if percentile(latencies, 0.99) * 1e3 > args.budget_ms:
+        failures.append(f"p99 above the {args.budget_ms} ms budget")
+    for failure in failures:
+        print(f"FAILED, {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
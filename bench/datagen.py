@@ -0,0 +1,186 @@
+"""
+Generates a synthetic, fully migrated database with realistic skew: a few hot localities hold most riders,
+a few power users create most pools, and friend counts follow a power law.
+
+Usage: python bench/datagen.py OUTPUT [--users 5000] [--pools 50000] [--requests 20000] [--history 50000] [--seed 42]
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from werkzeug.security import generate_password_hash
+
+import friendship
+import geo
+import hashing
+import migrations
+import repository
+from places import normalize
+
+
+# Every synthetic user logs in with this password
+PASSWORD = "Commute#2024"
+
+# Share of pools still live, created within the last two hours
+LIVE_SHARE = 0.2
+
+# Share of pools that are invitations to one friend
+INVITE_SHARE = 0.1
+
+# Status of generated friend requests
+REQUEST_STATUSES = (("accepted", 0.7), ("pending", 0.2), ("rejected", 0.1))
+
+BIKES = ("Pleasure", "Activa", "Splendor", "NOT OWNED", "NOT AVAILABLE")
+
+
+def zipf_weights(count, exponent=1.1):
+    """Returns weights where the item of rank r is picked in proportion to 1 / r ** exponent"""
+    return [1 / rank ** exponent for rank in range(1, count + 1)]
+
+
+def load_places():
+    """Returns (name, city, latitude, longitude) for every gazetteer entry"""
+    with open(geo.GAZETTEER_PATH, newline="") as file:
+        return [(row["name"], row["city"], float(row["latitude"]), float(row["longitude"])) for row in csv.DictReader(file)]
+
+
+def generate(path, users=5000, pools=50000, requests=20000, history=50000, seed=42, hash_method=hashing.HASH_METHOD):
+    """Creates a migrated database at path filled with synthetic riders, pools, friend requests and history"""
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = migrations.connect(path)
+    migrations.upgrade(conn)
+
+    # Riders crowd into a few hot localities, shuffled so the hot ones are spread over cities
+    places = load_places()
+    rng.shuffle(places)
+    place_weights = zipf_weights(len(places))
+    password_hash = generate_password_hash(PASSWORD, hash_method)
+    homes = rng.choices(places, place_weights, k=users)
+    conn.execute("BEGIN")
+
+    # Every gazetteer city and entry is interned up front, keyed the way places.city() and places.intern() key them
+    city_ids = {}
+    for name, city, latitude, longitude in places:
+        if normalize(city) not in city_ids:
+            city_ids[normalize(city)] = conn.execute("INSERT INTO cities (key, name) VALUES (?, ?)", (normalize(city), city)).lastrowid
+    place_ids = {}
+    for name, city, latitude, longitude in places:
+        key = (normalize(city), normalize(name))
+        if key not in place_ids:
+            place_ids[key] = conn.execute(
+                "INSERT INTO places (city, key, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)", (*key, name, latitude, longitude)
+            ).lastrowid
+    place_id = {place: place_ids[(normalize(place[1]), normalize(place[0]))] for place in places}
+
+    conn.executemany(
+        """INSERT INTO users (id, username, fullname, hash, address, city, bike, phone, latitude, longitude, place_id, city_id)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (
+                user_id, f"rider{user_id}", f"Rider {user_id}", password_hash, home[0], home[1], rng.choice(BIKES), f"+91-{rng.randrange(10 ** 9, 10 ** 10)}",
+                home[2], home[3], place_id[home], city_ids[normalize(home[1])],
+            )
+            for user_id, home in enumerate(homes, start=1)
+        ],
+    )
+
+    # Friend counts follow a power law, a few riders know hundreds of others
+    pairs = set()
+    senders = list(range(1, users + 1))
+    rng.shuffle(senders)
+    while len(pairs) < min(requests, users * (users - 1) // 2):
+        for sender in senders:
+            for _ in range(min(int(rng.paretovariate(1.2)), users - 1)):
+                receiver = rng.randint(1, users)
+                if receiver != sender and (receiver, sender) not in pairs:
+                    pairs.add((sender, receiver))
+            if len(pairs) >= requests:
+                break
+    pairs = sorted(pairs)[:requests]
+    statuses, status_weights = zip(*REQUEST_STATUSES)
+    conn.executemany(
+        "INSERT INTO requests (sender, receiver, status) VALUES (?, ?, ?)",
+        [(sender, receiver, rng.choices(statuses, status_weights)[0]) for sender, receiver in pairs],
+    )
+    # Suggestions are materialized from the accepted requests, as the migration does for an existing database
+    conn.execute(repository.SUGGEST_ALL, (friendship.CONNECTOR_LIMIT,))
+    friends = {}
+    for sender, receiver in pairs:
+        friends.setdefault(sender, []).append(receiver)
+        friends.setdefault(receiver, []).append(sender)
+
+    # A few power users create most pools, mostly between localities of their own city
+    by_city = {}
+    for place in places:
+        by_city.setdefault(place[1], []).append(place)
+    creators = rng.choices(range(1, users + 1), zipf_weights(users, 0.8), k=pools)
+    now = time.time()
+    trips = []
+    for creator in creators:
+        home = homes[creator - 1]
+        destination = rng.choice(by_city[home[1]])
+        created = now - rng.uniform(0, 7200) if rng.random() < LIVE_SHARE else now - rng.uniform(7200, 30 * 86400)
+        follower = rng.choice(friends[creator]) if creator in friends and rng.random() < INVITE_SHARE else None
+        trips.append((created, creator, follower, home, destination))
+
+    # Ids follow creation time, as they do in the app
+    trips.sort(key=lambda trip: trip[0])
+    conn.executemany(
+        "INSERT INTO pools (id, creator, city_id, follower, origin_id, destination_id, time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (pool_id, creator, city_ids[normalize(home[1])], follower, place_id[home], place_id[destination], created)
+            for pool_id, (created, creator, follower, home, destination) in enumerate(trips, start=1)
+        ],
+    )
+    # Route rollups are counted from the pools, as the migration does for an existing database
+    for sql in (repository.ROLLUP_ROUTE_HOURS, repository.ROLLUP_ROUTE_TOTALS, repository.ROLLUP_CITY_HOURS):
+        conn.execute(sql)
+
+    # History has one row per pool, preceded by older rides whose pools were archived long ago
+    older = []
+    for _ in range(max(0, history - pools)):
+        creator = rng.choice(creators)
+        home = homes[creator - 1]
+        older.append((now - rng.uniform(30 * 86400, 365 * 86400), creator, home, rng.choice(by_city[home[1]])))
+    older.sort(key=lambda ride: ride[0])
+    history_rows = [
+        (creator, 0, None, place_id[home], place_id[destination], datetime.fromtimestamp(created).strftime("%Y-%m-%d"))
+        for created, creator, home, destination in older
+    ]
+    history_rows.extend(
+        (creator, pool_id, follower, place_id[home], place_id[destination], datetime.fromtimestamp(created).strftime("%Y-%m-%d"))
+        for pool_id, (created, creator, follower, home, destination) in enumerate(trips, start=1)
+    )
+    conn.executemany(
+        "INSERT INTO history (user_id, pool_id, recipient_id, origin_id, destination_id, date) VALUES (?, ?, ?, ?, ?, ?)",
+        history_rows[-history:] if history else [],
+    )
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("output")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--pools", type=int, default=50000)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--history", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.output, args.users, args.pools, args.requests, args.history, args.seed)
+    print(f"wrote {args.output} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import csv
+import itertools
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+import accounts
+import database
+import friendship
+import places
+import repository
+from geo import geocode
+from hashing import WORKERS
+from migrations import db_cli
+
+
+# Rows written per transaction, large enough to amortise the commit and small enough to keep memory flat
+BATCH_SIZE = 5000
+
+# Page cache of the importing connection, so index pages touched by one batch are still cached for the next
+CACHE_KIB = 65536
+
+# Columns of each kind of record, in the order they are exported
+FIELDS = {
+    "users": ("username", "fullname", "hash", "address", "city", "bike", "phone", "latitude", "longitude"),
+    "friendships": ("sender", "receiver", "status"),
+    "pools": ("creator", "follower", "origin", "destination", "time", "origin_latitude", "origin_longitude", "destination_latitude", "destination_longitude"),
+}
+
+REQUEST_STATUSES = ("pending", "accepted", "rejected")
+
+
+class Rejected(ValueError):
+    """Raised for an input row that fails validation, with the reason shown to the user"""
+
+
+def open_file(path, mode):
+    """Opens a text file for csv or jsonl, '-' meaning standard input or output"""
+    if path == "-":
+        return open(sys.stdin.fileno() if mode == "r" else sys.stdout.fileno(), mode, encoding="utf-8", newline="", closefd=False)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def file_format(path, chosen):
+    """Returns the format picked with --format, or the one implied by the file extension"""
+    if chosen:
+        return chosen
+    if path.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    if path.endswith(".csv"):
+        return "csv"
+    raise click.UsageError("cannot tell the format from the file name, pass --format")
+
+
+def read_rows(file, form):
+    """Yields (line number, row dict) one at a time, so input of any size is read in constant memory"""
+    if form == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for number, line in enumerate(file, start=1):
+        if line.strip():
+            try:
+                yield number, json.loads(line)
+            except json.JSONDecodeError as error:
+                yield number, error
+
+
+def text(row, name):
+    """Returns a field as stripped text, empty when missing"""
+    value = row.get(name)
+    if value is None:
+        return ""
+    return value.strip() if isinstance(value, str) else str(value)
+
+
+def number(row, name):
+    """Returns a field as a float, None when missing"""
+    value = row.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise Rejected(f"{name} must be a number") from None
+
+
+class Importer:
+    """Validates, prepares and stores rows of one kind in batches, hashing passwords in a process pool"""
+
+    def __init__(self, kind, hash_method, workers):
+        self.kind = kind
+        self.hash_method = hash_method
+        self.workers = workers
+        self._executor = None
+        self.stored = self.skipped = self.rejected = 0
+
+    def hash_all(self, passwords):
+        """Returns the hashes of the passwords, computed across the worker processes"""
+        if not passwords:
+            return []
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        chunk = max(1, len(passwords) // (self.workers * 4))
+        return list(self._executor.map(generate_password_hash, passwords, itertools.repeat(self.hash_method), chunksize=chunk))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def point(self, row, latitude, longitude):
+        """Returns the coordinates given in the row, or None when they are missing"""
+        if row.get(latitude) not in (None, "") and row.get(longitude) not in (None, ""):
+            return number(row, latitude), number(row, longitude)
+        return None
+
+    def prepare_user(self, row):
+        """Returns (profile, location, password, hash) for a row carrying either a plain password or an existing hash"""
+        username, fullname, password, hash = text(row, "username"), text(row, "fullname"), text(row, "password"), text(row, "hash")
+        # The same rules as register(), the password counting as its own confirmation
+        problem = accounts.check_profile(username, fullname) if hash and not password else accounts.check(username, fullname, password, password)
+        if problem:
+            raise Rejected(problem)
+        profile = accounts.clean(username, fullname, text(row, "address"), text(row, "city"), text(row, "bike"), text(row, "phone"))
+        return profile, self.point(row, "latitude", "longitude"), password, hash
+
+    def store_users(self, prepared):
+        # Passwords of taken usernames are never hashed, re-running an import costs no PBKDF2 work
+        taken = repository.users_by_usernames({user[0].username for user in prepared})
+        prepared = [user for user in prepared if user[0].username not in taken]
+        hashes = iter(self.hash_all([password for profile, location, password, hash in prepared if password]))
+        rows = []
+        for profile, location, password, hash in prepared:
+            # Imports name the same few localities over and over, each is interned and geocoded once
+            place = places.home(profile.address, profile.city, location)
+            if location is None:
+                location = (place.latitude, place.longitude) if place else geocode(profile.address, profile.city)
+            rows.append((*profile[:2], next(hashes) if password else hash, *profile[2:], *location, place.id if place else None, places.city(profile.city)))
+        return repository.import_users(rows, friendship.NEIGHBOUR_LIMIT)
+
+    def prepare_friendship(self, row):
+        """Returns (status, sender username, receiver username) for a friend request row, accepted by default"""
+        sender, receiver, status = text(row, "sender").lower(), text(row, "receiver").lower(), text(row, "status").lower() or "accepted"
+        if not sender or not receiver:
+            raise Rejected("must require sender and receiver")
+        if sender == receiver:
+            raise Rejected("you can't send yourself a friend request")
+        if status not in REQUEST_STATUSES:
+            raise Rejected(f"status must be one of {', '.join(REQUEST_STATUSES)}")
+        return status, sender, receiver
+
+    def store_friendships(self, prepared):
+        users = repository.users_by_usernames({name for status, sender, receiver in prepared for name in (sender, receiver)})
+        # Sorted by sender, so consecutive inserts touch neighbouring index pages
+        return repository.import_friend_requests(
+            sorted((users[sender].id, users[receiver].id, status) for status, sender, receiver in prepared if sender in users and receiver in users)
+        )
+
+    def prepare_pool(self, row):
+        """Returns the pool fields, the users and places being resolved when the batch is stored"""
+        origin, destination = text(row, "origin"), text(row, "destination")
+        # The same rules as create_pool()
+        if not origin:
+            raise Rejected("must require ride start address")
+        if not destination:
+            raise Rejected("must require ride destination address")
+        created = number(row, "time")
+        if created is None:
+            raise Rejected("must require the pool's creation time")
+        return text(row, "creator").lower(), text(row, "follower").lower() or None, origin, destination, created, row
+
+    def store_pools(self, prepared):
+        users = repository.users_by_usernames({name for pool in prepared for name in pool[:2] if name})
+        rows = []
+        for creator, follower, origin, destination, created, row in prepared:
+            if creator not in users or (follower and follower not in users):
+                continue
+            # Coordinates given in the row only count for a place seen for the first time
+            city = users[creator].city
+            rows.append((
+                users[creator].id,
+                users[creator].city_id,
+                users[follower].id if follower else None,
+                places.intern(origin, city, self.point(row, "origin_latitude", "origin_longitude")).id,
+                places.intern(destination, city, self.point(row, "destination_latitude", "destination_longitude")).id,
+                created,
+            ))
+        return repository.import_pools(rows) if rows else 0
+
+    def reject(self, line, problem):
+        self.rejected += 1
+        click.echo(f"line {line}: {problem}", err=True)
+
+    def run(self, rows, batch_size):
+        """Imports every row, one transaction per batch"""
+        prepare, store = {
+            "users": (self.prepare_user, self.store_users),
+            "friendships": (self.prepare_friendship, self.store_friendships),
+            "pools": (self.prepare_pool, self.store_pools),
+        }[self.kind]
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            prepared = []
+            for line, row in batch:
+                try:
+                    if not isinstance(row, dict):
+                        raise Rejected("not a JSON object")
+                    prepared.append(prepare(row))
+                except Rejected as problem:
+                    self.reject(line, problem)
+            if not prepared:
+                continue
+            with database.transaction():
+                stored = store(prepared)
+            self.stored += stored
+            self.skipped += len(prepared) - stored
+
+
+@db_cli.command("import")
+@click.argument("kind", type=click.Choice(tuple(FIELDS)))
+@click.argument("path", metavar="FILE")
+@click.option("--format", "form", type=click.Choice(("csv", "jsonl")), default=None, help="Defaults to the file extension.")
+@click.option("--batch-size", type=int, default=BATCH_SIZE, show_default=True, help="Rows written per transaction.")
+@click.option("--hash-method", default=None, help="Method for plain passwords, defaults to PASSWORD_HASH_METHOD.")
+@click.option("--workers", type=int, default=WORKERS, show_default=True, help="Processes hashing plain passwords.")
+def import_command(kind, path, form, batch_size, hash_method, workers):
+    """Bulk-load users, friendships or pools from CSV or JSON lines, '-' reading standard input.
+
+    Users carry either a plain 'password', hashed here, or an existing 'hash'. Friendships and pools name
+    users by username. Existing usernames and friend requests are skipped, invalid rows are reported.
+    """
+    importer = Importer(kind, hash_method or current_app.config["PASSWORD_HASH_METHOD"], workers)
+    # Each batch is one long statement by design, which the slow-statement log of the request metrics would flag
+    database.observer = None
+    database.execute(f"PRAGMA cache_size = -{CACHE_KIB}")
+    start = time.perf_counter()
+    try:
+        with open_file(path, "r") as file:
+            importer.run(read_rows(file, file_format(path, form)), batch_size)
+        if kind == "friendships" and importer.stored:
+            # Imported friendships skip the upkeep done as requests are accepted, rebuilding once beats replaying each
+            repository.rebuild_suggestions(friendship.CONNECTOR_LIMIT)
+    finally:
+        importer.close()
+        database.release()
+    elapsed = time.perf_counter() - start
+    rate = (importer.stored + importer.skipped) / elapsed if elapsed else 0
+    click.echo(
+        f"Imported {importer.stored} {kind}, skipped {importer.skipped} already present or naming unknown users, "
+        f"rejected {importer.rejected} invalid rows in {elapsed:.1f} s ({rate:.0f} rows/s)",
+        err=True,
+    )
+
+
+@db_cli.command("export")
+@click.argument("kind", type=click.Choice(tuple(FIELDS)))
+@click.argument("path", metavar="FILE", default="-")
+@click.option("--format", "form", type=click.Choice(("csv", "jsonl")), default=None, help="Defaults to the file extension, or csv for standard output.")
+def export_command(kind, path, form):
+    """Stream users, friendships or pools to CSV or JSON lines in the format 'flask db import' reads."""
+    form = form or ("csv" if path == "-" else file_format(path, None))
+    records = {"users": repository.export_users, "friendships": repository.export_friend_requests, "pools": repository.export_pools}[kind]()
+    fields = FIELDS[kind]
+    start = time.perf_counter()
+    count = 0
+    try:
+        with open_file(path, "w") as file:
+            if form == "csv":
+                writer = csv.writer(file)
+                writer.writerow(fields)
+                for count, record in enumerate(records, start=1):
+                    writer.writerow(record)
+            else:
+                for count, record in enumerate(records, start=1):
+                    file.write(json.dumps(dict(zip(fields, record))) + "\n")
+    finally:
+        database.release()
+    click.echo(f"Exported {count} {kind} in {time.perf_counter() - start:.1f} s", err=True)
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import click
+
+import database
+import repository
+from feed import cutoff_time
+from migrations import db_cli
+
+
+# Defaults for the COMPACTION_* settings read by init_app()
+BATCH_SIZE = 500
+BATCH_PAUSE = 0.05
+VACUUM_PAGES = 2000
+INTERVAL = 0
+
+# Outcome of archiving one batch of expired pools
+Batch = namedtuple("Batch", "number rows seconds")
+
+
+def vacuum(pages=VACUUM_PAGES):
+    """Hands up to 'pages' free pages back to the filesystem and returns how many were released"""
+    free = database.query_value("PRAGMA freelist_count")
+    # Stepping through every row runs the whole vacuum, it only does work under incremental auto-vacuum
+    database.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return free - database.query_value("PRAGMA freelist_count")
+
+
+def compact(batch_size=BATCH_SIZE, pause=BATCH_PAUSE, vacuum_pages=VACUUM_PAGES, report=None):
+    """Moves every expired pool into the archive in bounded batches, then vacuums, and returns (batches, pages freed)
+
+    Each batch is its own short write transaction, and the job sleeps 'pause' seconds between batches so request
+    handlers are never locked out for long. 'report' is called with every Batch as it completes.
+    """
+    cutoff = cutoff_time()
+    batches = []
+    try:
+        while True:
+            start = time.perf_counter()
+            moved = repository.archive_expired_pools(cutoff, batch_size, time.time())
+            if not moved:
+                break
+            batch = Batch(len(batches) + 1, moved, time.perf_counter() - start)
+            batches.append(batch)
+            if report is not None:
+                report(batch)
+            if moved < batch_size:
+                break
+            time.sleep(pause)
+        return batches, vacuum(vacuum_pages)
+    finally:
+        database.release()
+
+
+class Compactor(threading.Thread):
+    """Daemon thread that periodically archives expired pools"""
+
+    def __init__(self, interval, batch_size=BATCH_SIZE, pause=BATCH_PAUSE, vacuum_pages=VACUUM_PAGES, logger=None):
+        super().__init__(name="pool-compactor", daemon=True)
+        self.interval = interval
+        self.options = (batch_size, pause, vacuum_pages)
+        self.logger = logger or logging.getLogger(__name__)
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                compact(*self.options)
+            except Exception:
+                # A locked database or a failed batch is retried on the next tick
+                self.logger.exception("pool compaction failed, retrying in %s s", self.interval)
+
+    def stop(self):
+        self._halt.set()
+
+
+def init_app(app):
+    """Sets up a background compactor, which the app starts with its first request, when COMPACTION_INTERVAL is a
+    positive number of seconds"""
+    interval = app.config.setdefault("COMPACTION_INTERVAL", INTERVAL)
+    if not interval:
+        return
+    app.extensions["pool_compactor"] = Compactor(
+        interval,
+        app.config.get("COMPACTION_BATCH_SIZE", BATCH_SIZE),
+        app.config.get("COMPACTION_BATCH_PAUSE", BATCH_PAUSE),
+        app.config.get("COMPACTION_VACUUM_PAGES", VACUUM_PAGES),
+        app.logger,
+    )
+
+
+@db_cli.command("compact")
+@click.option("--batch-size", type=int, default=BATCH_SIZE, show_default=True, help="Pools moved per transaction.")
+@click.option("--pause", type=float, default=BATCH_PAUSE, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--vacuum-pages", type=int, default=VACUUM_PAGES, show_default=True, help="Free pages to release afterwards, 0 for all.")
+@click.option("--check/--no-check", default=False, help="Fail if any history row points at a missing pool.")
+def compact_command(batch_size, pause, vacuum_pages, check):
+    """Move expired pools into the archive table."""
+
+    def report(batch):
+        click.echo(f"Batch {batch.number}: moved {batch.rows} pools in {batch.seconds * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    batches, pages = compact(batch_size, pause, vacuum_pages, report)
+    click.echo(f"Archived {sum(batch.rows for batch in batches)} pools in {len(batches)} batches, {time.perf_counter() - start:.2f} s")
+    click.echo(f"Released {pages} free pages")
+
+    if check:
+        orphans = repository.orphaned_history()
+        database.release()
+        if orphans:
+            raise click.ClickException(f"{orphans} history rows point at missing pools")
+        click.echo("Every history row resolves to a pool")
@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import wraps
+
+
+# Connection settings applied to every pooled connection
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 256
+POOL_SIZE = 8
+
+
+# Called with the SQL and elapsed seconds of every statement run through the functions below, when set
+observer = None
+
+
+# Row classes keyed by their column names, so each distinct query shape builds its class once
+_record_types = {}
+
+
+def record_type(columns):
+    """Returns a lightweight tuple class with one attribute per column"""
+    cls = _record_types.get(columns)
+    if cls is None:
+        cls = _record_types[columns] = namedtuple("Record", columns, rename=True)
+    return cls
+
+
+class Busy(Exception):
+    """Raised by transaction(wait=False) when another connection is writing"""
+
+
+class ConnectionPool:
+    """Hands each thread a SQLite connection and keeps released connections for reuse"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        return conn
+
+    def acquire(self):
+        """Returns the connection bound to the current thread, checking one out of the pool if needed"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    def release(self):
+        """Returns the current thread's connection to the pool"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        """Closes every idle connection"""
+        self.release()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    @contextmanager
+    def transaction(self, wait=True):
+        """Runs the enclosed statements in one write transaction, nested blocks join the outer one. Without 'wait' it
+        raises Busy at once instead of waiting up to BUSY_TIMEOUT_MS for another connection to finish writing"""
+        conn = self.acquire()
+        if self._local.depth == 0:
+            self._begin(conn, wait)
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("ROLLBACK")
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _begin(conn, wait):
+        if wait:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as error:
+            if error.sqlite_errorcode != sqlite3.SQLITE_BUSY:
+                raise
+            raise Busy() from error
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
+
+pool = ConnectionPool("project.db")
+
+
+def configure(path, size=POOL_SIZE):
+    """Points the pool at another database file"""
+    global pool
+    pool.close()
+    pool = ConnectionPool(path, size)
+
+
+def release():
+    """Returns the current thread's connection to the pool"""
+    pool.release()
+
+
+def transaction(wait=True):
+    """Runs the enclosed statements in one write transaction, raising Busy at once when another connection is writing
+    unless 'wait'"""
+    return pool.transaction(wait)
+
+
+def _observed(function):
+    """Reports the statement and its duration, including fetching its rows, to the observer"""
+
+    @wraps(function)
+    def wrapper(sql, *params):
+        if observer is None:
+            return function(sql, *params)
+        start = time.perf_counter()
+        try:
+            return function(sql, *params)
+        finally:
+            observer(sql, time.perf_counter() - start)
+
+    return wrapper
+
+
+@_observed
+def query(sql, *params):
+    """Runs a SELECT and returns its rows as records"""
+    cursor = pool.acquire().execute(sql, params)
+    make = record_type(tuple(field[0] for field in cursor.description))._make
+    return [make(row) for row in cursor]
+
+
+def iterate(sql, *params):
+    """Runs a SELECT and yields its rows as records one at a time, for results too large to hold in memory"""
+    cursor = pool.acquire().execute(sql, params)
+    make = record_type(tuple(field[0] for field in cursor.description))._make
+    for row in cursor:
+        yield make(row)
+
+
+@_observed
+def query_one(sql, *params):
+    """Runs a SELECT and returns its first row as a record, or None"""
+    cursor = pool.acquire().execute(sql, params)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return record_type(tuple(field[0] for field in cursor.description))._make(row)
+
+
+@_observed
+def query_value(sql, *params):
+    """Runs a SELECT and returns the first column of its first row, or None"""
+    row = pool.acquire().execute(sql, params).fetchone()
+    return None if row is None else row[0]
+
+
+@_observed
+def column(sql, *params):
+    """Runs a SELECT and returns the first column of every row"""
+    return [row[0] for row in pool.acquire().execute(sql, params)]
+
+
+@_observed
+def execute(sql, *params):
+    """Runs an INSERT, UPDATE or DELETE and returns its cursor"""
+    return pool.acquire().execute(sql, params)
+
+
+@_observed
+def executemany(sql, rows):
+    """Runs one statement for every parameter tuple in 'rows' and returns its cursor, whose rowcount is the total"""
+    return pool.acquire().executemany(sql, rows)
@@ -0,0 +1,248 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import database
+import repository
+from geo import RADIUS_KM, haversine_km
+
+
+# Defaults for the EVENTS_* settings read by init_app()
+STREAM = False
+STREAM_SECONDS = 300
+DEFAULT_BACKEND = "sqlite"
+QUEUE_SIZE = 100
+POLL_INTERVAL = 0.5
+RETENTION_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+
+# The relay purges old rows from 'events' once every this many polls
+PURGE_EVERY = 120
+
+# Something that happened which open streams, or another part of every worker, may want to hear about
+#   kind      'pool' for a pool open to everyone, 'invite' for a pool offered to one friend, 'friend' for an accepted
+#             request, or a kind handed to the listener registered for it, such as 'session' for a deleted session
+#   audience  the one user the event is meant for, None for open pools, which go to everyone living near their origin
+#   creator, place_id, latitude, longitude  who created an open pool and where they live, used to pick its audience
+#   payload   what is sent to the browser
+Event = namedtuple("Event", "kind audience creator place_id latitude longitude payload")
+
+
+class Subscriber:
+    """One open stream, holding the rider's home location and the events waiting to be sent to them"""
+
+    def __init__(self, user, size=QUEUE_SIZE):
+        self.user_id = user.id
+        self.place_id = user.place_id
+        self.latitude = user.latitude
+        self.longitude = user.longitude
+        self.queue = queue.Queue(size)
+
+    def wants(self, event):
+        """Returns True if the event concerns this rider"""
+        if event.audience is not None:
+            return event.audience == self.user_id
+        if event.creator == self.user_id:
+            return False
+
+        # Open pools go to riders living near their origin, or at the creator's place when either side has no coordinates
+        if self.latitude is not None and event.latitude is not None:
+            return haversine_km(self.latitude, self.longitude, event.latitude, event.longitude) <= RADIUS_KM
+        return self.place_id is not None and self.place_id == event.place_id
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # A client that stopped reading misses events rather than growing this worker's memory
+            pass
+
+
+class Bus:
+    """Publish/subscribe between request handlers and the streams open in this worker"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._listeners = {}
+        self._lock = threading.Lock()
+        # When shared, events go through the 'events' table so streams held by other workers see them too
+        self.shared = False
+        # Whether pages open streams at all, without them pool, invite and friend events are not published
+        self.streaming = False
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def listen(self, kind, callback):
+        """Hands every event of a kind, from any worker when the bus is shared, to callback(payload) instead of the
+        streams, replacing the kind's previous listener"""
+        with self._lock:
+            self._listeners[kind] = callback
+
+    def idle(self):
+        """Returns True when no stream is open and nothing listens, so events need not be relayed"""
+        return not self._subscribers and not self._listeners
+
+    def subscribe(self, user, size=QUEUE_SIZE):
+        """Opens a stream for a user record carrying id, place_id, latitude and longitude"""
+        subscriber = Subscriber(user, size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        """Sends an event to every interested stream, in every worker when the bus is shared"""
+        if self.shared:
+            repository.add_event(event.kind, event.audience, event.creator, event.place_id, event.latitude, event.longitude, json.dumps(event.payload), time.time())
+        else:
+            self.dispatch(event)
+
+    def publish_all(self, events):
+        """Sends several events, written in one transaction when the bus is shared"""
+        if not self.shared:
+            for event in events:
+                self.dispatch(event)
+            return
+        with database.transaction():
+            for event in events:
+                self.publish(event)
+
+    def dispatch(self, event):
+        """Hands an event to its kind's listener, or to the interested streams open in this worker"""
+        with self._lock:
+            listener = self._listeners.get(event.kind)
+            subscribers = list(self._subscribers)
+        if listener is not None:
+            listener(event.payload)
+            return
+        for subscriber in subscribers:
+            if subscriber.wants(event):
+                subscriber.deliver(event)
+
+
+class Relay(threading.Thread):
+    """Daemon thread that polls the 'events' table and dispatches rows written by any worker to this worker's streams"""
+
+    def __init__(self, bus, interval=POLL_INTERVAL, retention=RETENTION_SECONDS, logger=None):
+        super().__init__(name="event-relay", daemon=True)
+        self.bus = bus
+        self.interval = interval
+        self.retention = retention
+        self.logger = logger or logging.getLogger(__name__)
+        self._halt = threading.Event()
+
+    def run(self):
+        last_id = None
+        polls = 0
+        # The first poll runs at once, so a stream opened by the request that started the relay misses no event
+        wait = 0
+        while not self._halt.wait(wait):
+            wait = self.interval
+            try:
+                # With no stream open and no listener there is nobody to deliver to, so only skip ahead to the newest
+                # event
+                if last_id is None or self.bus.idle():
+                    last_id = repository.last_event_id()
+                else:
+                    for row in repository.events_since(last_id):
+                        last_id = row.id
+                        self.bus.dispatch(Event(row.kind, row.audience, row.creator, row.place_id, row.latitude, row.longitude, json.loads(row.payload)))
+
+                polls += 1
+                if polls % PURGE_EVERY == 0:
+                    repository.purge_events(time.time() - self.retention)
+            except Exception:
+                # A locked database or a failed poll is retried on the next tick
+                self.logger.exception("event relay poll failed, retrying in %s s", self.interval)
+            finally:
+                database.release()
+
+    def stop(self):
+        self._halt.set()
+
+
+bus = Bus()
+
+
+def init_app(app):
+    """Sets up the bus named by EVENTS_BACKEND: 'sqlite' (shared by all workers), with a relay thread the app starts
+    with its first request, or 'memory' (single worker). With EVENTS_STREAM off no page opens a stream, so pool,
+    invite and friend events are not published at all"""
+    bus.streaming = app.config.setdefault("EVENTS_STREAM", STREAM)
+    app.config.setdefault("EVENTS_STREAM_SECONDS", STREAM_SECONDS)
+    backend = app.config.setdefault("EVENTS_BACKEND", DEFAULT_BACKEND)
+    if backend == "memory":
+        bus.shared = False
+        return
+    if backend != "sqlite":
+        raise ValueError(f"unknown EVENTS_BACKEND {backend!r}")
+
+    bus.shared = True
+    app.extensions["event_relay"] = Relay(
+        bus,
+        app.config.get("EVENTS_POLL_INTERVAL", POLL_INTERVAL),
+        app.config.get("EVENTS_RETENTION_SECONDS", RETENTION_SECONDS),
+        app.logger,
+    )
+
+
+def stream(subscriber, heartbeat=HEARTBEAT_SECONDS, lifetime=STREAM_SECONDS):
+    """Yields the subscriber's events in text/event-stream format until the client goes away or lifetime seconds
+    have passed, when the browser reconnects on its own and the worker thread is free for other requests meanwhile"""
+    deadline = time.monotonic() + lifetime
+    try:
+        # Reconnect after 5 seconds if the connection drops or the stream ends
+        yield "retry: 5000\n\n"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = subscriber.queue.get(timeout=min(heartbeat, remaining))
+            except queue.Empty:
+                # A comment line keeps proxies from closing an idle connection and reveals clients that left
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event.kind}\ndata: {json.dumps(event.payload)}\n\n"
+    finally:
+        bus.unsubscribe(subscriber)
+
+
+def pool_created(creator_id, pool_id, origin, destination, origin_point, place_id):
+    """Announces a new pool to riders living near its origin, or at the creator's home place 'place_id'"""
+    if not bus.streaming:
+        return
+    creator = repository.users_by_ids([creator_id])[0]
+    payload = {"id": pool_id, "fullname": creator.fullname, "origin": origin, "destination": destination}
+    bus.publish(Event("pool", None, creator_id, place_id, *origin_point, payload))
+
+
+def friends_invited(creator_id, invited, origin, destination):
+    """Announces each invitation of {follower: pool id} to its friend, stored in one transaction for the relay"""
+    if not bus.streaming:
+        return
+    creator = repository.users_by_ids([creator_id])[0]
+    bus.publish_all(
+        Event("invite", follower, creator_id, None, None, None, {"id": pool_id, "fullname": creator.fullname, "origin": origin, "destination": destination})
+        for follower, pool_id in invited.items()
+    )
+
+
+def request_accepted(sender_id, receiver_id):
+    """Tells the sender of a friend request that it was accepted"""
+    if not bus.streaming:
+        return
+    receiver = repository.users_by_ids([receiver_id])[0]
+    bus.publish(Event("friend", sender_id, None, None, None, None, {"username": receiver.username, "fullname": receiver.fullname}))
+
+
+def session_deleted(sid):
+    """Tells every worker that a session was deleted, so none keeps serving it from its cache"""
+    bus.publish(Event("session", None, None, None, None, None, {"sid": sid}))
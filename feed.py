@@ -0,0 +1,131 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import geo
+import repository
+import scoring
+from fragment_cache import cache
+
+
+# Pools disappear from the homepage this long after they are created
+POOL_LIFETIME = timedelta(hours=2)
+
+# Most nearby pools listed on the homepage
+NEARBY_LIMIT = 50
+
+# Row shown in the "Nearby Pools" table, 'distance' is None when the user's address could not be geocoded
+NearbyPool = namedtuple("NearbyPool", "id username fullname bike phone origin destination distance")
+
+# Everything the homepage shows, 'recommended' is only filled in when the user says where they are heading
+Feed = namedtuple("Feed", "nearby invites recommended matches")
+
+
+def cutoff_time():
+    """Returns the creation timestamp before which pools are no longer live"""
+    return datetime.now().timestamp() - POOL_LIFETIME.total_seconds()
+
+
+def nearby_pools(user, cutoff, heading=None):
+    """Returns live pools near the user ranked by distance, one row per route"""
+
+    # Users whose address is not in the gazetteer keep the match on their home place
+    if user.latitude is None:
+        return [NearbyPool(*pool, None) for pool in repository.nearby_pools(user.id, cutoff)]
+
+    # Only the partition of the user's city is read and synced
+    index = geo.indexes[user.city_id]
+    index.sync(cutoff)
+    nearby = []
+    routes = set()
+    for distance, pool in index.nearby(user.latitude, user.longitude, cutoff, destination=heading):
+        route = (pool.origin_id, pool.destination_id)
+        if pool.creator == user.id or route in routes:
+            continue
+        routes.add(route)
+        nearby.append(NearbyPool(pool.id, pool.username, pool.fullname, pool.bike, pool.phone, pool.origin, pool.destination, distance))
+        if len(nearby) == NEARBY_LIMIT:
+            break
+    return nearby
+
+
+def recommended_pools(user, cutoff, heading):
+    """Returns the live pools best matching the user's trip from home to heading, best first"""
+    engine = scoring.engines[user.city_id]
+    engine.sync(cutoff)
+    ranked = engine.score(user.id, (user.latitude, user.longitude), heading, cutoff + POOL_LIFETIME.total_seconds())
+    if not ranked:
+        return []
+    pools = repository.pools_by_ids(pool_id for cost, pool_id in ranked)
+    return [pools[pool_id] for cost, pool_id in ranked if pool_id in pools]
+
+
+def expiry(pools):
+    """Returns when the first of the listed pools leaves the homepage, or None for an empty list"""
+    if not pools:
+        return None
+    return repository.earliest_pool_time(pool.id for pool in pools) + POOL_LIFETIME.total_seconds()
+
+
+def home_tag(user):
+    """Returns the cache tag of the area around the user's home, which pools created nearby invalidate"""
+    if user.latitude is None:
+        return "place:%s" % user.place_id
+    return "cell:%d:%d" % geo.cell(user.latitude, user.longitude)
+
+
+def cached_nearby(user_id, cutoff):
+    """Returns the user's nearby pools from the fragment cache, computing and storing them on a miss"""
+    key = f"nearby:{user_id}"
+    nearby = cache.get(key)
+    if nearby is None:
+        user = repository.user_location(user_id)
+        nearby = nearby_pools(user, cutoff)
+        cache.set(key, nearby, home_tag(user), expiry(nearby))
+    return nearby
+
+
+def cached_invites(user_id, cutoff):
+    """Returns the user's pool invitations from the fragment cache, computing and storing them on a miss"""
+    key = f"invites:{user_id}"
+    invites = cache.get(key)
+    if invites is None:
+        invites = repository.invited_pools(user_id, cutoff)
+        cache.set(key, invites, key, expiry(invites))
+    return invites
+
+
+def load_feed(user_id, destination=None):
+    """Returns the nearby pools, pool invitations, trip recommendations and ride matches shown on the homepage"""
+    cutoff = cutoff_time()
+    # Rewritten by the matcher every MATCH_INTERVAL, and a single indexed lookup, so never cached
+    matches = repository.matches_of_user(user_id, cutoff)
+
+    # The plain homepage only changes when pools are created nearby, the user is invited or a listed pool expires
+    if not destination:
+        return Feed(cached_nearby(user_id, cutoff), cached_invites(user_id, cutoff), [], matches)
+
+    user = repository.user_location(user_id)
+    invites = cached_invites(user_id, cutoff)
+    heading = geo.geocode(destination, user.city)
+    if heading[0] is None:
+        return Feed([], invites, [], matches)
+    recommended = recommended_pools(user, cutoff, heading) if user.latitude is not None else []
+    return Feed(nearby_pools(user, cutoff, heading), invites, recommended, matches)
+
+
+def pool_created(creator_id, city_id, origin_point, followers=()):
+    """Pulls newly stored pools into this worker's live pool indexes of the creator's city and drops the homepage
+    fragments they change, 'followers' being the friends invited to them"""
+    cutoff = cutoff_time()
+    geo.indexes[city_id].sync(cutoff)
+    scoring.engines[city_id].sync(cutoff)
+
+    if followers:
+        cache.invalidate(*(f"invites:{follower}" for follower in followers))
+        return
+
+    # Riders whose home lies within reach of the origin, and those matched by the creator's home place
+    tags = ["place:%s" % repository.user_location(creator_id).place_id]
+    if origin_point[0] is not None:
+        tags.extend("cell:%d:%d" % key for key in geo.cells_near(*origin_point))
+    cache.invalidate(*tags)
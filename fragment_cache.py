@@ -0,0 +1,207 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import database
+import repository
+
+
+# Defaults for the FEED_CACHE_* settings read by init_app()
+DEFAULT_TYPE = "sqlite"
+SIZE = 10000
+MAX_TTL = 300
+
+# The SQLite backend trims expired and surplus rows once every this many writes, and records a read of a fragment
+# only when its last recorded read is older than this many seconds, so eviction is least recently used to within it
+TRIM_EVERY = 100
+TOUCH_SECONDS = 30
+
+
+def encode(records):
+    """Serializes a list of records sharing one set of fields"""
+    if not records:
+        return "[]"
+    return json.dumps([records[0]._fields, [list(record) for record in records]])
+
+
+def decode(text):
+    """Rebuilds a list of records written by encode()"""
+    value = json.loads(text)
+    if not value:
+        return []
+    fields, rows = value
+    make = database.record_type(tuple(fields))._make
+    return [make(row) for row in rows]
+
+
+class MemoryBackend:
+    """Size-bounded LRU of fragments held by this process, only suited to single-worker deployments"""
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        # key -> (expiry, tag, value), with the least recently used key first
+        self._entries = OrderedDict()
+        # tag -> keys stored under it, so invalidating a tag never scans every entry
+        self._tags = {}
+        self._lock = threading.Lock()
+        self.expirations = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        expiry, tag, value = self._entries.pop(key)
+        keys = self._tags[tag]
+        keys.discard(key)
+        if not keys:
+            del self._tags[tag]
+
+    def get(self, key):
+        """Returns a live value, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                self.expirations += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value, expiry, tag):
+        """Stores a value until expiry or until its tag is invalidated, evicting the least recently used entries beyond
+        the size limit"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiry, tag, value)
+            self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        """Drops every entry stored under one of the tags and returns how many were dropped"""
+        with self._lock:
+            keys = [key for tag in tags for key in self._tags.get(tag, ())]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+
+class SQLiteBackend:
+    """Fragments in the 'fragments' table, shared by every worker. Storing a fragment never waits for the write lock:
+    when another connection is writing, the fragment is simply not stored and the next miss tries again"""
+
+    def __init__(self, size=SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.expirations = self.evictions = 0
+
+    def __len__(self):
+        return repository.fragment_count()
+
+    def get(self, key):
+        now = time.time()
+        row = repository.fragment(key, now)
+        if row is None:
+            return None
+        if row.accessed < now - TOUCH_SECONDS:
+            try:
+                with database.transaction(wait=False):
+                    repository.touch_fragment(key, now)
+            except database.Busy:
+                pass
+        return decode(row.value)
+
+    def set(self, key, value, expiry, tag):
+        now = time.time()
+        with self._lock:
+            self._writes += 1
+            trim = self._writes >= TRIM_EVERY
+            if trim:
+                self._writes = 0
+        try:
+            with database.transaction(wait=False):
+                repository.save_fragment(key, tag, encode(value), expiry, now)
+                if trim:
+                    expired, evicted = repository.trim_fragments(now, self.size)
+        except database.Busy:
+            return
+        if trim:
+            with self._lock:
+                self.expirations += expired
+                self.evictions += evicted
+
+    def invalidate(self, tags):
+        return repository.invalidate_fragments(tags)
+
+
+class FragmentCache:
+    """Rendered-data fragments with a per-entry expiry and tag-based invalidation, counting hits and misses. The
+    backends count the entries they expire and evict"""
+
+    def __init__(self, backend=None, max_ttl=MAX_TTL):
+        self.backend = backend
+        self.max_ttl = max_ttl
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = 0
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def get(self, key):
+        """Returns the cached value for key, or None when the cache is off, empty or stale"""
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        self._count("misses" if value is None else "hits")
+        return value
+
+    def set(self, key, value, tag, expiry=None):
+        """Caches a list of records under one invalidation tag, until expiry but never longer than max_ttl"""
+        if self.backend is None:
+            return
+        limit = time.time() + self.max_ttl
+        self.backend.set(key, value, limit if expiry is None else min(expiry, limit), tag)
+
+    def invalidate(self, *tags):
+        """Drops every fragment stored under any of the tags"""
+        if self.backend is None or not tags:
+            return
+        dropped = self.backend.invalidate(tags)
+        if dropped:
+            self._count("invalidations", dropped)
+
+    def stats(self):
+        """Returns the counters of this process and the number of cached fragments"""
+        with self._lock:
+            counters = {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
+        counters["expirations"] = self.backend.expirations if self.backend is not None else 0
+        counters["evictions"] = self.backend.evictions if self.backend is not None else 0
+        lookups = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / lookups if lookups else 0.0
+        counters["size"] = len(self.backend) if self.backend is not None else 0
+        return counters
+
+
+cache = FragmentCache()
+
+
+def init_app(app):
+    """Sets up the backend named by FEED_CACHE_TYPE: 'memory' (single worker), 'sqlite' (shared by all workers) or 'none'"""
+    backend = app.config.setdefault("FEED_CACHE_TYPE", DEFAULT_TYPE)
+    size = app.config.setdefault("FEED_CACHE_SIZE", SIZE)
+    cache.max_ttl = app.config.setdefault("FEED_CACHE_MAX_TTL", MAX_TTL)
+    if backend == "memory":
+        cache.backend = MemoryBackend(size)
+    elif backend == "sqlite":
+        cache.backend = SQLiteBackend(size)
+    elif backend == "none":
+        cache.backend = None
+    else:
+        raise ValueError(f"unknown FEED_CACHE_TYPE {backend!r}")
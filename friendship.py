@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+import database
+import repository
+
+
+# Number of users whose friend sets are kept in memory, and how long another worker's accept may go unseen. Only
+# pages listing friends read them, permissions are checked against the database
+CACHE_SIZE = 4096
+CACHE_TTL = 60
+
+# People you may know listed on the friends page
+SUGGESTION_LIMIT = 10
+
+# Users living closest to a new or moved user, suggested to them and they to the user even without mutual friends
+NEIGHBOUR_LIMIT = SUGGESTION_LIMIT
+
+# Friends with more friends than this are not counted as mutual friends: knowing the same very popular user says
+# little, and each of them would add a suggestion for every pair of their friends
+CONNECTOR_LIMIT = 50
+
+
+class FriendGraph:
+    """LRU cache of a set of user ids per user, by default each user's accepted friends, loaded on a miss"""
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL, load=repository.friend_ids):
+        self.load = load
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def friends(self, user_id):
+        """Returns the ids of the user's friends as a frozenset"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+
+        friends = frozenset(self.load(user_id))
+        with self._lock:
+            self._entries[user_id] = (now + self.ttl, friends)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return friends
+
+    def invalidate(self, *user_ids):
+        """Drops the cached friend sets of the given users"""
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drops every cached friend set"""
+        with self._lock:
+            self._entries.clear()
+
+
+def _circle(user_id):
+    """Returns the ids of the user's friends and their friends, leaving out the user"""
+    friends = graph.friends(user_id)
+    if not friends:
+        return friends
+    return (friends | frozenset(repository.friends_of(friends))) - {user_id}
+
+
+graph = FriendGraph()
+# Friends of friends change with any accept among the user's friends, so apart from the user's own accepts they are
+# left to expire with the TTL
+circles = FriendGraph(load=_circle)
+
+
+def circle(user_id):
+    """Returns the ids of the user's friends and friends of friends"""
+    return circles.friends(user_id)
+
+
+def friend_profiles(user_id):
+    """Returns the profile of every friend of the user, fetched in a single query"""
+    friends = graph.friends(user_id)
+    if not friends:
+        return []
+    return repository.users_by_ids(friends)
+
+
+def suggestions(user_id, limit=SUGGESTION_LIMIT):
+    """Returns the users the user may know, with their mutual friend count and how close they live, best first"""
+    return repository.suggestions(user_id, limit)
+
+
+def add_neighbours(user_id):
+    """Suggests the users living closest to a new user, and the user to them"""
+    repository.add_neighbours(user_id, NEIGHBOUR_LIMIT)
+
+
+def _befriend(user_id, friend_id):
+    """Updates the suggestions of two users who just became friends, and of everyone they now connect"""
+    repository.drop_suggestion(user_id, friend_id)
+    for friend, connector in ((user_id, friend_id), (friend_id, user_id)):
+        count = repository.friend_count(connector)
+        if count <= CONNECTOR_LIMIT:
+            repository.add_mutual_friend(friend, connector)
+        elif count == CONNECTOR_LIMIT + 1:
+            # Just grew past the limit, its earlier friends stop counting it
+            repository.drop_connector(connector, friend)
+
+
+def answer_request(sender, receiver, option):
+    """Accepts or rejects a pending friend request and refreshes both users' friend sets and suggestions"""
+    if option == "accept":
+        with database.transaction():
+            # Users already friends through a request the other way round gain nothing new
+            if repository.answer_friend_request(sender, receiver, "accepted"):
+                reverse = repository.friend_request(receiver, sender)
+                if reverse is None or reverse.status != "accepted":
+                    _befriend(sender, receiver)
+    elif option == "reject":
+        repository.answer_friend_request(sender, receiver, "rejected")
+    else:
+        return
+    graph.invalidate(sender, receiver)
+    circles.invalidate(sender, receiver)
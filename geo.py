@@ -0,0 +1,171 @@
+import csv
+import math
+import os
+import re
+import threading
+from collections import deque
+
+import repository
+from partitions import Partitions
+
+
+# Offline gazetteer of place names shipped with the app
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.csv")
+
+# Riders within this distance of a pool's origin (and of its destination, when given) count as nearby
+RADIUS_KM = 3.0
+
+# Side of one grid cell in degrees of latitude, about 2.2 km
+CELL_DEGREES = 0.02
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Returns the great-circle distance between two points in kilometres"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def normalize(text):
+    """Lowercases text and collapses everything but letters and digits into single spaces"""
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+
+class Gazetteer:
+    """Maps place names found inside free-text addresses to coordinates"""
+
+    def __init__(self, path=GAZETTEER_PATH):
+        # Places indexed by the first word of their name, so matching an address only looks at candidates sharing a word with it
+        self._by_first_word = {}
+        self._cities = {}
+        with open(path, newline="") as file:
+            for row in csv.DictReader(file):
+                name = normalize(row["name"])
+                city = normalize(row["city"])
+                point = (float(row["latitude"]), float(row["longitude"]))
+                self._by_first_word.setdefault(name.split()[0], []).append((name.split(), city, point, name == city))
+                if name == city:
+                    self._cities[city] = point
+
+    def geocode(self, text, city=None):
+        """Returns (latitude, longitude) of the most specific place named in text, or of the city, or None"""
+        words = normalize(text).split()
+        city = normalize(city)
+        matches = []
+        for start, word in enumerate(words):
+            for name, place_city, point, is_city in self._by_first_word.get(word, ()):
+                if words[start:start + len(name)] == name:
+                    matches.append((len(name), place_city, point, is_city))
+
+        # A place in another city only counts when the text names that city too, so "Sector 5" in Mhow
+        # is not mistaken for the one in Kolkata
+        mentioned = {match[1] for match in matches if match[3]}
+        matches = [match for match in matches if match[1] == city or match[1] in mentioned or city not in self._cities]
+        if matches:
+            return max(matches, key=lambda match: (match[1] == city, match[0]))[2]
+        return self._cities.get(city)
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def gazetteer():
+    """Returns the shared gazetteer, loading it on first use"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer()
+    return _gazetteer
+
+
+def geocode(text, city=None):
+    """Returns (latitude, longitude) for free text, or (None, None) when no place is recognised"""
+    return gazetteer().geocode(text, city) or (None, None)
+
+
+def cell(latitude, longitude):
+    """Returns the (row, column) of the grid cell holding a point"""
+    return (math.floor(latitude / CELL_DEGREES), math.floor(longitude / CELL_DEGREES))
+
+
+def cells_near(latitude, longitude, radius_km=RADIUS_KM):
+    """Returns every grid cell overlapping the box of radius_km around a point"""
+    lat_span = radius_km / KM_PER_DEGREE
+    lon_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+    low_row, low_col = cell(latitude - lat_span, longitude - lon_span)
+    high_row, high_col = cell(latitude + lat_span, longitude + lon_span)
+    return [(row, col) for row in range(low_row, high_row + 1) for col in range(low_col, high_col + 1)]
+
+
+class GridIndex:
+    """Uniform-grid spatial index over the live pools of one city, or of every city when city_id is None, keyed by
+    the cell of each pool's origin"""
+
+    def __init__(self, city_id=None):
+        self.city_id = city_id
+        self._cells = {}
+        # Indexed pools in id order, which is also creation order, so expired pools are always at the left
+        self._order = deque()
+        self._lock = threading.Lock()
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self._order)
+
+    def add(self, pool):
+        """Indexes one pool record carrying id, follower, time and origin/destination coordinates"""
+        with self._lock:
+            if pool.id <= self.last_id:
+                return
+            self.last_id = pool.id
+            # Private invitations are listed separately on the homepage, only pools open to everyone are indexed
+            if pool.follower is not None or pool.origin_latitude is None or pool.destination_latitude is None:
+                return
+            self._cells.setdefault(cell(pool.origin_latitude, pool.origin_longitude), []).append(pool)
+            self._order.append(pool)
+
+    def expire(self, cutoff):
+        """Drops pools created at or before the cutoff"""
+        with self._lock:
+            while self._order and self._order[0].time <= cutoff:
+                pool = self._order.popleft()
+                key = cell(pool.origin_latitude, pool.origin_longitude)
+                pools = self._cells[key]
+                pools.remove(pool)
+                if not pools:
+                    del self._cells[key]
+
+    def sync(self, cutoff):
+        """Pulls pools created in the index's city since the last sync, in any worker, and drops expired ones"""
+        for pool in repository.live_pools_since(self.last_id, cutoff, self.city_id):
+            self.add(pool)
+        self.expire(cutoff)
+
+    def nearby(self, latitude, longitude, cutoff, radius_km=RADIUS_KM, destination=None):
+        """Returns (distance_km, pool) for live pools starting within radius_km, nearest first
+
+        When destination is a (latitude, longitude) pair only pools ending within radius_km of it are kept.
+        """
+        results = []
+        with self._lock:
+            for key in cells_near(latitude, longitude, radius_km):
+                for pool in self._cells.get(key, ()):
+                    if pool.time <= cutoff:
+                        continue
+                    distance = haversine_km(latitude, longitude, pool.origin_latitude, pool.origin_longitude)
+                    if distance > radius_km:
+                        continue
+                    if destination is not None:
+                        if haversine_km(destination[0], destination[1], pool.destination_latitude, pool.destination_longitude) > radius_km:
+                            continue
+                    results.append((distance, pool))
+        results.sort(key=lambda result: (result[0], result[1].id))
+        return results
+
+
+indexes = Partitions(GridIndex)
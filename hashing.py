@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import database
+import repository
+
+
+# Defaults for the PASSWORD_HASH_* settings read by init_app()
+HASH_METHOD = "pbkdf2:sha256:600000"
+WORKERS = os.cpu_count() or 2
+MAX_PENDING = 4 * WORKERS
+TIMEOUT = 30
+
+
+class HashingBusy(Exception):
+    """Raised instead of queueing when too many hashes are already waiting for a worker process"""
+
+
+class PasswordHasher:
+    """Runs password hashing in a bounded process pool so request threads are never stuck behind PBKDF2"""
+
+    def __init__(self, method=HASH_METHOD, workers=WORKERS, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        self._executor = None
+        self._lock = threading.Lock()
+        self.configure(method, workers, max_pending, timeout)
+
+    def configure(self, method=HASH_METHOD, workers=WORKERS, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        """Sets the hash method, pool size and queue depth, restarting the pool if it was running"""
+        self.shutdown()
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _pool(self):
+        # Started on first use, so each gunicorn worker gets its own pool after forking
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _submit(self, fn, *args):
+        """Queues work on the pool, raising HashingBusy at once when every slot is taken"""
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        return future
+
+    def hash(self, password):
+        """Returns a hash of the password made with the configured method"""
+        return self._submit(generate_password_hash, password, self.method).result(self.timeout)
+
+    def verify(self, hash, password):
+        """Returns True if the password matches the stored hash"""
+        return self._submit(check_password_hash, hash, password).result(self.timeout)
+
+    def needs_rehash(self, hash):
+        """Returns True if the hash was made with another method or a lower cost than the configured one"""
+        stored = hash.split("$", 1)[0]
+        if stored == self.method:
+            return False
+
+        # 'pbkdf2:sha256:260000' against 'pbkdf2:sha256:600000' only differs in its iteration count
+        stored, wanted = stored.split(":"), self.method.split(":")
+        if len(stored) == len(wanted) == 3 and stored[0] == "pbkdf2" and stored[:2] == wanted[:2]:
+            return int(stored[2]) < int(wanted[2])
+        return True
+
+    def rehash_later(self, user_id, hash, password):
+        """Re-hashes a user's password with the current cost in the background after a successful log-in"""
+        try:
+            future = self._submit(generate_password_hash, password, self.method)
+        except HashingBusy:
+            # Another log-in will try again once the pool has room
+            return
+
+        def store(future):
+            if future.exception() is not None:
+                return
+            try:
+                # Only replace the hash that was verified, a password changed in the meantime wins
+                repository.replace_password_hash(user_id, hash, future.result())
+            finally:
+                database.release()
+
+        future.add_done_callback(store)
+
+    def shutdown(self):
+        """Stops the worker processes, the next hash starts a new pool"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    """Configures the shared hasher from PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS and PASSWORD_HASH_MAX_PENDING"""
+    hasher.configure(
+        app.config.setdefault("PASSWORD_HASH_METHOD", HASH_METHOD),
+        app.config.setdefault("PASSWORD_HASH_WORKERS", WORKERS),
+        app.config.setdefault("PASSWORD_HASH_MAX_PENDING", MAX_PENDING),
+    )
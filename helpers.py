@@ -1,3 +1,4 @@
+import math
 import os
 import requests
 import urllib.parse
@@ -5,6 +6,8 @@ import urllib.parse
 from flask import redirect, render_template, request, session
 from functools import wraps
 
+from ratelimit import limiter
+
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -47,6 +50,29 @@ def login_required(f):
     return decorated_function
 
 
+def rate_limited(endpoint):
+    """
+    Decorate routes to throttle form submissions with the endpoint's per-user and per-address buckets.
+
+    Answers 429 with Retry-After once a bucket is empty, GET requests are never limited.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == "POST":
+                wait = limiter.check(endpoint, session.get("user_id"), request.remote_addr)
+                if wait:
+                    seconds = math.ceil(wait)
+                    message, code = apology(f"too many requests, try again in {seconds} s", 429)
+                    return message, code, {"Retry-After": str(seconds)}
+            return f(*args, **kwargs)
+
+        return decorated_function
+
+    return decorator
+
+
 def lookup(symbol):
     """Look up quote for symbol."""
 
@@ -71,6 +97,12 @@ def lookup(symbol):
         return None
 
 
+def day_month_year(value):
+    """Format a YYYY-MM-DD date as DD/MM/YYYY."""
+    year, month, day = value.split("-")
+    return f"{day}/{month}/{year}"
+
+
 def usd(value):
     """Format value as USD."""
     return f"${value:,.2f}"
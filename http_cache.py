@@ -0,0 +1,83 @@
+import hashlib
+import os
+import threading
+
+from flask import request, url_for
+from werkzeug.security import safe_join
+
+
+# Fingerprinted static URLs never change content, so browsers may keep them for a year without asking again
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# Characters of the content hash put into static URLs
+FINGERPRINT_LENGTH = 12
+
+
+class Fingerprints:
+    """Content hashes of static files, recomputed only when a file's modification time changes"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Returns the fingerprint of a file in the static folder, or None if there is no such file"""
+        path = safe_join(self.folder, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+        cached = self._hashes.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with open(path, "rb") as file:
+            fingerprint = hashlib.sha256(file.read()).hexdigest()[:FINGERPRINT_LENGTH]
+        with self._lock:
+            self._hashes[filename] = (mtime, fingerprint)
+        return fingerprint
+
+
+def init_app(app):
+    """Installs the caching policy for every response and the 'static_url' template helper"""
+    fingerprints = Fingerprints(app.static_folder)
+    max_age = app.config.setdefault("STATIC_MAX_AGE", STATIC_MAX_AGE)
+
+    def static_url(filename):
+        """Returns the URL of a static file carrying its content hash, so a changed file gets a new URL"""
+        return url_for("static", filename=filename, v=fingerprints.get(filename))
+
+    app.jinja_env.globals["static_url"] = static_url
+
+    @app.after_request
+    def apply_policy(response):
+        """Sets Cache-Control by kind of response: immutable static files, revalidated JSON and uncached pages"""
+        if request.endpoint == "static":
+            # Only the URL carrying the current hash may be cached forever, others revalidate with the file's ETag
+            if request.args.get("v") and request.args.get("v") == fingerprints.get(request.view_args["filename"]):
+                # send_file() marks every file no-cache unless told otherwise
+                response.cache_control.no_cache = None
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+                response.cache_control.immutable = True
+            else:
+                response.cache_control.no_cache = True
+            return response
+
+        if response.mimetype == "text/event-stream":
+            response.cache_control.no_cache = True
+            return response
+
+        if response.is_json and response.status_code == 200:
+            # Each user sees their own data, which the browser may keep but must revalidate, answered with 304 when unchanged
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.add_etag(weak=True)
+            return response.make_conditional(request)
+
+        # Pages show the logged-in user's data and must never be stored
+        response.headers["Cache-Control"] = "private, no-cache, no-store, must-revalidate"
+        response.headers["Expires"] = 0
+        response.headers["Pragma"] = "no-cache"
+        return response
@@ -0,0 +1,248 @@
+import bisect
+import hmac
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import has_request_context, request
+
+import database
+
+
+# Defaults for the SQL_* settings read by init_app()
+SLOW_SECONDS = 0.1
+REPEAT_LIMIT = 5
+STATEMENT_LIMIT = 100
+
+# Label of the statements seen after STATEMENT_LIMIT distinct ones, so a stream of one-off statements cannot grow the
+# metrics without bound
+OTHER_STATEMENTS = "other"
+
+# Upper bounds of the histogram buckets, in seconds and in statements per request
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+# String and number literals, replaced so statements differing only in inlined values share a fingerprint, the
+# digits of numbered parameters such as ?1 are left alone
+LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![?\w])\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+
+# Fingerprints kept per distinct SQL text, the statements are constants so this stays small
+FINGERPRINT_CACHE_SIZE = 10000
+
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """Returns the statement with literals replaced by '?' and whitespace collapsed"""
+    value = _fingerprints.get(sql)
+    if value is None:
+        value = WHITESPACE.sub(" ", LITERALS.sub("?", sql)).strip()
+        if len(_fingerprints) < FINGERPRINT_CACHE_SIZE:
+            _fingerprints[sql] = value
+    return value
+
+
+def _label(value):
+    """Escapes a Prometheus label value"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values, per set of label values"""
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self.series = {}
+
+    def observe(self, values, amount):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, amount)] += 1
+        series[-1] += amount
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.description}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for values, series in sorted(self.series.items()):
+            labels = ",".join(f'{name}="{_label(value)}"' for name, value in zip(self.labels, values))
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {total}")
+
+
+class CounterMetric:
+    """Monotonic totals per set of label values"""
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.series = Counter()
+
+    def add(self, values, amount=1):
+        self.series[values] += amount
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.description}")
+        lines.append(f"# TYPE {self.name} counter")
+        for values, total in sorted(self.series.items()):
+            labels = ",".join(f'{name}="{_label(value)}"' for name, value in zip(self.labels, values))
+            lines.append(f"{self.name}{{{labels}}} {total}")
+
+
+class RequestStats:
+    """Statements run while handling one request"""
+
+    __slots__ = ("started", "endpoint", "statements")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.endpoint = "unmatched"
+        # (sql, seconds) in the order they ran
+        self.statements = []
+
+
+class Metrics:
+    """This process's request and statement metrics, merged once per request to keep the per-statement cost low"""
+
+    def __init__(self, slow_seconds=SLOW_SECONDS, repeat_limit=REPEAT_LIMIT, statement_limit=STATEMENT_LIMIT, logger=None):
+        self.slow_seconds = slow_seconds
+        self.repeat_limit = repeat_limit
+        self.statement_limit = statement_limit
+        self.logger = logger
+        # Scrapers must send it as a bearer token, None keeps the metrics private
+        self.token = None
+        # Statements given their own label so far
+        self._labelled = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.request_seconds = Histogram("http_request_duration_seconds", "Time spent handling a request.", ("endpoint",), SECONDS_BUCKETS)
+        self.request_queries = Histogram("db_queries_per_request", "SQL statements run by one request.", ("endpoint",), COUNT_BUCKETS)
+        self.request_db_seconds = Histogram("db_time_per_request_seconds", "Time one request spent in SQL statements.", ("endpoint",), SECONDS_BUCKETS)
+        self.statement_seconds = Histogram("db_statement_duration_seconds", "Time spent in one SQL statement.", ("statement",), SECONDS_BUCKETS)
+        self.slow = CounterMetric("db_slow_statements_total", "SQL statements slower than the slow-query threshold.", ("statement",))
+        self.repeated = CounterMetric("db_repeated_statements_total", "Requests running one statement more times than the repeat limit.", ("endpoint", "statement"))
+
+    def _statement(self, statement):
+        """Returns the label a statement fingerprint is reported under, called with the lock held"""
+        if statement in self._labelled:
+            return statement
+        if len(self._labelled) < self.statement_limit:
+            self._labelled.add(statement)
+            return statement
+        return OTHER_STATEMENTS
+
+    def authorized(self, header):
+        """Returns True when the Authorization header carries the configured token"""
+        if not self.token or not header:
+            return False
+        return hmac.compare_digest(header.encode(), f"Bearer {self.token}".encode())
+
+    def begin(self):
+        """Starts collecting the statements of the current thread's request"""
+        self._local.stats = RequestStats()
+
+    def name(self, endpoint):
+        """Sets the endpoint the current thread's request is reported under"""
+        stats = getattr(self._local, "stats", None)
+        if stats is not None and endpoint:
+            stats.endpoint = endpoint
+
+    def observe(self, sql, seconds):
+        """Records one statement, called by the database module"""
+        stats = getattr(self._local, "stats", None)
+        if seconds >= self.slow_seconds:
+            statement = fingerprint(sql)
+            with self._lock:
+                self.slow.add((self._statement(statement),))
+            if self.logger is not None:
+                endpoint = request.endpoint if has_request_context() else "background"
+                self.logger.warning("slow SQL statement in %s took %.1f ms: %s", endpoint, seconds * 1e3, statement)
+        if stats is not None:
+            stats.statements.append((sql, seconds))
+            return
+        # Statements run outside a request, e.g. by background threads, only count towards statement timings
+        with self._lock:
+            self.statement_seconds.observe((self._statement(fingerprint(sql)),), seconds)
+
+    def end(self):
+        """Merges the current thread's request into the histograms and flags statements repeated too often"""
+        stats = getattr(self._local, "stats", None)
+        if stats is None:
+            return None
+        self._local.stats = None
+        elapsed = time.perf_counter() - stats.started
+        endpoint = stats.endpoint
+        statements = [(fingerprint(sql), seconds) for sql, seconds in stats.statements]
+        repeats = Counter(statement for statement, seconds in statements)
+        repeated = [(statement, count) for statement, count in repeats.items() if count > self.repeat_limit]
+
+        with self._lock:
+            self.request_seconds.observe((endpoint,), elapsed)
+            self.request_queries.observe((endpoint,), len(statements))
+            self.request_db_seconds.observe((endpoint,), sum(seconds for statement, seconds in statements))
+            for statement, seconds in statements:
+                self.statement_seconds.observe((self._statement(statement),), seconds)
+            for statement, count in repeated:
+                self.repeated.add((endpoint, self._statement(statement)))
+
+        if self.logger is not None:
+            for statement, count in repeated:
+                self.logger.warning("%s ran the same SQL statement %d times, likely an N+1 query: %s", endpoint, count, statement)
+        return len(statements)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for metric in (self.request_seconds, self.request_queries, self.request_db_seconds, self.statement_seconds, self.slow, self.repeated):
+                metric.render(lines)
+        return "\n".join(lines) + "\n"
+
+    def queries(self):
+        """Returns the total number of statements run by requests so far"""
+        with self._lock:
+            return int(sum(series[-1] for series in self.request_queries.series.values()))
+
+
+metrics = Metrics()
+
+
+def init_app(app):
+    """Times every request and its SQL statements when SQL_INSTRUMENTATION is on, for the /metrics endpoint, which only
+    answers scrapers sending METRICS_TOKEN"""
+    enabled = app.config.setdefault("SQL_INSTRUMENTATION", True)
+    metrics.slow_seconds = app.config.setdefault("SQL_SLOW_SECONDS", SLOW_SECONDS)
+    metrics.repeat_limit = app.config.setdefault("SQL_REPEAT_LIMIT", REPEAT_LIMIT)
+    metrics.statement_limit = app.config.setdefault("SQL_STATEMENT_LIMIT", STATEMENT_LIMIT)
+    metrics.token = app.config.setdefault("METRICS_TOKEN", None)
+    metrics.logger = app.logger
+    if not enabled:
+        return
+    database.observer = metrics.observe
+
+    # Wrap the whole WSGI call, so loading and saving the session are counted with the request
+    wsgi_app = app.wsgi_app
+
+    def instrumented(environ, start_response):
+        metrics.begin()
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            metrics.end()
+
+    app.wsgi_app = instrumented
+
+    @app.teardown_request
+    def name_request(exception):
+        metrics.name(request.endpoint)
@@ -0,0 +1,361 @@
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import namedtuple
+
+import click
+import numpy as np
+
+import accounts
+import database
+import geo
+import repository
+from feed import cutoff_time
+from migrations import db_cli
+
+
+# Default for the MATCH_INTERVAL setting read by init_app(), in seconds
+INTERVAL = 60.0
+
+# A rider is only matched with a bike owner leaving within this distance of the rider's origin, heading to within
+# DESTINATION_KM of the rider's destination, and leaving at most MAX_WAIT_SECONDS before or after the rider
+ORIGIN_KM = geo.RADIUS_KM
+DESTINATION_KM = geo.RADIUS_KM
+MAX_WAIT_SECONDS = 30 * 60
+
+# A pairing costs one point per kilometre the two trips' origins and destinations lie apart, plus this many per
+# minute between their departures
+WAIT_COST_PER_MINUTE = 0.1
+
+# Bound on the cost of any pairing within the limits above
+MAX_COST = ORIGIN_KM + DESTINATION_KM + WAIT_COST_PER_MINUTE * MAX_WAIT_SECONDS / 60 + 1
+
+# Cheapest bike owners kept per rider, the greedy pass never needs more than a rider's first few choices
+CANDIDATES = 16
+
+# Groups of riders and owners that only compete among themselves are matched optimally up to this many on the
+# larger side, bigger ones greedily
+OPTIMAL_SIZE = 24
+
+# Riders handled per vectorised block while looking for candidates, bounding the size of the distance matrices
+BLOCK_ROWS = 512
+
+# Offers near a group of riders are sorted by the band of latitude, this many kilometres wide, their destination
+# falls in, so a rider's compatible offers lie in the BAND_REACH bands either side of its own
+BAND_KM = DESTINATION_KM / 2
+BAND_REACH = math.ceil(DESTINATION_KM / BAND_KM)
+
+# Bike entries of users who cannot give a ride
+WITHOUT_BIKE = ("NOT OWNED", accounts.NOT_AVAILABLE)
+
+# One side of a possible match: the latest live open pool of a rider or of a bike owner
+Trip = namedtuple("Trip", "pool_id user_id time origin destination")
+
+# A proposed pairing of a rider's pool with a bike owner's pool
+Match = namedtuple("Match", "request offer origin_km destination_km wait_seconds cost")
+
+# Fields of the possible pairings of requests[rider] with offers[owner] found by candidates(), kept as plain tuples
+# since a batch has hundreds of thousands of them
+EDGE_FIELDS = ("cost", "rider", "owner", "origin_km", "destination_km", "wait_seconds")
+
+
+def owns_bike(bike):
+    """Returns whether a user's bike entry says they have one to ride"""
+    return bool(bike) and bike.strip().upper() not in WITHOUT_BIKE
+
+
+def split(pools):
+    """Returns (requests, offers) as Trips from live pool records carrying the creator's bike, one per creator
+
+    Private invitations and pools without coordinates are left out, and a creator with several live pools is only
+    matched on the latest.
+    """
+    latest = {}
+    for pool in pools:
+        if pool.follower is not None or pool.origin_latitude is None or pool.destination_latitude is None:
+            continue
+        if pool.creator not in latest or pool.id > latest[pool.creator].id:
+            latest[pool.creator] = pool
+    requests, offers = [], []
+    for pool in sorted(latest.values(), key=lambda pool: pool.id):
+        trip = Trip(pool.id, pool.creator, pool.time, (pool.origin_latitude, pool.origin_longitude), (pool.destination_latitude, pool.destination_longitude))
+        (offers if owns_bike(pool.bike) else requests).append(trip)
+    return requests, offers
+
+
+def _planar_km(points, centre):
+    """Returns (east, north) kilometres of (latitude, longitude) degree points from a centre, accurate at city scale"""
+    scale = np.array((geo.KM_PER_DEGREE, geo.KM_PER_DEGREE * math.cos(math.radians(centre[0]))))
+    return (points - np.array(centre)) * scale
+
+
+def _slices(low, high):
+    """Returns (i, j) pairing each row i with every position j in low[i]:high[i], in row order"""
+    counts = high - low
+    rows = np.repeat(np.arange(len(counts)), counts)
+    starts = np.repeat(low - (np.cumsum(counts) - counts), counts)
+    return rows, np.arange(len(rows)) + starts
+
+
+def candidates(requests, offers, limit=CANDIDATES):
+    """Returns (cost, rider, owner, origin_km, destination_km, wait_seconds) edges between each request and its
+    cheapest compatible offers, in (rider, cost) order
+
+    Offers are bucketed by the grid cell of their origin. Within the cells around a group of riders they are sorted
+    by the band of latitude their destination falls in and then by departure time, so each rider is only paired with
+    the slices of offers heading to a nearby band and leaving within MAX_WAIT_SECONDS. The pairs are then filtered
+    by distance in vectorised passes.
+    """
+    if not requests or not offers:
+        return []
+    # Times relative to the earliest trip, and a band's key range wider than any time span in the batch
+    epoch = min(min(trip.time for trip in requests), min(trip.time for trip in offers))
+    request_origins = np.array([trip.origin for trip in requests])
+    request_destinations = np.array([trip.destination for trip in requests])
+    request_times = np.array([trip.time for trip in requests]) - epoch
+    offer_origins = np.array([trip.origin for trip in offers])
+    offer_destinations = np.array([trip.destination for trip in offers])
+    offer_times = np.array([trip.time for trip in offers]) - epoch
+    band_span = 2 * (max(request_times.max(), offer_times.max()) + MAX_WAIT_SECONDS) + 1
+    # A destination within DESTINATION_KM north or south lies at most this many bands away
+    bands = np.arange(-BAND_REACH, BAND_REACH + 1)
+
+    by_cell = {}
+    for position, trip in enumerate(offers):
+        by_cell.setdefault(geo.cell(*trip.origin), []).append(position)
+    riders_by_cell = {}
+    for position, trip in enumerate(requests):
+        riders_by_cell.setdefault(geo.cell(*trip.origin), []).append(position)
+
+    # From anywhere in a cell, offers within ORIGIN_KM start at most ORIGIN_KM plus half the cell's diagonal from its centre
+    reach_km = ORIGIN_KM + geo.CELL_DEGREES * geo.KM_PER_DEGREE / math.sqrt(2)
+    columns = [[] for _ in EDGE_FIELDS]
+    for (row, column), riders in sorted(riders_by_cell.items()):
+        centre = ((row + 0.5) * geo.CELL_DEGREES, (column + 0.5) * geo.CELL_DEGREES)
+        nearby = np.array([position for key in geo.cells_near(*centre, reach_km) for position in by_cell.get(key, ())], dtype=np.int64)
+        if not len(nearby):
+            continue
+        nearby_destinations = _planar_km(offer_destinations[nearby], centre)
+        keys = np.floor(nearby_destinations[:, 0] / BAND_KM) * band_span + offer_times[nearby]
+        # Stable, so offers with equal keys stay in id order
+        order = np.argsort(keys, kind="stable")
+        nearby, keys, nearby_destinations = nearby[order], keys[order], nearby_destinations[order]
+        nearby_origins = _planar_km(offer_origins[nearby], centre)
+        nearby_times = offer_times[nearby]
+        for start in range(0, len(riders), BLOCK_ROWS):
+            block = np.array(riders[start:start + BLOCK_ROWS])
+            origins = _planar_km(request_origins[block], centre)
+            destinations = _planar_km(request_destinations[block], centre)
+            times = request_times[block]
+            # One slice per rider and nearby band, of the offers in that band leaving within MAX_WAIT_SECONDS
+            lowest = (np.floor(destinations[:, 0] / BAND_KM)[:, None] + bands) * band_span + times[:, None]
+            i, j = _slices(
+                np.searchsorted(keys, (lowest - MAX_WAIT_SECONDS).ravel(), "left"),
+                np.searchsorted(keys, (lowest + MAX_WAIT_SECONDS).ravel(), "right"),
+            )
+            i //= len(bands)
+            # Squared distances to filter, the square root is only taken for the pairs kept
+            north, east = destinations[i, 0] - nearby_destinations[j, 0], destinations[i, 1] - nearby_destinations[j, 1]
+            close = north * north + east * east <= DESTINATION_KM ** 2
+            i, j = i[close], j[close]
+            north, east = origins[i, 0] - nearby_origins[j, 0], origins[i, 1] - nearby_origins[j, 1]
+            close = north * north + east * east <= ORIGIN_KM ** 2
+            i, j = i[close], j[close]
+            origin_km = np.hypot(north[close], east[close])
+            destination_km = np.hypot(destinations[i, 0] - nearby_destinations[j, 0], destinations[i, 1] - nearby_destinations[j, 1])
+            wait = np.abs(times[i] - nearby_times[j])
+            cost = origin_km + destination_km + wait * (WAIT_COST_PER_MINUTE / 60)
+
+            # Each rider's cheapest offers, sorting on one key as costs never reach MAX_COST
+            order = np.argsort(i * MAX_COST + cost, kind="stable")
+            i = i[order]
+            first = np.flatnonzero(np.concatenate(([True], i[1:] != i[:-1])))
+            rank = np.arange(len(i)) - np.repeat(first, np.diff(np.append(first, len(i))))
+            keep = order[rank < limit]
+            for values, collected in zip((cost[keep], block[i[rank < limit]], nearby[j[keep]], origin_km[keep], destination_km[keep], wait[keep]), columns):
+                collected.extend(values.tolist())
+    return list(zip(*columns))
+
+
+def greedy(edges):
+    """Returns the edges taken by repeatedly pairing the cheapest rider and owner both still free"""
+    # Edges order by cost first, then rider and owner, so ties are broken the same way on every run
+    queue = list(edges)
+    heapq.heapify(queue)
+    taken, riders, owners = [], set(), set()
+    while queue:
+        edge = heapq.heappop(queue)
+        cost, rider, owner = edge[:3]
+        if rider in riders or owner in owners:
+            continue
+        riders.add(rider)
+        owners.add(owner)
+        taken.append(edge)
+    return taken
+
+
+def assignment(cost):
+    """Returns the column assigned to each row of a cost matrix with no more rows than columns, minimising the total
+
+    The Hungarian method with potentials, O(rows^2 * columns).
+    """
+    rows, columns = len(cost), len(cost[0])
+    u = [0.0] * (rows + 1)
+    v = [0.0] * (columns + 1)
+    # owner[j] is the row assigned to column j, 1-based with 0 meaning none
+    owner = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for row in range(1, rows + 1):
+        owner[0] = row
+        column = 0
+        least = [math.inf] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[column] = True
+            current = owner[column]
+            delta, next_column = math.inf, 0
+            costs = cost[current - 1]
+            for j in range(1, columns + 1):
+                if used[j]:
+                    continue
+                reduced = costs[j - 1] - u[current] - v[j]
+                if reduced < least[j]:
+                    least[j] = reduced
+                    way[j] = column
+                if least[j] < delta:
+                    delta, next_column = least[j], j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[owner[j]] += delta
+                    v[j] -= delta
+                else:
+                    least[j] -= delta
+            column = next_column
+            if owner[column] == 0:
+                break
+        # Flip the alternating path back to the root
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+    assigned = [0] * rows
+    for j in range(1, columns + 1):
+        if owner[j]:
+            assigned[owner[j] - 1] = j - 1
+    return assigned
+
+
+def optimal(edges):
+    """Returns the edges of a minimum-cost matching among the largest possible, for a small group of edges"""
+    riders = sorted({edge[1] for edge in edges})
+    owners = sorted({edge[2] for edge in edges})
+    # Any real pairing is cheaper than leaving a rider unmatched, so the fullest matching always wins
+    unmatched = 1 + sum(edge[0] for edge in edges)
+    transpose = len(riders) > len(owners)
+    rows, columns = (owners, riders) if transpose else (riders, owners)
+    row_index = {value: i for i, value in enumerate(rows)}
+    column_index = {value: j for j, value in enumerate(columns)}
+    cost = [[unmatched] * len(columns) for _ in rows]
+    chosen = {}
+    for edge in edges:
+        row, column = (edge[2], edge[1]) if transpose else (edge[1], edge[2])
+        cost[row_index[row]][column_index[column]] = edge[0]
+        chosen[(row, column)] = edge
+    taken = []
+    for i, j in enumerate(assignment(cost)):
+        edge = chosen.get((rows[i], columns[j]))
+        if edge is not None:
+            taken.append(edge)
+    return taken
+
+
+def groups(edges):
+    """Splits edges into groups sharing no rider or owner, so each can be matched on its own"""
+    # Union-find over riders numbered as they are and owners numbered after the last rider
+    offset = max((edge[1] for edge in edges), default=0) + 1
+    parent = list(range(offset + max((edge[2] for edge in edges), default=0) + 1))
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for cost, rider, owner, *distances in edges:
+        parent[find(rider)] = find(offset + owner)
+    grouped = {}
+    for edge in edges:
+        grouped.setdefault(find(edge[1]), []).append(edge)
+    return list(grouped.values())
+
+
+def match(requests, offers):
+    """Returns the proposed Matches of ride requests with bike owners' offers, cheapest first"""
+    taken = []
+    for group in groups(candidates(requests, offers)):
+        size = max(len({edge[1] for edge in group}), len({edge[2] for edge in group}))
+        taken.extend(optimal(group) if size <= OPTIMAL_SIZE else greedy(group))
+    taken.sort()
+    return [
+        Match(requests[rider], offers[owner], origin_km, destination_km, wait_seconds, cost)
+        for cost, rider, owner, origin_km, destination_km, wait_seconds in taken
+    ]
+
+
+def run(now=None):
+    """Matches every live ride request with a bike owner and replaces the stored proposals, returning the Matches"""
+    now = time.time() if now is None else now
+    try:
+        requests, offers = split(repository.live_pools_since(0, cutoff_time()))
+        matches = match(requests, offers)
+        repository.replace_matches(
+            [(found.request.user_id, found.request.pool_id, found.offer.user_id, found.offer.pool_id, found.origin_km, found.wait_seconds, found.cost) for found in matches],
+            now,
+        )
+        return matches
+    finally:
+        database.release()
+
+
+class Matcher(threading.Thread):
+    """Daemon thread that periodically recomputes the proposed ride matches"""
+
+    def __init__(self, interval, logger=None):
+        super().__init__(name="ride-matcher", daemon=True)
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                # Every worker runs a matcher, the first one due does the work for all of them
+                if time.time() - repository.last_match_time() < self.interval / 2:
+                    database.release()
+                    continue
+                run()
+            except Exception:
+                # A locked database or a failed run is retried on the next tick
+                self.logger.exception("ride matching failed, retrying in %s s", self.interval)
+
+    def stop(self):
+        self._halt.set()
+
+
+def init_app(app):
+    """Sets up a background matcher, which the app starts with its first request, when MATCH_INTERVAL is a positive
+    number of seconds"""
+    interval = app.config.setdefault("MATCH_INTERVAL", INTERVAL)
+    if not interval:
+        return
+    app.extensions["ride_matcher"] = Matcher(interval, app.logger)
+
+
+@db_cli.command("match")
+def match_command():
+    """Pair live ride requests with bike owners' pools now."""
+    start = time.perf_counter()
+    matches = run()
+    click.echo(f"Proposed {len(matches)} matches in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,827 @@
+import csv
+import os
+import re
+import sqlite3
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import ratelimit
+import repository
+
+
+# Command group exposed as 'flask db ...'
+db_cli = AppGroup("db", help="Manage the database schema.")
+
+
+# Frozen copies of the app code and SQL the data migrations ran with when they shipped. The app's own keep changing,
+# and a version applied to an old database later must still do exactly what it did then
+
+# accounts.NOT_AVAILABLE, the placeholder stored for a blank optional field
+_NOT_AVAILABLE = "NOT AVAILABLE"
+
+# places.ABBREVIATIONS, written out in place keys
+_ABBREVIATIONS = {
+    "apt": "apartment",
+    "apts": "apartments",
+    "ave": "avenue",
+    "bldg": "building",
+    "blvd": "boulevard",
+    "clg": "college",
+    "ext": "extension",
+    "govt": "government",
+    "hosp": "hospital",
+    "hwy": "highway",
+    "jn": "junction",
+    "jnct": "junction",
+    "ln": "lane",
+    "mkt": "market",
+    "ngr": "nagar",
+    "nr": "near",
+    "opp": "opposite",
+    "ph": "phase",
+    "rd": "road",
+    "sch": "school",
+    "sec": "sector",
+    "sect": "sector",
+    "st": "street",
+    "stn": "station",
+    "univ": "university",
+}
+
+_GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "gazetteer.csv")
+
+
+def _place_key(text):
+    """places.normalize(): the key a place or city is interned under"""
+    text = (text or "").casefold()
+    words = re.findall(r"[^\W_]+", text)
+    if not words:
+        return " ".join(text.split())
+    return " ".join(_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def _display(text):
+    """places.display(): whitespace collapsed and the first character uppercased"""
+    text = " ".join(text.split())
+    return text[:1].upper() + text[1:]
+
+
+def _gazetteer_words(text):
+    """geo.normalize(): lowercased, everything but letters and digits collapsed into single spaces"""
+    return " ".join(re.findall(r"[a-z0-9]+", (text or "").lower()))
+
+
+def _geocoder(path=_GAZETTEER_PATH):
+    """Loads the gazetteer and returns geo.geocode(text, city), giving (latitude, longitude) or (None, None)"""
+    by_first_word, cities = {}, {}
+    with open(path, newline="") as file:
+        for row in csv.DictReader(file):
+            name = _gazetteer_words(row["name"])
+            city = _gazetteer_words(row["city"])
+            point = (float(row["latitude"]), float(row["longitude"]))
+            by_first_word.setdefault(name.split()[0], []).append((name.split(), city, point, name == city))
+            if name == city:
+                cities[city] = point
+
+    def geocode(text, city=None):
+        words = _gazetteer_words(text).split()
+        city = _gazetteer_words(city)
+        matches = []
+        for start, word in enumerate(words):
+            for name, place_city, point, is_city in by_first_word.get(word, ()):
+                if words[start:start + len(name)] == name:
+                    matches.append((len(name), place_city, point, is_city))
+        mentioned = {match[1] for match in matches if match[3]}
+        matches = [match for match in matches if match[1] == city or match[1] in mentioned or city not in cities]
+        if matches:
+            return max(matches, key=lambda match: (match[1] == city, match[0]))[2]
+        return cities.get(city, (None, None))
+
+    return geocode
+
+
+def _baseline(conn):
+    """Creates the tables the app has always used"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        username TEXT NOT NULL,
+                        fullname TEXT NOT NULL,
+                        hash TEXT NOT NULL,
+                        address TEXT,
+                        city TEXT,
+                        bike TEXT,
+                        phone TEXT
+                        )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS pools (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        creator INTEGER NOT NULL,
+                        follower INTEGER,
+                        origin TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        time REAL NOT NULL,
+                        FOREIGN KEY (creator) REFERENCES users(id),
+                        FOREIGN KEY (follower) REFERENCES users(id)
+                        )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS requests (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        sender INTEGER NOT NULL,
+                        receiver INTEGER NOT NULL,
+                        status TEXT DEFAULT 'pending',
+                        FOREIGN KEY (sender) REFERENCES users(id),
+                        FOREIGN KEY (receiver) REFERENCES users(id)
+                        )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        pool_id INTEGER NOT NULL,
+                        recipient_id TEXT,
+                        origin TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        FOREIGN KEY (user_id) REFERENCES users(id),
+                        FOREIGN KEY (pool_id) REFERENCES pools(id)
+                        )""")
+
+
+def _typed_pool_time(conn):
+    """Rebuilds 'pools' with a REAL 'time' column on databases created before it was typed"""
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(pools)")}
+    if columns["time"].upper() == "REAL":
+        return
+
+    # Keep the AUTOINCREMENT counter so new pools never reuse the ids stored in 'history'
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pools'").fetchone()
+    conn.execute("ALTER TABLE pools RENAME TO pools_untyped")
+    conn.execute("""CREATE TABLE pools (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        creator INTEGER NOT NULL,
+                        follower INTEGER,
+                        origin TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        time REAL NOT NULL,
+                        FOREIGN KEY (creator) REFERENCES users(id),
+                        FOREIGN KEY (follower) REFERENCES users(id)
+                        )""")
+    conn.execute("""INSERT INTO pools (id, creator, follower, origin, destination, time)
+                    SELECT id, creator, follower, origin, destination, CAST(time AS REAL) FROM pools_untyped""")
+    conn.execute("DROP TABLE pools_untyped")
+    if seq:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'pools'", (seq[0],))
+
+
+def _hot_path_indexes(conn):
+    """Indexes every lookup made by the request handlers"""
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_time ON pools (time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_follower_time ON pools (follower, time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_creator ON pools (creator)")
+    conn.execute("CREATE INDEX IF NOT EXISTS requests_receiver_status ON requests (receiver, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS requests_sender_status ON requests (sender, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_user_id ON history (user_id, id)")
+
+
+def _coordinates(conn):
+    """Stores geocoded coordinates next to user addresses and pool origins and destinations"""
+    for column in ("latitude", "longitude"):
+        conn.execute(f"ALTER TABLE users ADD COLUMN {column} REAL")
+    for column in ("origin_latitude", "origin_longitude", "destination_latitude", "destination_longitude"):
+        conn.execute(f"ALTER TABLE pools ADD COLUMN {column} REAL")
+
+    # Geocode the rows that already exist against the bundled gazetteer
+    geocode = _geocoder()
+    users = conn.execute("SELECT id, address, city FROM users").fetchall()
+    conn.executemany(
+        "UPDATE users SET latitude = ?, longitude = ? WHERE id = ?",
+        [(*geocode(address, city), user_id) for user_id, address, city in users],
+    )
+    pools = conn.execute("SELECT pools.id, pools.origin, pools.destination, users.city FROM pools JOIN users ON users.id = pools.creator").fetchall()
+    conn.executemany(
+        """UPDATE pools SET origin_latitude = ?, origin_longitude = ?, destination_latitude = ?, destination_longitude = ?
+           WHERE id = ?""",
+        [(*geocode(origin, city), *geocode(destination, city), pool_id) for pool_id, origin, destination, city in pools],
+    )
+
+
+def _sessions(conn):
+    """Stores server-side sessions, indexed by expiry for the sweeper"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                        id TEXT PRIMARY KEY NOT NULL,
+                        data TEXT NOT NULL,
+                        expiry REAL NOT NULL
+                        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS sessions_expiry ON sessions (expiry)")
+
+
+def _pool_archive(conn):
+    """Creates the table expired pools are moved into, keeping their ids so 'history' still resolves them"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS pools_archive (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        creator INTEGER NOT NULL,
+                        follower INTEGER,
+                        origin TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        time REAL NOT NULL,
+                        origin_latitude REAL,
+                        origin_longitude REAL,
+                        destination_latitude REAL,
+                        destination_longitude REAL,
+                        archived_at REAL NOT NULL,
+                        FOREIGN KEY (creator) REFERENCES users(id),
+                        FOREIGN KEY (follower) REFERENCES users(id)
+                        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_archive_creator ON pools_archive (creator)")
+
+
+def _incremental_vacuum(conn):
+    """Switches the file to incremental auto-vacuum so compaction can hand freed pages back to the filesystem"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # The new mode only takes effect once the whole file has been rebuilt
+        conn.execute("VACUUM")
+
+
+def _typed_history(conn):
+    """Rebuilds 'history' with an INTEGER 'recipient_id' and sortable 'YYYY-MM-DD' dates"""
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+    conn.execute("ALTER TABLE history RENAME TO history_untyped")
+    # 'pool_id' points into 'pools' or, once the pool has expired, 'pools_archive', so it has no foreign key
+    conn.execute("""CREATE TABLE history (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        pool_id INTEGER NOT NULL,
+                        recipient_id INTEGER,
+                        origin TEXT NOT NULL,
+                        destination TEXT NOT NULL,
+                        date TEXT NOT NULL,
+                        FOREIGN KEY (user_id) REFERENCES users(id),
+                        FOREIGN KEY (recipient_id) REFERENCES users(id)
+                        )""")
+    conn.execute("""INSERT INTO history (id, user_id, pool_id, recipient_id, origin, destination, date)
+                    SELECT id, user_id, pool_id, CAST(NULLIF(recipient_id, '') AS INTEGER), origin, destination,
+                           CASE WHEN date GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+                                THEN substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2)
+                                ELSE date END
+                    FROM history_untyped""")
+    conn.execute("DROP TABLE history_untyped")
+    if seq:
+        conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'history'", (seq[0],))
+    conn.execute("CREATE INDEX IF NOT EXISTS history_user_id ON history (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_user_date ON history (user_id, date)")
+
+
+def _events(conn):
+    """Stores recently published events so every worker can relay them to its open streams"""
+    # AUTOINCREMENT keeps ids growing after old events are purged, relays remember the last id they saw
+    conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        kind TEXT NOT NULL,
+                        audience INTEGER,
+                        creator INTEGER,
+                        address TEXT,
+                        latitude REAL,
+                        longitude REAL,
+                        payload TEXT NOT NULL,
+                        created REAL NOT NULL
+                        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS events_created ON events (created)")
+
+
+def _fragments(conn):
+    """Stores cached homepage fragments shared by every worker, indexed for invalidation and trimming"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS fragments (
+                        key TEXT PRIMARY KEY NOT NULL,
+                        tag TEXT NOT NULL,
+                        value TEXT NOT NULL,
+                        expiry REAL NOT NULL
+                        )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS fragments_tag ON fragments (tag)")
+    conn.execute("CREATE INDEX IF NOT EXISTS fragments_expiry ON fragments (expiry)")
+
+
+def _request_pairs(conn):
+    """Indexes friend requests by sender and receiver, so checking whether two users are linked never scans"""
+    conn.execute("CREATE INDEX IF NOT EXISTS requests_sender_receiver ON requests (sender, receiver)")
+
+
+def _matches(conn):
+    """Stores the ride matches proposed by the matcher, at most one per rider and one per bike owner"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS matches (
+                        rider INTEGER PRIMARY KEY NOT NULL,
+                        request_id INTEGER NOT NULL,
+                        owner INTEGER NOT NULL,
+                        offer_id INTEGER NOT NULL,
+                        origin_km REAL NOT NULL,
+                        wait_seconds REAL NOT NULL,
+                        cost REAL NOT NULL,
+                        created REAL NOT NULL
+                        )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS matches_owner ON matches (owner)")
+
+
+def _keep_sequence(conn, table, seq):
+    """Restores the AUTOINCREMENT counter of a rebuilt table, so new rows never reuse ids stored elsewhere"""
+    if seq and not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq[0], table)).rowcount:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq[0]))
+
+
+def _places(conn):
+    """Interns every address, origin and destination into 'places' and rebuilds 'pools', 'pools_archive' and
+    'history' to point at them by id, the coordinates of pools moving to their places"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS places (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        city TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        name TEXT NOT NULL,
+                        latitude REAL,
+                        longitude REAL
+                        )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS places_city_key ON places (city, key)")
+
+    # Every spelling in use with the city it was written in, the creator's for pools and the rider's for history,
+    # most used first
+    spellings = conn.execute("""SELECT text, city FROM (
+                                    SELECT address AS text, COALESCE(city, '') AS city FROM users WHERE address IS NOT NULL AND address != ?
+                                    UNION ALL SELECT pools.origin, COALESCE(users.city, '') FROM pools LEFT JOIN users ON users.id = pools.creator
+                                    UNION ALL SELECT pools.destination, COALESCE(users.city, '') FROM pools LEFT JOIN users ON users.id = pools.creator
+                                    UNION ALL SELECT pools_archive.origin, COALESCE(users.city, '') FROM pools_archive LEFT JOIN users ON users.id = pools_archive.creator
+                                    UNION ALL SELECT pools_archive.destination, COALESCE(users.city, '') FROM pools_archive LEFT JOIN users ON users.id = pools_archive.creator
+                                    UNION ALL SELECT history.origin, COALESCE(users.city, '') FROM history LEFT JOIN users ON users.id = history.user_id
+                                    UNION ALL SELECT history.destination, COALESCE(users.city, '') FROM history LEFT JOIN users ON users.id = history.user_id
+                                )
+                                GROUP BY text, city
+                                ORDER BY COUNT(*) DESC, text""",
+                             (_NOT_AVAILABLE,)).fetchall()
+    conn.execute("CREATE TEMP TABLE spellings (text TEXT NOT NULL, city TEXT NOT NULL, place_id INTEGER NOT NULL, PRIMARY KEY (text, city))")
+    ids = {}
+    geocode = _geocoder()
+    for text, city in spellings:
+        key = (_place_key(city), _place_key(text))
+        if key not in ids:
+            # The most used spelling names the place, geocoded the way places.intern() does it
+            ids[key] = conn.execute(
+                "INSERT INTO places (city, key, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)",
+                (*key, _display(text), *geocode(key[1], key[0])),
+            ).lastrowid
+        conn.execute("INSERT INTO spellings (text, city, place_id) VALUES (?, ?, ?)", (text, city, ids[key]))
+
+    conn.execute("ALTER TABLE users ADD COLUMN place_id INTEGER REFERENCES places(id)")
+    conn.execute(
+        "UPDATE users SET place_id = (SELECT place_id FROM spellings WHERE text = users.address AND city = COALESCE(users.city, '')) WHERE address != ?",
+        (_NOT_AVAILABLE,),
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS users_place ON users (place_id)")
+
+    # Each table is rebuilt under a new name and renamed over the old one, so no other table's references follow a rename
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pools'").fetchone()
+    conn.execute("""CREATE TABLE pools_placed (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                        creator INTEGER NOT NULL,
+                        follower INTEGER,
+                        origin_id INTEGER NOT NULL,
+                        destination_id INTEGER NOT NULL,
+                        time REAL NOT NULL,
+                        FOREIGN KEY (creator) REFERENCES users(id),
+                        FOREIGN KEY (follower) REFERENCES users(id),
+                        FOREIGN KEY (origin_id) REFERENCES places(id),
+                        FOREIGN KEY (destination_id) REFERENCES places(id)
+                        )""")
+    conn.execute("""INSERT INTO pools_placed (id, creator, follower, origin_id, destination_id, time)
+                    SELECT pools.id, pools.creator, pools.follower, origins.place_id, destinations.place_id, pools.time
+                    FROM pools
+                    LEFT JOIN users ON users.id = pools.creator
+                    JOIN spellings AS origins ON origins.text = pools.origin AND origins.city = COALESCE(users.city, '')
+                    JOIN spellings AS destinations ON destinations.text = pools.destination AND destinations.city = COALESCE(users.city, '')""")
+    conn.execute("DROP TABLE pools")
+    conn.execute("ALTER TABLE pools_placed RENAME TO pools")
+    _keep_sequence(conn, "pools", seq)
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_time ON pools (time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_follower_time ON pools (follower, time)")
+    # Replaces the index on 'creator' alone, nearby pools read the live routes of each creator at the user's place
+    # from the index without touching the table, which integer place ids keep small
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_creator_time ON pools (creator, time, origin_id, destination_id)")
+
+    conn.execute("""CREATE TABLE pools_archive_placed (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        creator INTEGER NOT NULL,
+                        follower INTEGER,
+                        origin_id INTEGER NOT NULL,
+                        destination_id INTEGER NOT NULL,
+                        time REAL NOT NULL,
+                        archived_at REAL NOT NULL,
+                        FOREIGN KEY (creator) REFERENCES users(id),
+                        FOREIGN KEY (follower) REFERENCES users(id),
+                        FOREIGN KEY (origin_id) REFERENCES places(id),
+                        FOREIGN KEY (destination_id) REFERENCES places(id)
+                        )""")
+    conn.execute("""INSERT INTO pools_archive_placed (id, creator, follower, origin_id, destination_id, time, archived_at)
+                    SELECT pools_archive.id, pools_archive.creator, pools_archive.follower, origins.place_id, destinations.place_id,
+                           pools_archive.time, pools_archive.archived_at
+                    FROM pools_archive
+                    LEFT JOIN users ON users.id = pools_archive.creator
+                    JOIN spellings AS origins ON origins.text = pools_archive.origin AND origins.city = COALESCE(users.city, '')
+                    JOIN spellings AS destinations ON destinations.text = pools_archive.destination AND destinations.city = COALESCE(users.city, '')""")
+    conn.execute("DROP TABLE pools_archive")
+    conn.execute("ALTER TABLE pools_archive_placed RENAME TO pools_archive")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_archive_creator ON pools_archive (creator)")
+
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'").fetchone()
+    conn.execute("""CREATE TABLE history_placed (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        user_id INTEGER NOT NULL,
+                        pool_id INTEGER NOT NULL,
+                        recipient_id INTEGER,
+                        origin_id INTEGER NOT NULL,
+                        destination_id INTEGER NOT NULL,
+                        date TEXT NOT NULL,
+                        FOREIGN KEY (user_id) REFERENCES users(id),
+                        FOREIGN KEY (recipient_id) REFERENCES users(id),
+                        FOREIGN KEY (origin_id) REFERENCES places(id),
+                        FOREIGN KEY (destination_id) REFERENCES places(id)
+                        )""")
+    conn.execute("""INSERT INTO history_placed (id, user_id, pool_id, recipient_id, origin_id, destination_id, date)
+                    SELECT history.id, history.user_id, history.pool_id, history.recipient_id, origins.place_id, destinations.place_id, history.date
+                    FROM history
+                    LEFT JOIN users ON users.id = history.user_id
+                    JOIN spellings AS origins ON origins.text = history.origin AND origins.city = COALESCE(users.city, '')
+                    JOIN spellings AS destinations ON destinations.text = history.destination AND destinations.city = COALESCE(users.city, '')""")
+    conn.execute("DROP TABLE history")
+    conn.execute("ALTER TABLE history_placed RENAME TO history")
+    _keep_sequence(conn, "history", seq)
+    conn.execute("CREATE INDEX IF NOT EXISTS history_user_id ON history (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_user_date ON history (user_id, date)")
+    conn.execute("DROP TABLE spellings")
+
+    # Open pools are matched to streams by the creator's place rather than address text
+    conn.execute("ALTER TABLE events ADD COLUMN place_id INTEGER")
+    conn.execute("ALTER TABLE events DROP COLUMN address")
+
+
+def _city_partitions(conn):
+    """Interns every user's city into 'cities' and keys users and pools by city id, each pool belonging to the city
+    of its creator, with an index giving each city its own slice of the live pools"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS cities (
+                        id INTEGER PRIMARY KEY NOT NULL,
+                        key TEXT NOT NULL,
+                        name TEXT NOT NULL
+                        )""")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS cities_key ON cities (key)")
+
+    # The most used spelling names a city
+    spellings = conn.execute(
+        "SELECT city FROM users WHERE city IS NOT NULL AND city != ? GROUP BY city ORDER BY COUNT(*) DESC, city", (_NOT_AVAILABLE,)
+    ).fetchall()
+    ids = {}
+    for (city,) in spellings:
+        key = _place_key(city)
+        if key not in ids:
+            ids[key] = conn.execute("INSERT INTO cities (key, name) VALUES (?, ?)", (key, _display(city))).lastrowid
+    conn.execute("ALTER TABLE users ADD COLUMN city_id INTEGER REFERENCES cities(id)")
+    conn.executemany("UPDATE users SET city_id = ? WHERE city = ?", [(ids[_place_key(city)], city) for (city,) in spellings])
+
+    for table in ("pools", "pools_archive"):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN city_id INTEGER REFERENCES cities(id)")
+        conn.execute(f"UPDATE {table} SET city_id = (SELECT city_id FROM users WHERE users.id = {table}.creator)")
+    conn.execute("CREATE INDEX IF NOT EXISTS pools_city_time ON pools (city_id, time)")
+
+
+def _rate_limits(conn):
+    """Stores the token buckets of the rate limiter shared by every worker, one row per endpoint, scope and owner"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS rate_limits (
+                        key TEXT PRIMARY KEY NOT NULL,
+                        tokens REAL NOT NULL,
+                        updated REAL NOT NULL
+                        ) WITHOUT ROWID""")
+
+
+def _suggestions(conn):
+    """Materializes friend suggestions, one row per user and candidate with their mutual friend count, ranked by an
+    index, then fills it from the friend graph"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS suggestions (
+                        user_id INTEGER NOT NULL,
+                        candidate_id INTEGER NOT NULL,
+                        mutual INTEGER NOT NULL,
+                        nearby INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, candidate_id)
+                        ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS suggestions_rank ON suggestions (user_id, mutual DESC, nearby DESC, candidate_id)")
+    # Every pair of users who are not friends, counting their mutual friends with at most 50 friends of their own,
+    # and how close they live: 2 at the same place, 1 in the same city, 0 otherwise
+    conn.execute("""INSERT INTO suggestions (user_id, candidate_id, mutual, nearby)
+                    WITH friends (user_id, friend_id) AS MATERIALIZED (
+                        SELECT sender, receiver FROM requests WHERE status = 'accepted'
+                        UNION
+                        SELECT receiver, sender FROM requests WHERE status = 'accepted'
+                    ), connectors (id) AS MATERIALIZED (
+                        SELECT user_id FROM friends GROUP BY user_id HAVING COUNT(*) <= 50
+                    ), pairs (user_id, candidate_id, mutual) AS (
+                        SELECT mine.user_id, theirs.friend_id, COUNT(*) FROM connectors
+                        JOIN friends AS mine ON mine.friend_id = connectors.id
+                        JOIN friends AS theirs ON theirs.user_id = connectors.id
+                        WHERE theirs.friend_id != mine.user_id
+                        GROUP BY mine.user_id, theirs.friend_id
+                    )
+                    SELECT pairs.user_id, pairs.candidate_id, pairs.mutual,
+                           CASE WHEN users.place_id = candidates.place_id THEN 2 WHEN users.city_id = candidates.city_id THEN 1 ELSE 0 END
+                    FROM pairs
+                    JOIN users ON users.id = pairs.user_id
+                    JOIN users AS candidates ON candidates.id = pairs.candidate_id
+                    WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = pairs.user_id AND receiver = pairs.candidate_id AND status = 'accepted')
+                      AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = pairs.candidate_id AND receiver = pairs.user_id AND status = 'accepted')""")
+
+
+def _route_rollups(conn):
+    """Stores pool counts per route and hour of the week, per route and per city and hour, each keyed for the stats
+    page to read directly, then counts every pool created so far"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS route_hours (
+                        city_id INTEGER NOT NULL,
+                        origin_id INTEGER NOT NULL,
+                        destination_id INTEGER NOT NULL,
+                        hour INTEGER NOT NULL,
+                        pools INTEGER NOT NULL,
+                        requests INTEGER NOT NULL,
+                        PRIMARY KEY (city_id, origin_id, destination_id, hour)
+                        ) WITHOUT ROWID""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS route_totals (
+                        city_id INTEGER NOT NULL,
+                        origin_id INTEGER NOT NULL,
+                        destination_id INTEGER NOT NULL,
+                        pools INTEGER NOT NULL,
+                        requests INTEGER NOT NULL,
+                        PRIMARY KEY (city_id, origin_id, destination_id)
+                        ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS route_totals_rank ON route_totals (city_id, pools DESC)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS city_hours (
+                        city_id INTEGER NOT NULL,
+                        hour INTEGER NOT NULL,
+                        pools INTEGER NOT NULL,
+                        requests INTEGER NOT NULL,
+                        PRIMARY KEY (city_id, hour)
+                        ) WITHOUT ROWID""")
+    # Hours of the week run from 0 for Monday midnight to 167 in the server's local time, a pool created by a user
+    # without a bike is a ride request, and pools of users without a city are counted under city 0
+    conn.execute("""INSERT INTO route_hours (city_id, origin_id, destination_id, hour, pools, requests)
+                    SELECT COALESCE(pools.city_id, 0), pools.origin_id, pools.destination_id,
+                           (CAST(strftime('%w', pools.time, 'unixepoch', 'localtime') AS INTEGER) + 6) % 7 * 24
+                           + CAST(strftime('%H', pools.time, 'unixepoch', 'localtime') AS INTEGER),
+                           COUNT(*), SUM(UPPER(TRIM(COALESCE(users.bike, ''))) IN ('', 'NOT OWNED', 'NOT AVAILABLE'))
+                    FROM (SELECT city_id, creator, origin_id, destination_id, time FROM pools
+                          UNION ALL
+                          SELECT city_id, creator, origin_id, destination_id, time FROM pools_archive) AS pools
+                    JOIN users ON users.id = pools.creator
+                    GROUP BY 1, 2, 3, 4""")
+    conn.execute("""INSERT INTO route_totals (city_id, origin_id, destination_id, pools, requests)
+                    SELECT city_id, origin_id, destination_id, SUM(pools), SUM(requests) FROM route_hours
+                    GROUP BY city_id, origin_id, destination_id""")
+    conn.execute("""INSERT INTO city_hours (city_id, hour, pools, requests)
+                    SELECT city_id, hour, SUM(pools), SUM(requests) FROM route_hours
+                    GROUP BY city_id, hour""")
+
+
+def _fragment_access(conn):
+    """Records when each cached homepage fragment was last read, so the least recently read ones are trimmed first"""
+    conn.execute("ALTER TABLE fragments ADD COLUMN accessed REAL NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS fragments_accessed ON fragments (accessed)")
+
+
+def _match_runs(conn):
+    """Records when the matcher last ran in a single row, starting from the time of the stored matches"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS match_runs (
+                        id INTEGER PRIMARY KEY NOT NULL CHECK (id = 1),
+                        created REAL NOT NULL
+                        )""")
+    conn.execute("INSERT OR IGNORE INTO match_runs (id, created) SELECT 1, MAX(created) FROM matches HAVING COUNT(*) > 0")
+
+
+
+def _neighbour_suggestions(conn):
+    """Indexes users by city, then replays every sign-up: each user is suggested up to 10 of the earlier users living
+    at their place, then in their city, newest first, and they the user"""
+    conn.execute("CREATE INDEX IF NOT EXISTS users_city ON users (city_id)")
+    user_ids = [user_id for (user_id,) in conn.execute("SELECT id FROM users ORDER BY id")]
+    for user_id in user_ids:
+        conn.execute("""WITH neighbours (id, nearby) AS (
+                            SELECT id, nearby FROM (
+                                SELECT candidates.id, 2 AS nearby FROM users
+                                JOIN users AS candidates ON candidates.place_id = users.place_id
+                                WHERE users.id = ?1 AND candidates.id < ?1
+                                ORDER BY candidates.id DESC LIMIT 10
+                            )
+                            UNION ALL
+                            SELECT id, nearby FROM (
+                                SELECT candidates.id, 1 AS nearby FROM users
+                                JOIN users AS candidates ON candidates.city_id = users.city_id
+                                WHERE users.id = ?1 AND candidates.id < ?1 AND (users.place_id IS NULL OR candidates.place_id IS NOT users.place_id)
+                                ORDER BY candidates.id DESC LIMIT 10
+                            )
+                            ORDER BY nearby DESC, id DESC LIMIT 10
+                        ), strangers (id, nearby) AS (
+                            SELECT id, nearby FROM neighbours
+                            WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = neighbours.id AND status = 'accepted')
+                              AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = neighbours.id AND receiver = ?1 AND status = 'accepted')
+                        )
+                        INSERT INTO suggestions (user_id, candidate_id, mutual, nearby)
+                        SELECT ?1, id, 0, nearby FROM strangers
+                        UNION ALL
+                        SELECT id, ?1, 0, nearby FROM strangers WHERE true
+                        ON CONFLICT (user_id, candidate_id) DO NOTHING""", (user_id,))
+
+
+# Ordered list of (version, name, step), a version is never edited once it has shipped
+MIGRATIONS = [
+    (1, "baseline", _baseline),
+    (2, "typed pool time", _typed_pool_time),
+    (3, "hot path indexes", _hot_path_indexes),
+    (4, "coordinates", _coordinates),
+    (5, "sessions", _sessions),
+    (6, "pool archive", _pool_archive),
+    (7, "incremental vacuum", _incremental_vacuum),
+    (8, "typed history", _typed_history),
+    (9, "events", _events),
+    (10, "fragments", _fragments),
+    (11, "request pairs", _request_pairs),
+    (12, "ride matches", _matches),
+    (13, "places", _places),
+    (14, "city partitions", _city_partitions),
+    (15, "rate limits", _rate_limits),
+    (16, "friend suggestions", _suggestions),
+    (17, "route rollups", _route_rollups),
+    (18, "fragment access", _fragment_access),
+    (19, "match runs", _match_runs),
+    (20, "neighbour suggestions", _neighbour_suggestions),
+]
+
+# Versions whose step cannot run inside a transaction, e.g. because it issues VACUUM, they must be safe to re-run
+OUTSIDE_TRANSACTION = {7}
+
+
+# Queries issued by the request handlers with representative parameters, used by 'flask db explain'
+HOT_QUERIES = {
+    "nearby pools": (repository.NEARBY_POOLS, (1, 0.0)),
+    "invited pools": (repository.INVITED_POOLS, (1, 0.0)),
+    "live pools since": (repository.LIVE_POOLS_SINCE, (0, 0.0)),
+    "live pools in city": (repository.LIVE_POOLS_IN_CITY, (1, 0, 0.0)),
+    "live pools without city": (repository.LIVE_POOLS_WITHOUT_CITY, (0, 0.0)),
+    "not friends": (repository.NOT_FRIENDS, (1, "[1, 2]")),
+    "pools by ids": (repository.POOLS_BY_IDS, ("[1, 2]",)),
+    "earliest pool time": (repository.EARLIEST_POOL_TIME, ("[1, 2]",)),
+    "user location": (repository.USER_LOCATION, (1,)),
+    "place": (repository.PLACE, ("mhow", "sector 5")),
+    "city id": (repository.CITY_ID, ("mhow",)),
+    "user by username": (repository.USER_BY_USERNAME, ("satvik",)),
+    "user id by username": (repository.USER_ID_BY_USERNAME, ("satvik",)),
+    "password hash": (repository.PASSWORD_HASH, (1,)),
+    "expired pool ids": (repository.EXPIRED_POOL_IDS, (0.0, 500)),
+    "friend request": (repository.FRIEND_REQUEST, (1, 2)),
+    "answer friend request": (repository.ANSWER_FRIEND_REQUEST, ("accepted", 1, 2)),
+    "pending senders": (repository.PENDING_SENDERS, (1,)),
+    "friend ids": (repository.FRIEND_IDS, (1, 1)),
+    "users by ids": (repository.USERS_BY_IDS, ("[1, 2]",)),
+    "users since": (repository.USERS_SINCE, (0,)),
+    "friends of": (repository.FRIENDS_OF, ("[1, 2]",)),
+    "users by usernames": (repository.USERS_BY_USERNAMES, ('["satvik"]',)),
+    "suggestions": (repository.SUGGESTIONS, (1, 10)),
+    "friend count": (repository.FRIEND_COUNT, (1,)),
+    "drop suggestion": (repository.DROP_SUGGESTION, (1, 2)),
+    "add mutual friend": (repository.ADD_MUTUAL_FRIEND, (1, 2)),
+    "drop connector": (repository.DROP_CONNECTOR, (1, 2)),
+    "drop unconnected": (repository.DROP_UNCONNECTED, (1, 2)),
+    "refresh nearby": (repository.REFRESH_NEARBY, (1,)),
+    "drop strangers of": (repository.DROP_STRANGERS_OF, (1,)),
+    "drop strangers": (repository.DROP_STRANGERS, (1,)),
+    "add neighbours": (repository.ADD_NEIGHBOURS, (1, 10)),
+    "count route hours": (repository.COUNT_ROUTES["route_hours"], (1, 1)),
+    "count route totals": (repository.COUNT_ROUTES["route_totals"], (1, 1)),
+    "count city hours": (repository.COUNT_ROUTES["city_hours"], (1, 1)),
+    "top routes": (repository.TOP_ROUTES, (1, 20)),
+    "city hours": (repository.CITY_HOURS, (1,)),
+    "route hours": (repository.ROUTE_HOURS, (1, 1, 2)),
+    "place name": (repository.PLACE_NAME, (1,)),
+    "import friend requests": (repository.IMPORT_FRIEND_REQUESTS, (1, 2, "accepted")),
+    "session": (repository.SESSION, ("sid", 0.0)),
+    "save session": (repository.SAVE_SESSION, ("sid", b"{}", 0.0)),
+    "delete session": (repository.DELETE_SESSION, ("sid",)),
+    "delete expired sessions": (repository.DELETE_EXPIRED_SESSIONS, (0.0,)),
+    "fragment": (repository.FRAGMENT, ("nearby:1", 0.0)),
+    "save fragment": (repository.SAVE_FRAGMENT, ("nearby:1", "cell:1:1", "[]", 0.0, 0.0)),
+    "touch fragment": (repository.TOUCH_FRAGMENT, (0.0, "nearby:1")),
+    "delete expired fragments": (repository.DELETE_EXPIRED_FRAGMENTS, (0.0,)),
+    "delete least recent fragments": (repository.DELETE_LEAST_RECENT_FRAGMENTS, (10,)),
+    "invalidate fragments": (repository.INVALIDATE_FRAGMENTS, ('["cell:1:1"]',)),
+    "events since": (repository.EVENTS_SINCE, (0,)),
+    "last event id": (repository.LAST_EVENT_ID, ()),
+    "purge events": (repository.PURGE_EVENTS, (0.0,)),
+    "matches of user": (repository.MATCHES_OF_USER, (1, 0.0)),
+    "last match time": (repository.LAST_MATCH_TIME, ()),
+    "save match run": (repository.SAVE_MATCH_RUN, (0.0,)),
+    "history page": (repository.HISTORY_PAGE, (1, repository.FIRST_PAGE, 25)),
+    "history page between dates": (repository.HISTORY_PAGE_BETWEEN, (1, "2024-01-01", "2024-01-31", repository.FIRST_PAGE, 25)),
+    "take rate limit token": (ratelimit.TAKE_TOKEN, ("login:ip:127.0.0.1", 10, 1.0, 0.0)),
+    "rate limit wait": (ratelimit.WAIT_SECONDS, ("login:ip:127.0.0.1", 10, 1.0, 0.0)),
+}
+
+
+def connect(path):
+    """Opens a connection that leaves transaction control to the caller"""
+    return sqlite3.connect(path, isolation_level=None)
+
+
+def current_version(conn):
+    """Returns the newest migration applied to the database"""
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY NOT NULL,
+                        name TEXT NOT NULL,
+                        applied_at REAL NOT NULL
+                        )""")
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def upgrade(conn, target=None):
+    """Applies every pending migration up to 'target', each in its own transaction, and returns the ones applied"""
+    applied = []
+    version = current_version(conn)
+    for number, name, step in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        if number in OUTSIDE_TRANSACTION:
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (number, name, time.time()))
+            applied.append((number, name))
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)", (number, name, time.time()))
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        applied.append((number, name))
+    return applied
+
+
+def explain(conn):
+    """Returns the query plan of every hot query as {name: [plan detail, ...]}"""
+    plans = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        try:
+            plans[name] = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.OperationalError as error:
+            plans[name] = [f"error: {error}"]
+    return plans
+
+
+def full_scans(plan):
+    """Returns the plan steps that read a whole table, table-valued functions such as json_each(), the single row
+    of a SELECT without FROM and the rows a subquery or WITH clause has just built are not tables"""
+    built = {"SCAN " + step[len("MATERIALIZE "):] for step in plan if step.startswith("MATERIALIZE ")}
+    return [
+        step for step in plan
+        if step.startswith("SCAN") and "USING" not in step and "VIRTUAL TABLE" not in step and step != "SCAN CONSTANT ROW"
+        and step not in built and not step.startswith("SCAN (subquery-")
+    ]
+
+
+def _echo_plans(title, plans):
+    click.echo(title)
+    for name, plan in plans.items():
+        marker = "  FULL SCAN" if full_scans(plan) else ""
+        click.echo(f"  {name}:{marker}")
+        for step in plan:
+            click.echo(f"      {step}")
+
+
+@db_cli.command("upgrade")
+@click.option("--target", type=int, default=None, help="Stop after this schema version.")
+@click.option("--explain/--no-explain", "show_plans", default=False, help="Print query plans before and after upgrading.")
+def upgrade_command(target, show_plans):
+    """Apply pending schema migrations."""
+    conn = connect(current_app.config["DATABASE"])
+    try:
+        if show_plans:
+            _echo_plans("Query plans before upgrade:", explain(conn))
+        applied = upgrade(conn, target)
+        for number, name in applied:
+            click.echo(f"Applied migration {number}: {name}")
+        if not applied:
+            click.echo(f"Database already at version {current_version(conn)}")
+        if show_plans:
+            _echo_plans("Query plans after upgrade:", explain(conn))
+    finally:
+        conn.close()
+
+
+@db_cli.command("explain")
+def explain_command():
+    """Print the query plan of every query issued by the request handlers."""
+    conn = connect(current_app.config["DATABASE"])
+    try:
+        plans = explain(conn)
+    finally:
+        conn.close()
+    _echo_plans("Query plans:", plans)
+    scanning = [name for name, plan in plans.items() if full_scans(plan)]
+    if scanning:
+        raise click.ClickException("full table scans in: " + ", ".join(scanning))
@@ -0,0 +1,57 @@
+import threading
+
+
+# Default for the POOL_PARTITIONS setting read by init_app(): 'city' or 'none'
+DEFAULT_PARTITIONING = "city"
+
+# Partition of the pools created by users without a city, read by riders without a city, the same key the route
+# rollups count those pools under
+UNKNOWN_CITY = 0
+
+
+class Partitions:
+    """One live-pool structure per city, built by factory(city_id) on first use, so a rider's feed only reads and
+    syncs the pools of their own city
+
+    Riders without a city read the UNKNOWN_CITY partition, holding only the pools of other users without a city.
+    The None partition holds the pools of every city and is read by every rider when partitioning is off.
+    """
+
+    # Set by init_app() for every instance
+    by_city = True
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._partitions)
+
+    def __getitem__(self, city_id):
+        key = (UNKNOWN_CITY if city_id is None else city_id) if self.by_city else None
+        partition = self._partitions.get(key)
+        if partition is None:
+            with self._lock:
+                partition = self._partitions.get(key)
+                if partition is None:
+                    partition = self._partitions[key] = self.factory(key)
+        return partition
+
+    def values(self):
+        """Returns the partitions built so far"""
+        with self._lock:
+            return list(self._partitions.values())
+
+    def clear(self):
+        """Drops every partition, each is rebuilt from the database on its next use"""
+        with self._lock:
+            self._partitions.clear()
+
+
+def init_app(app):
+    """Reads POOL_PARTITIONS, 'city' for one partition per city or 'none' for a single one holding every city"""
+    partitioning = app.config.setdefault("POOL_PARTITIONS", DEFAULT_PARTITIONING)
+    if partitioning not in ("city", "none"):
+        raise ValueError(f"unknown POOL_PARTITIONS {partitioning!r}")
+    Partitions.by_city = partitioning == "city"
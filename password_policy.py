@@ -0,0 +1,94 @@
+import os
+
+
+# Defaults for the PASSWORD_* settings read by init_app()
+MIN_LENGTH = 8
+REQUIRED_CLASSES = ("upper", "lower", "digit", "special")
+DENYLIST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "breached_passwords.txt")
+
+SPECIAL_CHARACTERS = frozenset("!@#$%^&*()-_+={}[]|\\;:'\"<>,.?/")
+
+# Character classes as bits, so a password is classified in a single pass
+UPPER, LOWER, DIGIT, SPECIAL = 1, 2, 4, 8
+CLASS_BITS = {"upper": UPPER, "lower": LOWER, "digit": DIGIT, "special": SPECIAL}
+
+# Messages for a missing class, checked in this order
+CLASS_ERRORS = (
+    (UPPER, "password must contain at least one uppercase character"),
+    (LOWER, "password must contain at least one lowercase character"),
+    (DIGIT, "password must contain at least one number"),
+    (SPECIAL, "password must contain a special character"),
+)
+
+
+def _classify(char):
+    if char in SPECIAL_CHARACTERS:
+        return SPECIAL
+    if char.isupper():
+        return UPPER
+    if char.islower():
+        return LOWER
+    if char.isdigit():
+        return DIGIT
+    return 0
+
+
+class PasswordPolicy:
+    """Password rules compiled once, checked against a password in one pass over its characters"""
+
+    def __init__(self, min_length=MIN_LENGTH, required=REQUIRED_CLASSES, denylist_path=DENYLIST_PATH):
+        self.min_length = min_length
+        self.required = 0
+        for name in required:
+            if name not in CLASS_BITS:
+                raise ValueError(f"unknown password character class {name!r}")
+            self.required |= CLASS_BITS[name]
+        self.denylist = load_denylist(denylist_path) if denylist_path else frozenset()
+        # Class bits of every ASCII character, looked up instead of classified one by one
+        self._classes = {chr(code): _classify(chr(code)) for code in range(128)}
+
+    def check(self, password):
+        """Returns the reason the password is rejected, or None if it is acceptable"""
+        if len(password) < self.min_length:
+            return f"password must contain {self.min_length} characters"
+
+        # Collect the classes present, stopping as soon as every required one has been seen
+        seen = 0
+        classes = self._classes
+        for char in password:
+            bit = classes.get(char)
+            seen |= _classify(char) if bit is None else bit
+            if seen & self.required == self.required:
+                break
+
+        for bit, message in CLASS_ERRORS:
+            if self.required & bit and not seen & bit:
+                return message
+
+        if password.lower() in self.denylist:
+            return "password is too common, choose another"
+        return None
+
+
+def load_denylist(path):
+    """Returns the lowercased passwords listed one per line in path, ignoring blank lines and '#' comments"""
+    with open(path, encoding="utf-8") as file:
+        return frozenset(line.strip().lower() for line in file if line.strip() and not line.startswith("#"))
+
+
+policy = PasswordPolicy()
+
+
+def init_app(app):
+    """Replaces the shared policy from PASSWORD_MIN_LENGTH, PASSWORD_REQUIRED_CLASSES and PASSWORD_DENYLIST"""
+    global policy
+    policy = PasswordPolicy(
+        app.config.setdefault("PASSWORD_MIN_LENGTH", MIN_LENGTH),
+        app.config.setdefault("PASSWORD_REQUIRED_CLASSES", REQUIRED_CLASSES),
+        app.config.setdefault("PASSWORD_DENYLIST", DENYLIST_PATH),
+    )
+
+
+def check(password):
+    """Returns the reason the shared policy rejects the password, or None"""
+    return policy.check(password)
@@ -0,0 +1,138 @@
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+import accounts
+import geo
+import repository
+
+
+# Interned places remembered by each worker, a place never changes once stored so entries never go stale
+CACHE_SIZE = 50000
+
+# Short forms expanded when normalizing, so "Sec 5 Main Rd" and "Sector 5, Main Road" are the same place
+ABBREVIATIONS = {
+    "apt": "apartment",
+    "apts": "apartments",
+    "ave": "avenue",
+    "bldg": "building",
+    "blvd": "boulevard",
+    "clg": "college",
+    "ext": "extension",
+    "govt": "government",
+    "hosp": "hospital",
+    "hwy": "highway",
+    "jn": "junction",
+    "jnct": "junction",
+    "ln": "lane",
+    "mkt": "market",
+    "ngr": "nagar",
+    "nr": "near",
+    "opp": "opposite",
+    "ph": "phase",
+    "rd": "road",
+    "sch": "school",
+    "sec": "sector",
+    "sect": "sector",
+    "st": "street",
+    "stn": "station",
+    "univ": "university",
+}
+
+# A stored place, 'name' being the first spelling it was seen under
+Place = namedtuple("Place", "id name latitude longitude")
+
+
+def normalize(text):
+    """Returns the key a place is interned under: case-folded, punctuation and whitespace collapsed to single spaces
+    and common abbreviations written out"""
+    text = (text or "").casefold()
+    words = re.findall(r"[^\W_]+", text)
+    if not words:
+        # Nothing but punctuation, still a place of its own
+        return " ".join(text.split())
+    return " ".join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+def display(text):
+    """Returns the text as shown to riders: whitespace collapsed and the first character uppercased"""
+    text = " ".join(text.split())
+    return text[:1].upper() + text[1:]
+
+
+class PlaceTable:
+    """LRU cache of interned places by (city key, place key), and of city ids by city key, storing places and
+    cities seen for the first time"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        # Cities are few, every one seen is kept
+        self._cities = {}
+        self._lock = threading.Lock()
+
+    def intern(self, text, city, point=None):
+        """Returns the Place named by text within city, storing it when new
+
+        A new place takes the (latitude, longitude) given as point, or is geocoded against the gazetteer.
+        """
+        key = (normalize(city), normalize(text))
+        with self._lock:
+            place = self._entries.get(key)
+            if place is not None:
+                self._entries.move_to_end(key)
+                return place
+
+        place = repository.place(*key)
+        if place is None:
+            if point is None or point[0] is None:
+                point = geo.geocode(key[1], key[0])
+            # Another worker may store the same place meanwhile, whichever insert lands first names it
+            repository.add_place(*key, display(text), *point)
+            place = repository.place(*key)
+        place = Place(*place)
+        with self._lock:
+            self._entries[key] = place
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return place
+
+    def city(self, name):
+        """Returns the id of the city, storing it when new"""
+        key = normalize(name)
+        city_id = self._cities.get(key)
+        if city_id is None:
+            city_id = repository.city_id(key)
+            if city_id is None:
+                repository.add_city(key, display(name))
+                city_id = repository.city_id(key)
+            self._cities[key] = city_id
+        return city_id
+
+    def clear(self):
+        """Drops every cached place and city"""
+        with self._lock:
+            self._entries.clear()
+            self._cities.clear()
+
+
+table = PlaceTable()
+
+
+def intern(text, city, point=None):
+    """Returns the Place named by text within city from the shared table, see PlaceTable.intern"""
+    return table.intern(text, city, point)
+
+
+def city(name):
+    """Returns the id of the named city from the shared table, or None when no city was given"""
+    if name is None or name == accounts.NOT_AVAILABLE:
+        return None
+    return table.city(name)
+
+
+def home(address, city, point=None):
+    """Returns the Place a user lives at, or None when they gave no address"""
+    if address is None or address == accounts.NOT_AVAILABLE:
+        return None
+    return table.intern(address, city, point)
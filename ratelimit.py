@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import namedtuple
+
+import database
+
+
+# Defaults for the RATE_LIMIT_* settings read by init_app()
+DEFAULT_BACKEND = "sqlite"
+
+# A bucket holds up to 'burst' tokens and regains 'per_minute' of them a minute, each request takes one
+Limit = namedtuple("Limit", "burst per_minute")
+
+# Buckets per endpoint, one per logged-in user and one per client address. Addresses get more room since riders
+# behind one campus or office NAT share them, log-ins are only limited by address since nobody is logged in yet
+LIMITS = {
+    "login": {"ip": Limit(10, 10)},
+    "create_pool": {"user": Limit(20, 10), "ip": Limit(60, 60)},
+    "add_friend": {"user": Limit(30, 20), "ip": Limit(100, 100)},
+    "invite": {"user": Limit(20, 10), "ip": Limit(60, 60)},
+}
+
+# Buckets untouched this long are full again whatever their limit, so they are dropped
+IDLE_SECONDS = 3600
+
+# The backends drop idle buckets once every this many checks
+TRIM_EVERY = 1000
+
+# Takes one token if the bucket, refilled for the time since its last request, has one. A new bucket starts full,
+# and an empty one is left untouched and returns no row
+TAKE_TOKEN = """INSERT INTO rate_limits (key, tokens, updated) VALUES (?1, ?2 - 1, ?4)
+                ON CONFLICT (key) DO UPDATE SET tokens = MIN(?2, tokens + (?4 - updated) * ?3) - 1, updated = ?4
+                WHERE MIN(?2, tokens + (?4 - updated) * ?3) >= 1
+                RETURNING tokens"""
+# Seconds until an empty bucket regains a token
+WAIT_SECONDS = "SELECT (1 - MIN(?2, tokens + (?4 - updated) * ?3)) / ?3 FROM rate_limits WHERE key = ?1"
+DROP_IDLE = "DELETE FROM rate_limits WHERE updated < ?"
+
+
+class MemoryBackend:
+    """Token buckets held by this process, only suited to single-worker deployments"""
+
+    def __init__(self):
+        # key -> (tokens, updated)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key, burst, rate, now):
+        """Takes a token from the bucket and returns 0, or returns the seconds until it has one"""
+        with self._lock:
+            self._checks += 1
+            if self._checks % TRIM_EVERY == 0:
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[1] >= now - IDLE_SECONDS}
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1, now)
+            return 0
+
+
+class SQLiteBackend:
+    """Token buckets in the 'rate_limits' table, so every worker draws from the same ones"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checks = 0
+
+    def __len__(self):
+        return database.query_value("SELECT COUNT(*) FROM rate_limits")
+
+    def take(self, key, burst, rate, now):
+        with self._lock:
+            self._checks += 1
+            trim = self._checks % TRIM_EVERY == 0
+        if trim:
+            database.execute(DROP_IDLE, now - IDLE_SECONDS)
+        if database.column(TAKE_TOKEN, key, burst, rate, now):
+            return 0
+        return database.query_value(WAIT_SECONDS, key, burst, rate, now) or 0
+
+
+class RateLimiter:
+    """Per-user and per-address token buckets for each limited endpoint"""
+
+    def __init__(self, backend=None, limits=LIMITS):
+        self.backend = backend
+        self.limits = limits
+
+    def check(self, endpoint, user_id, address):
+        """Takes a token from each of the endpoint's buckets and returns 0, or returns the seconds to wait when one is
+        empty, the buckets checked before it having been charged"""
+        if self.backend is None:
+            return 0
+        now = time.time()
+        for scope, limit in self.limits.get(endpoint, {}).items():
+            owner = user_id if scope == "user" else address
+            if owner is None:
+                continue
+            wait = self.backend.take(f"{endpoint}:{scope}:{owner}", limit.burst, limit.per_minute / 60, now)
+            if wait:
+                return wait
+        return 0
+
+
+limiter = RateLimiter()
+
+
+def init_app(app):
+    """Sets up the backend named by RATE_LIMIT_BACKEND: 'sqlite' (shared by all workers), 'memory' (single worker)
+    or 'none', and the limits in RATE_LIMITS"""
+    backend = app.config.setdefault("RATE_LIMIT_BACKEND", DEFAULT_BACKEND)
+    limiter.limits = app.config.setdefault("RATE_LIMITS", LIMITS)
+    if backend == "sqlite":
+        limiter.backend = SQLiteBackend()
+    elif backend == "memory":
+        limiter.backend = MemoryBackend()
+    elif backend == "none":
+        limiter.backend = None
+    else:
+        raise ValueError(f"unknown RATE_LIMIT_BACKEND {backend!r}")
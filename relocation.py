@@ -0,0 +1,46 @@
+import click
+
+import database
+import friendship
+import places
+import repository
+from feed import home_tag
+from fragment_cache import cache
+from geo import geocode
+from migrations import db_cli
+
+
+def move_user(user_id, city, address=None):
+    """Re-homes a user in another city, at the given address or their current one, and returns (old, new) locations
+
+    Their feed reads the new city's partition from then on. Pools they already created stay in the city the ride
+    happens in.
+    """
+    old = repository.user_location(user_id)
+    city = places.display(city)
+    address = places.display(address) if address else old.address
+    place = places.home(address, city)
+    latitude, longitude = (place.latitude, place.longitude) if place else geocode(address, city)
+    with database.transaction():
+        repository.move_user(user_id, address, city, places.city(city), place.id if place else None, latitude, longitude)
+        repository.refresh_nearby(user_id, friendship.NEIGHBOUR_LIMIT)
+
+    # The nearby pools cached for the user were found around the old home
+    cache.invalidate(home_tag(old))
+    return old, repository.user_location(user_id)
+
+
+@db_cli.command("move-user")
+@click.argument("username")
+@click.argument("city")
+@click.option("--address", default=None, help="New home address, defaults to the current one.")
+def move_user_command(username, city, address):
+    """Move a user to another city, so their feed reads that city's pools."""
+    try:
+        user_id = repository.user_id(username.lower())
+        if user_id is None:
+            raise click.ClickException(f"no user named {username!r}")
+        old, new = move_user(user_id, city, address)
+    finally:
+        database.release()
+    click.echo(f"Moved {username.lower()} from {old.address}, {old.city} to {new.address}, {new.city} (city {new.city_id}, place {new.place_id})")
@@ -0,0 +1,825 @@
+import json
+
+from database import column, execute, executemany, iterate, query, query_one, query_value, transaction
+
+
+# Users
+
+USER_BY_USERNAME = "SELECT * FROM users WHERE username = ?"
+USER_ID_BY_USERNAME = "SELECT id FROM users WHERE username = ?"
+PASSWORD_HASH = "SELECT hash FROM users WHERE id = ?"
+USER_LOCATION = "SELECT id, address, city, city_id, place_id, latitude, longitude FROM users WHERE id = ?"
+INSERT_USER = """INSERT INTO users (username, fullname, hash, address, city, bike, phone, latitude, longitude, place_id, city_id)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+MOVE_USER = "UPDATE users SET address = ?, city = ?, city_id = ?, place_id = ?, latitude = ?, longitude = ? WHERE id = ?"
+UPDATE_PASSWORD_HASH = "UPDATE users SET hash = ? WHERE id = ?"
+REPLACE_PASSWORD_HASH = "UPDATE users SET hash = ? WHERE id = ? AND hash = ?"
+USERS_BY_IDS = """SELECT id, username, fullname, address, city, bike, phone FROM users
+                  WHERE id IN (SELECT value FROM json_each(?))
+                  ORDER BY username"""
+USERS_SINCE = "SELECT id, username, fullname FROM users WHERE id > ? ORDER BY id"
+
+
+def user_by_username(username):
+    """Returns the user with the given username, or None"""
+    return query_one(USER_BY_USERNAME, username)
+
+
+def user_id(username):
+    """Returns the id of the user with the given username, or None"""
+    return query_value(USER_ID_BY_USERNAME, username)
+
+
+def password_hash(user_id):
+    """Returns the stored password hash of a user"""
+    return query_value(PASSWORD_HASH, user_id)
+
+
+def users_by_ids(user_ids):
+    """Returns the public profile of every listed user in one query, ordered by username"""
+
+    # The ids travel as a single JSON array so the statement text, and its cached prepared form, never changes
+    return query(USERS_BY_IDS, json.dumps(list(user_ids)))
+
+
+def users_since(last_id):
+    """Yields (id, username, fullname) of users registered after last_id, in id order, without holding them all"""
+    return iterate(USERS_SINCE, last_id)
+
+
+def user_location(user_id):
+    """Returns the user's address, city, city id, home place id and geocoded coordinates"""
+    return query_one(USER_LOCATION, user_id)
+
+
+def create_user(username, fullname, hash, address, city, bike, phone, latitude=None, longitude=None, place_id=None, city_id=None):
+    """Stores a new user and returns its id"""
+    return execute(INSERT_USER, username, fullname, hash, address, city, bike, phone, latitude, longitude, place_id, city_id).lastrowid
+
+
+def move_user(user_id, address, city, city_id, place_id, latitude, longitude):
+    """Points a user's home at another address and city"""
+    execute(MOVE_USER, address, city, city_id, place_id, latitude, longitude, user_id)
+
+
+def set_password_hash(user_id, hash):
+    """Replaces a user's password hash"""
+    execute(UPDATE_PASSWORD_HASH, hash, user_id)
+
+
+def replace_password_hash(user_id, old_hash, new_hash):
+    """Replaces a user's password hash only if it is still old_hash"""
+    execute(REPLACE_PASSWORD_HASH, new_hash, user_id, old_hash)
+
+
+# Places and cities
+
+PLACE = "SELECT id, name, latitude, longitude FROM places WHERE city = ? AND key = ?"
+INSERT_PLACE = """INSERT INTO places (city, key, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)
+                  ON CONFLICT (city, key) DO NOTHING"""
+CITY_ID = "SELECT id FROM cities WHERE key = ?"
+INSERT_CITY = "INSERT INTO cities (key, name) VALUES (?, ?) ON CONFLICT (key) DO NOTHING"
+
+
+def place(city, key):
+    """Returns (id, name, latitude, longitude) of the place stored under the normalized city and key, or None"""
+    return query_one(PLACE, city, key)
+
+
+def add_place(city, key, name, latitude, longitude):
+    """Stores a place unless one is already stored under the same city and key"""
+    execute(INSERT_PLACE, city, key, name, latitude, longitude)
+
+
+def city_id(key):
+    """Returns the id of the city stored under the normalized key, or None"""
+    return query_value(CITY_ID, key)
+
+
+def add_city(key, name):
+    """Stores a city unless one is already stored under the same key"""
+    execute(INSERT_CITY, key, name)
+
+
+# Pools
+
+NEARBY_POOLS = """SELECT MIN(pools.id) AS id, users.username, users.fullname, users.bike, users.phone,
+                         origins.name AS origin, destinations.name AS destination
+                  FROM pools
+                  JOIN users ON users.id = pools.creator
+                  JOIN users AS me ON me.place_id = users.place_id
+                  JOIN places AS origins ON origins.id = pools.origin_id
+                  JOIN places AS destinations ON destinations.id = pools.destination_id
+                  WHERE me.id = ? AND pools.creator != me.id AND pools.time > ?
+                  GROUP BY pools.origin_id, pools.destination_id
+                  ORDER BY id"""
+INVITED_POOLS = """SELECT MIN(pools.id) AS id, users.username, users.fullname, users.bike, users.phone,
+                          origins.name AS origin, destinations.name AS destination
+                   FROM pools
+                   JOIN users ON users.id = pools.creator
+                   JOIN places AS origins ON origins.id = pools.origin_id
+                   JOIN places AS destinations ON destinations.id = pools.destination_id
+                   WHERE pools.follower = ? AND pools.time > ?
+                   GROUP BY pools.origin_id, pools.destination_id
+                   ORDER BY id"""
+LIVE_POOLS_SINCE = """SELECT pools.id, pools.creator, pools.follower, pools.origin_id, pools.destination_id,
+                            origins.name AS origin, destinations.name AS destination, pools.time,
+                            origins.latitude AS origin_latitude, origins.longitude AS origin_longitude,
+                            destinations.latitude AS destination_latitude, destinations.longitude AS destination_longitude,
+                            users.username, users.fullname, users.bike, users.phone
+                     FROM pools INDEXED BY pools_time
+                     JOIN users ON users.id = pools.creator
+                     JOIN places AS origins ON origins.id = pools.origin_id
+                     JOIN places AS destinations ON destinations.id = pools.destination_id
+                     WHERE pools.id > ? AND pools.time > ?
+                     ORDER BY pools.id"""
+# The same for one city, read through its own slice of the (city_id, time) index
+LIVE_POOLS_IN_CITY = """SELECT pools.id, pools.creator, pools.follower, pools.origin_id, pools.destination_id,
+                              origins.name AS origin, destinations.name AS destination, pools.time,
+                              origins.latitude AS origin_latitude, origins.longitude AS origin_longitude,
+                              destinations.latitude AS destination_latitude, destinations.longitude AS destination_longitude,
+                              users.username, users.fullname, users.bike, users.phone
+                       FROM pools INDEXED BY pools_city_time
+                       JOIN users ON users.id = pools.creator
+                       JOIN places AS origins ON origins.id = pools.origin_id
+                       JOIN places AS destinations ON destinations.id = pools.destination_id
+                       WHERE pools.city_id = ? AND pools.id > ? AND pools.time > ?
+                       ORDER BY pools.id"""
+# The same for the pools of creators without a city, through the NULL slice of that index
+LIVE_POOLS_WITHOUT_CITY = """SELECT pools.id, pools.creator, pools.follower, pools.origin_id, pools.destination_id,
+                                   origins.name AS origin, destinations.name AS destination, pools.time,
+                                   origins.latitude AS origin_latitude, origins.longitude AS origin_longitude,
+                                   destinations.latitude AS destination_latitude, destinations.longitude AS destination_longitude,
+                                   users.username, users.fullname, users.bike, users.phone
+                            FROM pools INDEXED BY pools_city_time
+                            JOIN users ON users.id = pools.creator
+                            JOIN places AS origins ON origins.id = pools.origin_id
+                            JOIN places AS destinations ON destinations.id = pools.destination_id
+                            WHERE pools.city_id IS NULL AND pools.id > ? AND pools.time > ?
+                            ORDER BY pools.id"""
+POOLS_BY_IDS = """SELECT pools.id, users.username, users.fullname, users.bike, users.phone, origins.name AS origin, destinations.name AS destination
+                  FROM pools
+                  JOIN users ON users.id = pools.creator
+                  JOIN places AS origins ON origins.id = pools.origin_id
+                  JOIN places AS destinations ON destinations.id = pools.destination_id
+                  WHERE pools.id IN (SELECT value FROM json_each(?))"""
+EARLIEST_POOL_TIME = "SELECT MIN(time) FROM pools WHERE id IN (SELECT value FROM json_each(?))"
+INSERT_POOL = "INSERT INTO pools (creator, city_id, follower, origin_id, destination_id, time) VALUES (?, ?, ?, ?, ?, ?)"
+# The listed users who are not friends of ?1, each looked up through the (sender, receiver) index
+NOT_FRIENDS = """SELECT value FROM json_each(?2)
+                 WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = value AND status = 'accepted')
+                   AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = value AND receiver = ?1 AND status = 'accepted')"""
+# One pool per invited friend, RETURNING pairs each new id with its follower
+INVITE_POOLS = """INSERT INTO pools (creator, city_id, follower, origin_id, destination_id, time)
+                  SELECT ?, ?, value, ?, ?, ? FROM json_each(?)
+                  RETURNING id, follower"""
+
+def nearby_pools(user_id, cutoff):
+    """Returns live pools created by other users living at the user's home place, one row per route"""
+
+    # Walk the live pools through the index on 'pools.time', keep the ones whose creator shares the user's place
+    # and collapse repeated routes onto the earliest pool, which is the one the homepage always showed first
+    return query(NEARBY_POOLS, user_id, cutoff)
+
+
+def invited_pools(user_id, cutoff):
+    """Returns live pools the user was invited to by friends, one row per route"""
+    return query(INVITED_POOLS, user_id, cutoff)
+
+
+def live_pools_since(last_id, cutoff, city_id=None):
+    """Returns live pools newer than last_id with their creator's contact details, in id order, only those created
+    in the given city unless city_id is None, city 0 holding those created by users without a city"""
+
+    # The two-hour live window is always small, so the scan is pinned to the time index rather than an id range
+    # that would start at the first pool ever created on a worker's first sync
+    if city_id is None:
+        return query(LIVE_POOLS_SINCE, last_id, cutoff)
+    if city_id == 0:
+        return query(LIVE_POOLS_WITHOUT_CITY, last_id, cutoff)
+    return query(LIVE_POOLS_IN_CITY, city_id, last_id, cutoff)
+
+
+def pools_by_ids(pool_ids):
+    """Returns the listed pools with their creator's contact details in one query, keyed by pool id"""
+    return {pool.id: pool for pool in query(POOLS_BY_IDS, json.dumps(list(pool_ids)))}
+
+
+def earliest_pool_time(pool_ids):
+    """Returns the creation time of the oldest of the listed pools, or None"""
+    return query_value(EARLIEST_POOL_TIME, json.dumps(list(pool_ids)))
+
+
+def create_pool(creator, city_id, origin_id, destination_id, time, date):
+    """Stores a new pool between two places of the creator's city, its entry in the creator's history and its count
+    in the route rollups in one transaction and returns the pool's id"""
+    with transaction():
+        pool_id = execute(INSERT_POOL, creator, city_id, None, origin_id, destination_id, time).lastrowid
+        execute(INSERT_HISTORY, creator, pool_id, None, origin_id, destination_id, date)
+        count_routes(pool_id, pool_id)
+    return pool_id
+
+
+def invite_friends(creator, city_id, followers, origin_id, destination_id, time, date):
+    """Stores one pool per invited friend and their entries in the creator's history in one transaction, and returns
+    {follower: pool id}, or None without storing anything when a follower is not the creator's friend"""
+    followers = json.dumps(list(followers))
+    with transaction():
+        # Checked against the requests table in the same transaction, a friend cache may be a minute behind
+        if column(NOT_FRIENDS, creator, followers):
+            return None
+        invited = {
+            pool.follower: pool.id
+            for pool in query(INVITE_POOLS, creator, city_id, origin_id, destination_id, time, followers)
+        }
+        executemany(INSERT_HISTORY, [(creator, pool_id, follower, origin_id, destination_id, date) for follower, pool_id in invited.items()])
+        if invited:
+            count_routes(min(invited.values()), max(invited.values()))
+    return invited
+
+
+# Route rollups
+
+# Hour of the week a pool was created in, 0 for Monday midnight to 167, in the server's local time like history dates
+_HOUR_OF_WEEK = """(CAST(strftime('%w', pools.time, 'unixepoch', 'localtime') AS INTEGER) + 6) % 7 * 24
+                   + CAST(strftime('%H', pools.time, 'unixepoch', 'localtime') AS INTEGER)"""
+# A pool created by a user without a bike is a ride request, the same test as matcher.owns_bike()
+_WITHOUT_BIKE = "UPPER(TRIM(COALESCE(users.bike, ''))) IN ('', 'NOT OWNED', 'NOT AVAILABLE')"
+# Key, GROUP BY positions and grouped values of each rollup, pools of users without a city are counted under city 0
+_ROUTE_GROUPS = {
+    "route_hours": ("city_id, origin_id, destination_id, hour", "1, 2, 3, 4", f"COALESCE(pools.city_id, 0), pools.origin_id, pools.destination_id, {_HOUR_OF_WEEK}"),
+    "route_totals": ("city_id, origin_id, destination_id", "1, 2, 3", "COALESCE(pools.city_id, 0), pools.origin_id, pools.destination_id"),
+    "city_hours": ("city_id, hour", "1, 2", f"COALESCE(pools.city_id, 0), {_HOUR_OF_WEEK}"),
+}
+
+# Adds a range of new pool ids to each rollup, in the transaction that inserts them
+COUNT_ROUTES = {
+    table: f"""INSERT INTO {table} ({key}, pools, requests)
+               SELECT {groups}, COUNT(*), SUM({_WITHOUT_BIKE})
+               FROM pools JOIN users ON users.id = pools.creator
+               WHERE pools.id BETWEEN ?1 AND ?2
+               GROUP BY {positions}
+               ON CONFLICT ({key}) DO UPDATE SET pools = pools + excluded.pools, requests = requests + excluded.requests"""
+    for table, (key, positions, groups) in _ROUTE_GROUPS.items()
+}
+# Rebuilds the hourly route counts from every live and archived pool, and the other two rollups from those
+ROLLUP_ROUTE_HOURS = f"""INSERT INTO route_hours (city_id, origin_id, destination_id, hour, pools, requests)
+                         SELECT {_ROUTE_GROUPS["route_hours"][2]}, COUNT(*), SUM({_WITHOUT_BIKE})
+                         FROM (SELECT city_id, creator, origin_id, destination_id, time FROM pools
+                               UNION ALL
+                               SELECT city_id, creator, origin_id, destination_id, time FROM pools_archive) AS pools
+                         JOIN users ON users.id = pools.creator
+                         GROUP BY 1, 2, 3, 4"""
+ROLLUP_ROUTE_TOTALS = """INSERT INTO route_totals (city_id, origin_id, destination_id, pools, requests)
+                         SELECT city_id, origin_id, destination_id, SUM(pools), SUM(requests) FROM route_hours
+                         GROUP BY city_id, origin_id, destination_id"""
+ROLLUP_CITY_HOURS = """INSERT INTO city_hours (city_id, hour, pools, requests)
+                       SELECT city_id, hour, SUM(pools), SUM(requests) FROM route_hours
+                       GROUP BY city_id, hour"""
+TOP_ROUTES = """SELECT route_totals.origin_id, route_totals.destination_id, origins.name AS origin, destinations.name AS destination,
+                       route_totals.pools, route_totals.requests
+                FROM route_totals INDEXED BY route_totals_rank
+                JOIN places AS origins ON origins.id = route_totals.origin_id
+                JOIN places AS destinations ON destinations.id = route_totals.destination_id
+                WHERE route_totals.city_id = ?
+                ORDER BY route_totals.pools DESC
+                LIMIT ?"""
+CITY_HOURS = "SELECT hour, pools, requests FROM city_hours WHERE city_id = ?"
+ROUTE_HOURS = "SELECT hour, pools, requests FROM route_hours WHERE city_id = ? AND origin_id = ? AND destination_id = ?"
+PLACE_NAME = "SELECT name FROM places WHERE id = ?"
+
+
+def count_routes(first_pool_id, last_pool_id):
+    """Adds the pools with ids in the inclusive range to the route rollups"""
+    for sql in COUNT_ROUTES.values():
+        execute(sql, first_pool_id, last_pool_id)
+
+
+def rollup_routes():
+    """Recounts the route rollups from every live and archived pool in one transaction"""
+    with transaction():
+        for table in _ROUTE_GROUPS:
+            execute(f"DELETE FROM {table}")
+        for sql in (ROLLUP_ROUTE_HOURS, ROLLUP_ROUTE_TOTALS, ROLLUP_CITY_HOURS):
+            execute(sql)
+
+
+def top_routes(city_id, limit):
+    """Returns the city's routes with the most pools ever created, busiest first, with how many were ride requests"""
+    return query(TOP_ROUTES, city_id or 0, limit)
+
+
+def city_hours(city_id):
+    """Returns (hour of week, pools, requests) for every hour of the week the city has seen a pool in"""
+    return query(CITY_HOURS, city_id or 0)
+
+
+def route_hours(city_id, origin_id, destination_id):
+    """Returns (hour of week, pools, requests) for every hour of the week the route has seen a pool in"""
+    return query(ROUTE_HOURS, city_id or 0, origin_id, destination_id)
+
+
+def place_name(place_id):
+    """Returns the name a place is shown under, or None"""
+    return query_value(PLACE_NAME, place_id)
+
+
+# Archive
+
+EXPIRED_POOL_IDS = "SELECT id FROM pools WHERE time <= ? ORDER BY time LIMIT ?"
+ARCHIVE_POOLS = """INSERT INTO pools_archive (id, creator, city_id, follower, origin_id, destination_id, time, archived_at)
+                   SELECT id, creator, city_id, follower, origin_id, destination_id, time, ?
+                   FROM pools WHERE id IN (SELECT value FROM json_each(?))"""
+DELETE_POOLS = "DELETE FROM pools WHERE id IN (SELECT value FROM json_each(?))"
+ORPHANED_HISTORY = """SELECT COUNT(*) FROM history
+                      WHERE pool_id NOT IN (SELECT id FROM pools) AND pool_id NOT IN (SELECT id FROM pools_archive)"""
+
+
+def archive_expired_pools(cutoff, limit, archived_at):
+    """Moves up to 'limit' pools created at or before the cutoff into 'pools_archive' and returns how many moved"""
+
+    # Copy and delete in one short transaction, so every pool id is always in exactly one of the two tables
+    with transaction():
+        pool_ids = json.dumps(column(EXPIRED_POOL_IDS, cutoff, limit))
+        execute(ARCHIVE_POOLS, archived_at, pool_ids)
+        return execute(DELETE_POOLS, pool_ids).rowcount
+
+
+def orphaned_history():
+    """Returns how many history rows point at a pool found neither in 'pools' nor in 'pools_archive'"""
+    return query_value(ORPHANED_HISTORY)
+
+
+# Friend requests
+
+FRIEND_REQUEST = "SELECT * FROM requests WHERE sender = ? AND receiver = ?"
+INSERT_FRIEND_REQUEST = "INSERT INTO requests (sender, receiver, status) VALUES (?, ?, 'pending')"
+# Only pending requests are answered, so accepting one twice never counts the friendship twice
+ANSWER_FRIEND_REQUEST = "UPDATE requests SET status = ? WHERE sender = ? AND receiver = ? AND status = 'pending'"
+PENDING_SENDERS = """SELECT users.username FROM requests
+                     JOIN users ON users.id = requests.sender
+                     WHERE requests.receiver = ? AND requests.status = 'pending'"""
+FRIEND_IDS = """SELECT receiver FROM requests WHERE sender = ? AND status = 'accepted'
+                UNION
+                SELECT sender FROM requests WHERE receiver = ? AND status = 'accepted'"""
+FRIENDS_OF = """SELECT receiver FROM requests WHERE sender IN (SELECT value FROM json_each(?1)) AND status = 'accepted'
+                UNION
+                SELECT sender FROM requests WHERE receiver IN (SELECT value FROM json_each(?1)) AND status = 'accepted'"""
+
+
+def friend_request(sender, receiver):
+    """Returns the friend request sent from one user to another, or None"""
+    return query_one(FRIEND_REQUEST, sender, receiver)
+
+
+def send_friend_request(sender, receiver):
+    """Stores a pending friend request"""
+    execute(INSERT_FRIEND_REQUEST, sender, receiver)
+
+
+def answer_friend_request(sender, receiver, status):
+    """Marks a pending friend request as 'accepted' or 'rejected' and returns whether there was one"""
+    return execute(ANSWER_FRIEND_REQUEST, status, sender, receiver).rowcount > 0
+
+
+def pending_senders(user_id):
+    """Returns the usernames of users waiting for the user to answer their friend request"""
+    return [row.username for row in query(PENDING_SENDERS, user_id)]
+
+
+def friend_ids(user_id):
+    """Returns the ids of the user's friends, whichever side sent the request"""
+    return column(FRIEND_IDS, user_id, user_id)
+
+
+def friends_of(user_ids):
+    """Returns the ids of everyone friends with any of the listed users, in one query"""
+    return column(FRIENDS_OF, json.dumps(list(user_ids)))
+
+
+# Friend suggestions
+
+# How close two users live: 2 at the same place, 1 in the same city, 0 otherwise
+_NEARBY = "CASE WHEN users.place_id = candidates.place_id THEN 2 WHEN users.city_id = candidates.city_id THEN 1 ELSE 0 END"
+
+# Read in rank order straight off the (user_id, mutual, nearby) index, skipping users a request already links
+SUGGESTIONS = """SELECT candidates.username, candidates.fullname, candidates.address, suggestions.mutual, suggestions.nearby
+                 FROM suggestions INDEXED BY suggestions_rank
+                 JOIN users AS candidates ON candidates.id = suggestions.candidate_id
+                 WHERE suggestions.user_id = ?1
+                   AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = suggestions.candidate_id)
+                   AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = suggestions.candidate_id AND receiver = ?1)
+                 ORDER BY suggestions.mutual DESC, suggestions.nearby DESC, suggestions.candidate_id
+                 LIMIT ?2"""
+FRIEND_COUNT = """SELECT COUNT(*) FROM (SELECT receiver FROM requests WHERE sender = ?1 AND status = 'accepted'
+                                       UNION
+                                       SELECT sender FROM requests WHERE receiver = ?1 AND status = 'accepted')"""
+DROP_SUGGESTION = "DELETE FROM suggestions WHERE (user_id = ?1 AND candidate_id = ?2) OR (user_id = ?2 AND candidate_id = ?1)"
+# The connector's friends other than the new friend, each of them not yet friends with the new friend, gain the
+# connector as a mutual friend with the new friend, in both directions
+ADD_MUTUAL_FRIEND = f"""WITH others (id) AS (
+                            SELECT receiver FROM requests WHERE sender = ?2 AND status = 'accepted' AND receiver != ?1
+                            UNION
+                            SELECT sender FROM requests WHERE receiver = ?2 AND status = 'accepted' AND sender != ?1
+                        ), strangers (id, nearby) AS (
+                            SELECT candidates.id, {_NEARBY} FROM others
+                            JOIN users AS candidates ON candidates.id = others.id
+                            JOIN users ON users.id = ?1
+                            WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = others.id AND status = 'accepted')
+                              AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = others.id AND receiver = ?1 AND status = 'accepted')
+                        )
+                        INSERT INTO suggestions (user_id, candidate_id, mutual, nearby)
+                        SELECT ?1, id, 1, nearby FROM strangers
+                        UNION ALL
+                        SELECT id, ?1, 1, nearby FROM strangers WHERE true
+                        ON CONFLICT (user_id, candidate_id) DO UPDATE SET mutual = mutual + 1"""
+# A connector with too many friends stops counting: every pair among its other friends loses it as a mutual friend
+_MEMBERS = """WITH members (id) AS (
+                  SELECT receiver FROM requests WHERE sender = ?1 AND status = 'accepted' AND receiver != ?2
+                  UNION
+                  SELECT sender FROM requests WHERE receiver = ?1 AND status = 'accepted' AND sender != ?2
+              )"""
+DROP_CONNECTOR = f"""{_MEMBERS}
+                     UPDATE suggestions SET mutual = mutual - 1
+                     WHERE user_id IN (SELECT id FROM members) AND candidate_id IN (SELECT id FROM members)"""
+DROP_UNCONNECTED = f"""{_MEMBERS}
+                       DELETE FROM suggestions
+                       WHERE user_id IN (SELECT id FROM members) AND candidate_id IN (SELECT id FROM members) AND mutual <= 0"""
+# A moved user's closeness to each candidate, and each candidate's to them, through the primary key
+REFRESH_NEARBY = f"""UPDATE suggestions SET nearby = (
+                         SELECT {_NEARBY} FROM users, users AS candidates
+                         WHERE users.id = suggestions.user_id AND candidates.id = suggestions.candidate_id
+                     )
+                     WHERE user_id = ?1 OR (user_id IN (SELECT candidate_id FROM suggestions WHERE user_id = ?1) AND candidate_id = ?1)"""
+# The neighbours without mutual friends a user who just moved left behind stop being suggested the user, found
+# through the user's own suggestions, then the user stops being suggested them
+DROP_STRANGERS_OF = """DELETE FROM suggestions
+                       WHERE candidate_id = ?1 AND mutual = 0 AND nearby = 0
+                         AND user_id IN (SELECT candidate_id FROM suggestions WHERE user_id = ?1 AND mutual = 0 AND nearby = 0)"""
+DROP_STRANGERS = "DELETE FROM suggestions WHERE user_id = ?1 AND mutual = 0 AND nearby = 0"
+# Up to ?2 of the users who signed up before the user, living at their place, then in their city, newest first, who
+# are not friends with them. They are suggested to the user and the user to them, without mutual friends unless
+# already counted. Only the next few users to sign up nearby pick a user, so nobody collects a whole city
+ADD_NEIGHBOURS = """WITH neighbours (id, nearby) AS (
+                        SELECT id, nearby FROM (
+                            SELECT candidates.id, 2 AS nearby FROM users
+                            JOIN users AS candidates ON candidates.place_id = users.place_id
+                            WHERE users.id = ?1 AND candidates.id < ?1
+                            ORDER BY candidates.id DESC LIMIT ?2
+                        )
+                        UNION ALL
+                        SELECT id, nearby FROM (
+                            SELECT candidates.id, 1 AS nearby FROM users
+                            JOIN users AS candidates ON candidates.city_id = users.city_id
+                            WHERE users.id = ?1 AND candidates.id < ?1 AND (users.place_id IS NULL OR candidates.place_id IS NOT users.place_id)
+                            ORDER BY candidates.id DESC LIMIT ?2
+                        )
+                        ORDER BY nearby DESC, id DESC LIMIT ?2
+                    ), strangers (id, nearby) AS (
+                        SELECT id, nearby FROM neighbours
+                        WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = neighbours.id AND status = 'accepted')
+                          AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = neighbours.id AND receiver = ?1 AND status = 'accepted')
+                    )
+                    INSERT INTO suggestions (user_id, candidate_id, mutual, nearby)
+                    SELECT ?1, id, 0, nearby FROM strangers
+                    UNION ALL
+                    SELECT id, ?1, 0, nearby FROM strangers WHERE true
+                    ON CONFLICT (user_id, candidate_id) DO NOTHING"""
+# A rebuild keeps only the neighbours, the suggestions without mutual friends
+DROP_MUTUAL = "DELETE FROM suggestions WHERE mutual > 0"
+# Every suggestion from scratch, counting the mutual friends of each pair of users who are not friends, through
+# friends with at most ?1 friends of their own. Neighbours sharing friends gain their count
+SUGGEST_ALL = f"""INSERT INTO suggestions (user_id, candidate_id, mutual, nearby)
+                  WITH friends (user_id, friend_id) AS MATERIALIZED (
+                      SELECT sender, receiver FROM requests WHERE status = 'accepted'
+                      UNION
+                      SELECT receiver, sender FROM requests WHERE status = 'accepted'
+                  ), connectors (id) AS MATERIALIZED (
+                      SELECT user_id FROM friends GROUP BY user_id HAVING COUNT(*) <= ?1
+                  ), pairs (user_id, candidate_id, mutual) AS (
+                      SELECT mine.user_id, theirs.friend_id, COUNT(*) FROM connectors
+                      JOIN friends AS mine ON mine.friend_id = connectors.id
+                      JOIN friends AS theirs ON theirs.user_id = connectors.id
+                      WHERE theirs.friend_id != mine.user_id
+                      GROUP BY mine.user_id, theirs.friend_id
+                  )
+                  SELECT pairs.user_id, pairs.candidate_id, pairs.mutual, {_NEARBY} FROM pairs
+                  JOIN users ON users.id = pairs.user_id
+                  JOIN users AS candidates ON candidates.id = pairs.candidate_id
+                  WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = pairs.user_id AND receiver = pairs.candidate_id AND status = 'accepted')
+                    AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = pairs.candidate_id AND receiver = pairs.user_id AND status = 'accepted')
+                  ON CONFLICT (user_id, candidate_id) DO UPDATE SET mutual = excluded.mutual"""
+
+
+def suggestions(user_id, limit):
+    """Returns up to limit users the user may know, most mutual friends first, then those living closest"""
+    return query(SUGGESTIONS, user_id, limit)
+
+
+def friend_count(user_id):
+    """Returns how many friends the user has"""
+    return query_value(FRIEND_COUNT, user_id)
+
+
+def drop_suggestion(user_id, other_id):
+    """Stops suggesting two users to each other"""
+    execute(DROP_SUGGESTION, user_id, other_id)
+
+
+def add_mutual_friend(friend_id, connector_id):
+    """Counts the connector as a mutual friend between the new friend and each of its other friends"""
+    execute(ADD_MUTUAL_FRIEND, friend_id, connector_id)
+
+
+def drop_connector(connector_id, friend_id):
+    """Stops counting the connector as a mutual friend between its friends other than the new one"""
+    execute(DROP_CONNECTOR, connector_id, friend_id)
+    execute(DROP_UNCONNECTED, connector_id, friend_id)
+
+
+def add_neighbours(user_id, limit):
+    """Suggests up to limit users who signed up before the user and live closest to them, and the user to them"""
+    execute(ADD_NEIGHBOURS, user_id, limit)
+
+
+def refresh_nearby(user_id, neighbour_limit):
+    """Recomputes how close a user lives to their suggestions after a move, and suggests their new neighbours"""
+    execute(REFRESH_NEARBY, user_id)
+    execute(DROP_STRANGERS_OF, user_id)
+    execute(DROP_STRANGERS, user_id)
+    execute(ADD_NEIGHBOURS, user_id, neighbour_limit)
+
+
+def rebuild_suggestions(connector_limit):
+    """Recomputes every mutual friend count from the friend graph"""
+    with transaction():
+        execute(DROP_MUTUAL)
+        execute(SUGGEST_ALL, connector_limit)
+
+
+# Ride matches
+
+# The other side of each live match of the user: the bike owner to ride with, or the rider to give a lift to
+MATCHES_OF_USER = """SELECT 'ride' AS role, users.fullname, users.bike, users.phone, origins.name AS origin, destinations.name AS destination,
+                            matches.origin_km
+                     FROM matches
+                     JOIN pools ON pools.id = matches.offer_id
+                     JOIN users ON users.id = matches.owner
+                     JOIN places AS origins ON origins.id = pools.origin_id
+                     JOIN places AS destinations ON destinations.id = pools.destination_id
+                     WHERE matches.rider = ?1 AND pools.time > ?2
+                     UNION ALL
+                     SELECT 'lift', users.fullname, users.bike, users.phone, origins.name, destinations.name, matches.origin_km
+                     FROM matches
+                     JOIN pools ON pools.id = matches.request_id
+                     JOIN users ON users.id = matches.rider
+                     JOIN places AS origins ON origins.id = pools.origin_id
+                     JOIN places AS destinations ON destinations.id = pools.destination_id
+                     WHERE matches.owner = ?1 AND pools.time > ?2"""
+LAST_MATCH_TIME = "SELECT COALESCE((SELECT created FROM match_runs WHERE id = 1), 0)"
+SAVE_MATCH_RUN = "INSERT INTO match_runs (id, created) VALUES (1, ?) ON CONFLICT (id) DO UPDATE SET created = excluded.created"
+DELETE_MATCHES = "DELETE FROM matches"
+INSERT_MATCH = """INSERT INTO matches (rider, request_id, owner, offer_id, origin_km, wait_seconds, cost, created)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+
+def matches_of_user(user_id, cutoff):
+    """Returns the user's proposed matches whose pools are still live"""
+    return query(MATCHES_OF_USER, user_id, cutoff)
+
+
+def last_match_time():
+    """Returns when the matcher last ran, 0 when it never has"""
+    return query_value(LAST_MATCH_TIME)
+
+
+def replace_matches(rows, created):
+    """Replaces every stored match with the given (rider, request_id, owner, offer_id, origin_km, wait_seconds, cost)
+    rows and records the run in one transaction"""
+    with transaction():
+        execute(DELETE_MATCHES)
+        executemany(INSERT_MATCH, [(*row, created) for row in rows])
+        execute(SAVE_MATCH_RUN, created)
+
+
+# History
+
+INSERT_HISTORY = "INSERT INTO history (user_id, pool_id, recipient_id, origin_id, destination_id, date) VALUES (?, ?, ?, ?, ?, ?)"
+HISTORY_PAGE = """SELECT history.id, origins.name AS origin, destinations.name AS destination, history.date, recipients.fullname AS recipient
+                  FROM history
+                  JOIN places AS origins ON origins.id = history.origin_id
+                  JOIN places AS destinations ON destinations.id = history.destination_id
+                  LEFT JOIN users AS recipients ON recipients.id = history.recipient_id
+                  WHERE history.user_id = ? AND history.id < ?
+                  ORDER BY history.id DESC LIMIT ?"""
+HISTORY_PAGE_BETWEEN = """SELECT history.id, origins.name AS origin, destinations.name AS destination, history.date, recipients.fullname AS recipient
+                          FROM history INDEXED BY history_user_date
+                          JOIN places AS origins ON origins.id = history.origin_id
+                          JOIN places AS destinations ON destinations.id = history.destination_id
+                          LEFT JOIN users AS recipients ON recipients.id = history.recipient_id
+                          WHERE history.user_id = ? AND history.date BETWEEN ? AND ? AND history.id < ?
+                          ORDER BY history.id DESC LIMIT ?"""
+
+# Larger than any history id, the cursor of the first page
+FIRST_PAGE = 2 ** 63 - 1
+
+
+def history_page(user_id, before=FIRST_PAGE, limit=25, start=None, end=None):
+    """Returns up to 'limit' of the user's pools with an id below 'before', newest first, with the recipient's name
+
+    'start' and 'end' are inclusive 'YYYY-MM-DD' dates, either may be None.
+    """
+    if start is None and end is None:
+        # Keyset scan of the (user_id, id) index, every page costs the same however deep it is
+        return query(HISTORY_PAGE, user_id, before, limit)
+
+    # Pinned to the (user_id, date) index, left to itself the planner walks every older id checking each date
+    return query(HISTORY_PAGE_BETWEEN, user_id, start or "0000-00-00", end or "9999-12-31", before, limit)
+
+
+# Sessions
+
+SESSION = "SELECT data, expiry FROM sessions WHERE id = ? AND expiry > ?"
+SAVE_SESSION = """INSERT INTO sessions (id, data, expiry) VALUES (?, ?, ?)
+                  ON CONFLICT (id) DO UPDATE SET data = excluded.data, expiry = excluded.expiry"""
+DELETE_SESSION = "DELETE FROM sessions WHERE id = ?"
+# Through the index on 'expiry'
+DELETE_EXPIRED_SESSIONS = "DELETE FROM sessions WHERE expiry <= ?"
+
+
+def session(sid, now):
+    """Returns the serialized data and expiry of a session still live at 'now', or None"""
+    return query_one(SESSION, sid, now)
+
+
+def save_session(sid, data, expiry):
+    """Stores a session's serialized data, replacing what it held before"""
+    execute(SAVE_SESSION, sid, data, expiry)
+
+
+def delete_session(sid):
+    """Deletes a session"""
+    execute(DELETE_SESSION, sid)
+
+
+def delete_expired_sessions(now):
+    """Deletes sessions expired at 'now' and returns how many were removed"""
+    return execute(DELETE_EXPIRED_SESSIONS, now).rowcount
+
+
+# Homepage fragments
+
+FRAGMENT = "SELECT value, accessed FROM fragments WHERE key = ? AND expiry > ?"
+SAVE_FRAGMENT = """INSERT INTO fragments (key, tag, value, expiry, accessed) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (key) DO UPDATE SET tag = excluded.tag, value = excluded.value, expiry = excluded.expiry,
+                                                   accessed = excluded.accessed"""
+TOUCH_FRAGMENT = "UPDATE fragments SET accessed = ? WHERE key = ?"
+FRAGMENT_COUNT = "SELECT COUNT(*) FROM fragments"
+DELETE_EXPIRED_FRAGMENTS = "DELETE FROM fragments WHERE expiry <= ?"
+# The surplus beyond the size limit goes least recently read first, through the index on 'accessed'
+DELETE_LEAST_RECENT_FRAGMENTS = "DELETE FROM fragments WHERE key IN (SELECT key FROM fragments ORDER BY accessed LIMIT ?)"
+INVALIDATE_FRAGMENTS = "DELETE FROM fragments WHERE tag IN (SELECT value FROM json_each(?))"
+
+
+def fragment(key, now):
+    """Returns the encoded value of a fragment still live at 'now' and when it was last read, or None"""
+    return query_one(FRAGMENT, key, now)
+
+
+def save_fragment(key, tag, value, expiry, accessed):
+    """Stores an encoded fragment under its invalidation tag, replacing what the key held before"""
+    execute(SAVE_FRAGMENT, key, tag, value, expiry, accessed)
+
+
+def touch_fragment(key, accessed):
+    """Records when a fragment was last read"""
+    execute(TOUCH_FRAGMENT, accessed, key)
+
+
+def fragment_count():
+    """Returns how many fragments are stored, live or not"""
+    return query_value(FRAGMENT_COUNT)
+
+
+def trim_fragments(now, size):
+    """Deletes fragments expired at 'now', then the least recently read ones beyond 'size', and returns how many of
+    each went as (expired, evicted)"""
+    with transaction():
+        expired = execute(DELETE_EXPIRED_FRAGMENTS, now).rowcount
+        surplus = query_value(FRAGMENT_COUNT) - size
+        evicted = execute(DELETE_LEAST_RECENT_FRAGMENTS, surplus).rowcount if surplus > 0 else 0
+    return expired, evicted
+
+
+def invalidate_fragments(tags):
+    """Deletes every fragment stored under one of the tags and returns how many were deleted"""
+    return execute(INVALIDATE_FRAGMENTS, json.dumps(list(tags))).rowcount
+
+
+# Events
+
+INSERT_EVENT = """INSERT INTO events (kind, audience, creator, place_id, latitude, longitude, payload, created)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+LAST_EVENT_ID = "SELECT COALESCE(MAX(id), 0) FROM events"
+EVENTS_SINCE = "SELECT id, kind, audience, creator, place_id, latitude, longitude, payload FROM events WHERE id > ? ORDER BY id"
+PURGE_EVENTS = "DELETE FROM events WHERE created < ?"
+
+
+def add_event(kind, audience, creator, place_id, latitude, longitude, payload, created):
+    """Stores an event for every worker's relay to pick up"""
+    execute(INSERT_EVENT, kind, audience, creator, place_id, latitude, longitude, payload, created)
+
+
+def last_event_id():
+    """Returns the id of the newest event, 0 when there is none"""
+    return query_value(LAST_EVENT_ID)
+
+
+def events_since(last_id):
+    """Returns events newer than last_id in the order they were published"""
+    return query(EVENTS_SINCE, last_id)
+
+
+def purge_events(before):
+    """Deletes events published before the given timestamp"""
+    execute(PURGE_EVENTS, before)
+
+
+# Bulk import and export
+
+IMPORT_USERS = """INSERT INTO users (username, fullname, hash, address, city, bike, phone, latitude, longitude, place_id, city_id)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                  ON CONFLICT (username) DO NOTHING"""
+LAST_USER_ID = "SELECT COALESCE(MAX(id), 0) FROM users"
+USER_IDS_AFTER = "SELECT id FROM users WHERE id > ? ORDER BY id"
+USERS_BY_USERNAMES = "SELECT id, username, city, city_id FROM users WHERE username IN (SELECT value FROM json_each(?))"
+IMPORT_FRIEND_REQUESTS = """INSERT INTO requests (sender, receiver, status)
+                            SELECT ?1, ?2, ?3
+                            WHERE NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?1 AND receiver = ?2)
+                              AND NOT EXISTS (SELECT 1 FROM requests WHERE sender = ?2 AND receiver = ?1)"""
+LAST_POOL_ID = "SELECT COALESCE(MAX(id), 0) FROM pools"
+# Dates are written the way create_pool() writes them, in the server's local time
+HISTORY_OF_POOLS_AFTER = """INSERT INTO history (user_id, pool_id, recipient_id, origin_id, destination_id, date)
+                            SELECT creator, id, follower, origin_id, destination_id, date(time, 'unixepoch', 'localtime')
+                            FROM pools WHERE id > ? ORDER BY id"""
+EXPORT_USERS = "SELECT username, fullname, hash, address, city, bike, phone, latitude, longitude FROM users ORDER BY id"
+EXPORT_FRIEND_REQUESTS = """SELECT senders.username AS sender, receivers.username AS receiver, requests.status FROM requests
+                            JOIN users AS senders ON senders.id = requests.sender
+                            JOIN users AS receivers ON receivers.id = requests.receiver
+                            ORDER BY requests.id"""
+EXPORT_POOLS = """SELECT creators.username AS creator, followers.username AS follower, origins.name AS origin, destinations.name AS destination,
+                         pools.time, origins.latitude, origins.longitude, destinations.latitude, destinations.longitude
+                  FROM pools
+                  JOIN users AS creators ON creators.id = pools.creator
+                  LEFT JOIN users AS followers ON followers.id = pools.follower
+                  JOIN places AS origins ON origins.id = pools.origin_id
+                  JOIN places AS destinations ON destinations.id = pools.destination_id
+                  ORDER BY pools.id"""
+
+
+def import_users(rows, neighbour_limit):
+    """Stores (username, fullname, hash, address, city, bike, phone, latitude, longitude, place_id, city_id) rows, skipping taken usernames, and returns how many were stored
+
+    Each stored user is suggested to up to neighbour_limit users living closest to them, as on sign-up.
+    """
+    with transaction():
+        last_id = query_value(LAST_USER_ID)
+        stored = executemany(IMPORT_USERS, rows).rowcount
+        for user_id in column(USER_IDS_AFTER, last_id):
+            execute(ADD_NEIGHBOURS, user_id, neighbour_limit)
+    return stored
+
+
+def users_by_usernames(usernames):
+    """Returns {username: (id, username, city, city_id)} for the given usernames that exist"""
+    return {user.username: user for user in query(USERS_BY_USERNAMES, json.dumps(list(usernames)))}
+
+
+def import_friend_requests(rows):
+    """Stores (sender id, receiver id, status) rows between users not yet linked either way, and returns how many were stored"""
+    return executemany(IMPORT_FRIEND_REQUESTS, rows).rowcount
+
+
+def import_pools(rows):
+    """Stores pools given as INSERT_POOL rows together with their creators' history rows, and returns how many were stored"""
+    with transaction():
+        last_id = query_value(LAST_POOL_ID)
+        stored = executemany(INSERT_POOL, rows).rowcount
+        execute(HISTORY_OF_POOLS_AFTER, last_id)
+        count_routes(last_id + 1, query_value(LAST_POOL_ID))
+    return stored
+
+
+def export_users():
+    """Yields every user with their password hash, oldest first"""
+    return iterate(EXPORT_USERS)
+
+
+def export_friend_requests():
+    """Yields every friend request as (sender, receiver, status) usernames, oldest first"""
+    return iterate(EXPORT_FRIEND_REQUESTS)
+
+
+def export_pools():
+    """Yields every live pool with creator and follower usernames, oldest first"""
+    return iterate(EXPORT_POOLS)
@@ -0,0 +1,140 @@
+import threading
+
+import numpy as np
+
+import repository
+from geo import EARTH_RADIUS_KM
+from partitions import Partitions
+
+
+# Weights of the three cost terms, a pool costs one point per kilometre of detour
+DETOUR_WEIGHT = 1.0
+HEADING_WEIGHT = 4.0
+AGE_WEIGHT = 2.0
+
+# Pools needing a longer detour than this are never recommended
+MAX_DETOUR_KM = 10.0
+
+# Number of pools recommended for a trip
+TOP_K = 10
+
+# Lifetime of a pool in seconds, pools further into it are assumed closer to leaving
+LIFETIME_SECONDS = 2 * 60 * 60
+
+INITIAL_CAPACITY = 1024
+
+
+class RouteScorer:
+    """Column arrays of the live pool routes of one city, or of every city when city_id is None, scored against a
+    rider's trip in one vectorized pass"""
+
+    def __init__(self, city_id=None, capacity=INITIAL_CAPACITY):
+        self.city_id = city_id
+        self._lock = threading.Lock()
+        self._size = 0
+        self.last_id = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.creators = np.zeros(capacity, dtype=np.int64)
+        # Follower of a private invitation, 0 for pools open to everyone
+        self.followers = np.zeros(capacity, dtype=np.int64)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        # Origin and destination as (latitude, longitude) in radians
+        self.origins = np.zeros((capacity, 2), dtype=np.float64)
+        self.destinations = np.zeros((capacity, 2), dtype=np.float64)
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        old = (self.ids, self.creators, self.followers, self.times, self.origins, self.destinations)
+        self._allocate(len(self.ids) * 2)
+        for new, previous in zip((self.ids, self.creators, self.followers, self.times, self.origins, self.destinations), old):
+            new[:self._size] = previous[:self._size]
+
+    def add_many(self, pools):
+        """Appends pool records carrying id, creator, follower, time and coordinates, skipping ones already seen"""
+        with self._lock:
+            for pool in pools:
+                if pool.id <= self.last_id:
+                    continue
+                self.last_id = pool.id
+                if pool.origin_latitude is None or pool.destination_latitude is None:
+                    continue
+                if self._size == len(self.ids):
+                    self._grow()
+                i = self._size
+                self.ids[i] = pool.id
+                self.creators[i] = pool.creator
+                self.followers[i] = pool.follower or 0
+                self.times[i] = pool.time
+                self.origins[i] = np.radians((pool.origin_latitude, pool.origin_longitude))
+                self.destinations[i] = np.radians((pool.destination_latitude, pool.destination_longitude))
+                self._size += 1
+
+    def expire(self, cutoff):
+        """Drops pools created at or before the cutoff"""
+        with self._lock:
+            live = self.times[:self._size] > cutoff
+            if live.all():
+                return
+            keep = np.flatnonzero(live)
+            for column in (self.ids, self.creators, self.followers, self.times, self.origins, self.destinations):
+                column[:len(keep)] = column[keep]
+            self._size = len(keep)
+
+    def sync(self, cutoff):
+        """Appends pools created in the scorer's city since the last sync, in any worker, and drops expired ones"""
+        self.add_many(repository.live_pools_since(self.last_id, cutoff, self.city_id))
+        self.expire(cutoff)
+
+    def score(self, rider_id, origin, destination, now, k=TOP_K):
+        """Returns up to k (cost, pool_id) pairs for the trip from origin to destination, cheapest first
+
+        origin and destination are (latitude, longitude) in degrees. The cost adds the rider's detour to the
+        pool's origin and from its destination, how far the pool's heading turns away from the trip, and how
+        far into its lifetime the pool is.
+        """
+        origin = np.radians(origin)
+        destination = np.radians(destination)
+        with self._lock:
+            n = self._size
+            pool_origins = self.origins[:n]
+            pool_destinations = self.destinations[:n]
+            visible = (self.creators[:n] != rider_id) & ((self.followers[:n] == 0) | (self.followers[:n] == rider_id))
+            age = (now - self.times[:n]) / LIFETIME_SECONDS
+
+            detour = _distance_km(origin, pool_origins) + _distance_km(destination, pool_destinations)
+            trip = _vector_km(origin, destination[None, :])[0]
+            route = _vector_km(pool_origins, pool_destinations)
+
+            # 1 - cos of the angle between the trip and each pool's route, 0 when parallel and 2 when opposite
+            norms = np.linalg.norm(route, axis=1) * np.linalg.norm(trip)
+            turn = 1.0 - np.divide(route @ trip, norms, out=np.ones(n), where=norms > 0)
+
+            cost = DETOUR_WEIGHT * detour + HEADING_WEIGHT * turn + AGE_WEIGHT * np.clip(age, 0.0, 1.0)
+            cost[~visible | (detour > MAX_DETOUR_KM) | (age >= 1.0)] = np.inf
+
+            candidates = np.flatnonzero(np.isfinite(cost))
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(cost[candidates], k)[:k]]
+            candidates = candidates[np.argsort(cost[candidates], kind="stable")]
+            return [(float(cost[i]), int(self.ids[i])) for i in candidates]
+
+
+def _vector_km(start, end):
+    """Returns the local east/north displacement in kilometres between arrays of (latitude, longitude) radians"""
+    latitude = (start[..., 0] + end[..., 0]) / 2
+    east = (end[..., 1] - start[..., 1]) * np.cos(latitude)
+    north = end[..., 0] - start[..., 0]
+    return np.stack((east, north), axis=-1) * EARTH_RADIUS_KM
+
+
+def _distance_km(point, points):
+    """Returns the equirectangular distance from one point to each of many, accurate at city scale"""
+    return np.linalg.norm(_vector_km(point[None, :], points), axis=1)
+
+
+engines = Partitions(RouteScorer)
@@ -0,0 +1,249 @@
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+import database
+import events
+import repository
+
+
+# Defaults for the SESSION_* settings read by init_app()
+DEFAULT_TYPE = "sqlite"
+MEMORY_SIZE = 10000
+SWEEP_INTERVAL = 300
+CACHE_SECONDS = 10
+
+_serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept on the server, the cookie only carries its signed id"""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # Who the session belonged to when loaded, and whether it was cleared since, see 'rotated'
+        self.owner = self.get("user_id")
+        self.cleared = False
+
+    def clear(self):
+        super().clear()
+        self.cleared = True
+
+    @property
+    def rotated(self):
+        """Whether the stored session was cleared or handed to another user, so it must be saved under a new id"""
+        return not self.new and (self.cleared or self.get("user_id") != self.owner)
+
+
+class MemoryStore:
+    """Size-bounded LRU of sessions held by this process, only suited to single-worker deployments"""
+
+    def __init__(self, size=MEMORY_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        """Returns the data of a live session, or None"""
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return dict(entry[1])
+
+    def save(self, sid, data, expiry):
+        with self._lock:
+            self._entries[sid] = (expiry, dict(data))
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+    def sweep(self):
+        """Evicts expired sessions and returns how many were removed"""
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expiry, data) in self._entries.items() if expiry <= now]
+            for sid in expired:
+                del self._entries[sid]
+        return len(expired)
+
+
+class SQLiteStore:
+    """Sessions in the 'sessions' table, shared by every worker, each worker keeping the sessions it read in the last
+    'ttl' seconds in memory so most requests never query the table
+
+    Deleting a session, by logging out or in, is announced on the events bus, and every worker drops it from its
+    cache as soon as the relay hands it over. The ttl bounds how long a worker without the relay may still serve it.
+    """
+
+    def __init__(self, ttl=CACHE_SECONDS, size=MEMORY_SIZE):
+        self.ttl = ttl
+        self.size = size
+        # sid -> (cached until, data), with the least recently used sid first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, sid, data, expiry):
+        with self._lock:
+            self._cache[sid] = (min(time.time() + self.ttl, expiry), dict(data))
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def forget(self, sid):
+        """Drops a session from this worker's cache"""
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is not None and entry[0] > time.time():
+                self._cache.move_to_end(sid)
+                return dict(entry[1])
+        row = repository.session(sid, time.time())
+        if row is None:
+            self.forget(sid)
+            return None
+        data = _serializer.loads(row.data)
+        self._remember(sid, data, row.expiry)
+        return data
+
+    def save(self, sid, data, expiry):
+        repository.save_session(sid, _serializer.dumps(dict(data)), expiry)
+        self._remember(sid, data, expiry)
+
+    def delete(self, sid):
+        self.forget(sid)
+        with database.transaction():
+            repository.delete_session(sid)
+            events.session_deleted(sid)
+
+    def sweep(self):
+        """Deletes expired sessions through the index on 'expiry' and returns how many were removed"""
+        try:
+            return repository.delete_expired_sessions(time.time())
+        finally:
+            database.release()
+
+
+class ServerSessionInterface(SessionInterface):
+    """Loads and saves sessions through a store, identified by a random id in a signed cookie"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="session-id")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.load(sid)
+                if data is not None:
+                    return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # An emptied session, e.g. after logging out, is removed from the store and the browser
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not session.modified:
+            return
+
+        # Logging in clears the session and stores the user's id, so it is saved under a new id and the old one is
+        # deleted. A session id planted in the victim's browser before they log in never becomes theirs
+        if session.rotated:
+            self.store.delete(session.sid)
+            session.sid = secrets.token_urlsafe(32)
+
+        expiry = time.time() + app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.sid, session, expiry)
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+class Sweeper(threading.Thread):
+    """Daemon thread that periodically evicts expired sessions from a store"""
+
+    def __init__(self, store, interval=SWEEP_INTERVAL, logger=None):
+        super().__init__(name="session-sweeper", daemon=True)
+        self.store = store
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._halt = threading.Event()
+
+    def run(self):
+        while not self._halt.wait(self.interval):
+            try:
+                self.store.sweep()
+            except Exception:
+                # A locked database or a failed sweep is retried on the next tick
+                self.logger.exception("session sweep failed, retrying in %s s", self.interval)
+
+    def stop(self):
+        self._halt.set()
+
+
+def init_app(app):
+    """Installs the session backend named by SESSION_TYPE: 'cookie', 'sqlite' or 'memory', and for the latter two the
+    sweeper thread, which the app starts with its first request"""
+    backend = app.config.setdefault("SESSION_TYPE", DEFAULT_TYPE)
+    if backend == "cookie":
+        app.session_interface = SecureCookieSessionInterface()
+        return
+
+    if backend == "memory":
+        store = MemoryStore(app.config.get("SESSION_MEMORY_SIZE", MEMORY_SIZE))
+    elif backend == "sqlite":
+        store = SQLiteStore(app.config.get("SESSION_CACHE_SECONDS", CACHE_SECONDS), app.config.get("SESSION_MEMORY_SIZE", MEMORY_SIZE))
+        # Sessions deleted in any worker leave this worker's cache, see SQLiteStore
+        events.bus.listen("session", lambda payload: store.forget(payload["sid"]))
+    else:
+        raise ValueError(f"unknown SESSION_TYPE {backend!r}")
+
+    app.session_interface = ServerSessionInterface(store)
+    app.extensions["session_sweeper"] = Sweeper(store, app.config.get("SESSION_SWEEP_INTERVAL", SWEEP_INTERVAL), app.logger)
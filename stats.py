@@ -0,0 +1,43 @@
+import time
+from collections import namedtuple
+
+import click
+
+import database
+import repository
+from migrations import db_cli
+
+
+# Busiest routes listed on the stats page
+TOP_ROUTES = 20
+
+DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+# One hour of the week in a heatmap, 'share' being its pools relative to the busiest hour shown, from 0 to 1
+Cell = namedtuple("Cell", "pools requests share")
+
+
+def heatmap(hours):
+    """Returns 7 rows of 24 Cells, Monday first, from (hour of week, pools, requests) rollup rows"""
+    counts = {row.hour: row for row in hours}
+    busiest = max((row.pools for row in hours), default=0)
+    grid = []
+    for day in range(len(DAYS)):
+        cells = []
+        for hour in range(day * 24, day * 24 + 24):
+            row = counts.get(hour)
+            cells.append(Cell(row.pools, row.requests, row.pools / busiest) if row else Cell(0, 0, 0.0))
+        grid.append(cells)
+    return grid
+
+
+@db_cli.command("rollups")
+def rollups_command():
+    """Recount the route rollups behind /stats from every live and archived pool."""
+    start = time.perf_counter()
+    try:
+        repository.rollup_routes()
+        routes, pools = database.query_one("SELECT COUNT(*), COALESCE(SUM(pools), 0) FROM route_totals")
+    finally:
+        database.release()
+    click.echo(f"Counted {pools} pools over {routes} routes in {time.perf_counter() - start:.1f} s")
@@ -0,0 +1,193 @@
+import array
+import bisect
+import heapq
+import sys
+import threading
+import time
+
+import friendship
+import repository
+
+
+# Defaults for the TYPEAHEAD_* settings read by init_app()
+LIMIT = 10
+SYNC_INTERVAL = 5.0
+
+# Matches looked at per lookup, ranking only reorders these, so a one-letter prefix costs no more than a long one
+SCAN_LIMIT = 200
+
+# Longest prefix looked up, anything longer cannot match a username or name anyway
+MAX_PREFIX = 100
+
+# New keys wait in a small sorted buffer, since an insertion into the main arrays moves millions of entries, until it
+# holds more than this many and is merged into them
+BUFFER_KEYS = 20000
+SMALL_BATCH = 100
+
+
+def normalize(text):
+    """Returns the text lowercased with runs of whitespace collapsed to single spaces"""
+    return " ".join(text.lower().split())
+
+
+def _prefixed(keys, ids, prefix):
+    """Yields (key, id) from the sorted arrays for every key starting with the prefix, in key order"""
+    for position in range(bisect.bisect_left(keys, prefix), len(keys)):
+        key = keys[position]
+        if not key.startswith(prefix):
+            return
+        yield key, ids[position]
+
+
+def _prefixed_entries(entries, prefix):
+    """Yields the (key, id) entries of a sorted list whose key starts with the prefix, in key order"""
+    for position in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+        entry = entries[position]
+        if not entry[0].startswith(prefix):
+            return
+        yield entry
+
+
+def _merged(keys, ids, entries):
+    """Returns new key and id arrays holding the arrays' entries and the sorted (key, id) entries, in key order"""
+
+    # Both are already sorted, so this is linear
+    merged = list(heapq.merge(entries, zip(keys, ids))) if keys else entries
+    return [key for key, user_id in merged], array.array("q", (user_id for key, user_id in merged))
+
+
+def search_keys(username, fullname):
+    """Returns the keys a user is found by: the username, the full name and each later word of the full name"""
+    fullname = normalize(fullname)
+    keys = {username.lower(), fullname, *fullname.split(" ")[1:]}
+    keys.discard("")
+    return keys
+
+
+class PrefixIndex:
+    """Sorted array of lowercase search keys with the id of each key's user, searched by bisecting to the first key
+    starting with the prefix"""
+
+    def __init__(self, sync_interval=SYNC_INTERVAL):
+        self.sync_interval = sync_interval
+        self._keys = []
+        # Parallel to _keys, a typed array takes 8 bytes per id instead of a pointer and an int object
+        self._ids = array.array("q")
+        # (key, id) of recently added users in key order
+        self._buffer = []
+        # The buffer being merged into the arrays, still searched until the merged arrays replace the old ones
+        self._flushing = []
+        self._merging = False
+        self._lock = threading.Lock()
+        self._synced = None
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self._keys) + len(self._flushing) + len(self._buffer)
+
+    def add(self, users):
+        """Indexes (id, username, fullname) rows in id order, skipping users already indexed"""
+        entries = []
+        last_id = self.last_id
+        for user_id, username, fullname in users:
+            if user_id <= last_id:
+                continue
+            last_id = user_id
+            # Words shared by many names, such as common first and last names, are stored once
+            entries.extend((sys.intern(key), user_id) for key in search_keys(username, fullname))
+
+        entries.sort()
+        with self._lock:
+            # Another thread may have indexed some of the same users meanwhile
+            entries = [entry for entry in entries if entry[1] > self.last_id]
+            if not entries:
+                return
+            self.last_id = max(self.last_id, last_id)
+            # A sign-up brings a few keys, a sync after a bulk import or the first load may bring millions
+            if len(entries) <= SMALL_BATCH:
+                for entry in entries:
+                    bisect.insort(self._buffer, entry)
+            else:
+                self._buffer = list(heapq.merge(self._buffer, entries)) if self._buffer else entries
+            if len(self._buffer) <= BUFFER_KEYS or self._merging:
+                return
+            self._merging = True
+            # Users added while merging go to a fresh buffer, never into the list being merged
+            keys, ids, flushing = self._keys, self._ids, self._buffer
+            self._flushing, self._buffer = flushing, []
+        self._merge(keys, ids, flushing)
+
+    def _merge(self, keys, ids, flushing):
+        """Merges the entries taken out of the buffer into the arrays, outside the lock so lookups and sign-ups go on
+        meanwhile"""
+        merged = None
+        try:
+            merged = _merged(keys, ids, flushing)
+        finally:
+            with self._lock:
+                if merged is not None:
+                    self._keys, self._ids = merged
+                else:
+                    # A failed merge leaves the entries buffered for the next one
+                    self._buffer = list(heapq.merge(flushing, self._buffer))
+                self._flushing = []
+                self._merging = False
+
+    def sync(self, force=False):
+        """Pulls users registered since the last sync, in any worker, at most once per sync_interval unless forced"""
+        now = time.monotonic()
+        # The first load reads every user, leave it to the first lookup rather than a forced sync after a sign-up
+        if self._synced is None and force:
+            return
+        if not force and self._synced is not None and now - self._synced < self.sync_interval:
+            return
+        self._synced = now
+        self.add(repository.users_since(self.last_id))
+
+    def search(self, prefix, circle=frozenset(), limit=LIMIT, exclude=None):
+        """Returns the ids of up to limit users with a key starting with the prefix, those in circle first and
+        otherwise in key order"""
+        prefix = normalize(prefix[:MAX_PREFIX])
+        if not prefix:
+            return []
+        found = []
+        seen = {exclude}
+        with self._lock:
+            matches = heapq.merge(
+                _prefixed(self._keys, self._ids, prefix), _prefixed_entries(self._flushing, prefix), _prefixed_entries(self._buffer, prefix)
+            )
+            for key, user_id in matches:
+                # A user matching by both username and name is listed once
+                if user_id not in seen:
+                    seen.add(user_id)
+                    found.append(user_id)
+                    if len(found) == SCAN_LIMIT:
+                        break
+        # Stable, so each group stays in key order
+        found.sort(key=lambda user_id: user_id not in circle)
+        return found[:limit]
+
+
+index = PrefixIndex()
+
+
+def suggest(user_id, prefix, limit=LIMIT):
+    """Returns the username, full name and whether they are a friend or friend of a friend for each user matching
+    the prefix, leaving out the user searching"""
+    index.sync()
+    circle = friendship.circle(user_id)
+    found = index.search(prefix, circle, limit, exclude=user_id)
+    if not found:
+        return []
+    profiles = {user.id: user for user in repository.users_by_ids(found)}
+    return [
+        {"username": profiles[found_id].username, "fullname": profiles[found_id].fullname, "known": found_id in circle}
+        for found_id in found
+        if found_id in profiles
+    ]
+
+
+def init_app(app):
+    """Reads TYPEAHEAD_LIMIT and TYPEAHEAD_SYNC_INTERVAL, the index itself is loaded by the first lookup"""
+    app.config.setdefault("TYPEAHEAD_LIMIT", LIMIT)
+    index.sync_interval = app.config.setdefault("TYPEAHEAD_SYNC_INTERVAL", SYNC_INTERVAL)